@@ -0,0 +1,155 @@
+import json
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ClientMethods import ClientMethods
+from ResultsCollector import ResultsCollector
+from CustomExceptions import *
+
+
+class BatchScheduler:
+    """
+    Runs a plan of speed tests without user input. The plan is a JSONL file, one test per line, ex:
+        {"name": "small", "size": "5 MB", "tcp": 2, "udp": 1, "repetitions": 3, "server": "10.0.0.5:41234:41235"}
+    'server' is 'IP:TCP_PORT:UDP_PORT' (or {"ip": .., "tcp_port": .., "udp_port": ..}), without it the test runs
+    against the first server that broadcasts an offer. The optional 'direction' is 'download', 'upload' or 'bidirectional'.
+    With a 'duration' (and an optional 'warmup') in seconds instead of the 'size', the test downloads for that long.
+    Each transfer and each test run (repetition) are written as a JSON record to the results file, followed by an
+    aggregate record per test.
+    """
+    def __init__(self, plan_path, results_path, max_concurrent_tests=1, engine="threads", client_options=None, num_of_workers=None):
+        """
+        Parameters:
+            plan_path: path of the JSONL test plan
+            results_path: path of the JSONL file to write the result records to
+            max_concurrent_tests: how many test runs can run at the same time, the 'processes' engine runs them one at a time
+            engine: 'threads', 'asyncio' or 'processes', the client engine each test run uses
+            client_options: extra ClientMethods keyword arguments (ex broadcast_port, tcp_rcvbuf)
+            num_of_workers: number of worker processes of the 'processes' engine, default is one per core
+        """
+        self.plan = self.load_plan(plan_path)
+        self.results_path = results_path
+        # a 'processes' run already uses all the cores, and concurrent runs would start their workers at the same time
+        self.max_concurrent_tests = 1 if engine == "processes" else max_concurrent_tests
+        self.engine = engine
+        self.client_options = client_options or {}
+        self.num_of_workers = num_of_workers
+        self.results_collector = None  # the single writer of the results file
+        self.discovery_lock = threading.Lock()
+        self.discovered_server = None  # tests without a server share the first discovered one
+        self.discovered_servers = []
+
+    @staticmethod
+    def load_plan(plan_path):
+        """Read and validate the test plan, raises InvalidTestPlan with the line number of the first invalid test"""
+        plan = []
+        with open(plan_path) as plan_file:
+            for line_number, line in enumerate(plan_file, start=1):
+                if line.strip() == "" or line.lstrip().startswith("#"):
+                    continue
+                try:
+                    test = json.loads(line)
+                    size = test["size"] if "duration" not in test else test.get("size", 0)
+                    plan.append({
+                        "name": str(test.get("name", f"test-{line_number}")),
+                        "file_size": size if isinstance(size, int) else ClientMethods.parse_file_size(str(size)),
+                        "num_of_tcp_conn": int(test.get("tcp", 0)),
+                        "num_of_udp_conn": int(test.get("udp", 0)),
+                        "repetitions": int(test.get("repetitions", 1)),
+                        "server": BatchScheduler.parse_server(test.get("server")),
+                        "direction": test.get("direction"),
+                        "duration": float(test["duration"]) if "duration" in test else None,
+                        "warmup": float(test["warmup"]) if "warmup" in test else None,
+                    })
+                    if plan[-1]["direction"] not in (None, "download", "upload", "bidirectional"):
+                        raise ValueError(f"unknown direction {plan[-1]['direction']!r}")
+                    if plan[-1]["duration"] is not None and plan[-1]["direction"] not in (None, "download"):
+                        raise ValueError("a duration-based test is a download")
+                except (ValueError, KeyError, TypeError, InvalidClientInput) as e:
+                    raise InvalidTestPlan(f"Invalid test on line {line_number} of {plan_path}: {e!r}")
+        return plan
+
+    @staticmethod
+    def parse_server(server):
+        """Returns (ip, tcp_port, udp_port), or None if the server should be discovered from its offer"""
+        if server is None or server == "discover":
+            return None
+        if isinstance(server, dict):
+            return server["ip"], int(server["tcp_port"]), int(server["udp_port"])
+        ip, tcp_port, udp_port = server.rsplit(":", 2)
+        return ip, int(tcp_port), int(udp_port)
+
+    def run(self):
+        """Run the whole plan, returns the aggregate record of each test"""
+        with ResultsCollector(self.results_path) as self.results_collector:
+            with ThreadPoolExecutor(max_workers=self.max_concurrent_tests) as executor:
+                runs = [[executor.submit(self.run_test, test, repetition) for repetition in range(test["repetitions"])]
+                        for test in self.plan]
+                aggregates = []
+                for test, test_runs in zip(self.plan, runs):
+                    aggregate = self.aggregate_test(test, [future.result() for future in test_runs])
+                    aggregates.append(aggregate)
+                    self.results_collector.publish_record(aggregate, [ClientMethods.format_colored(
+                        f"Test '{test['name']}' complete: {round(aggregate['throughput']['mean'] / 1e6, 3)} Mbit/s "
+                        f"(±{round(aggregate['throughput']['stdev'] / 1e6, 3)}) over {test['repetitions']} runs", "green")])
+        return aggregates
+
+    def run_test(self, test, repetition):
+        """Run a single repetition of a test, writes a record per transfer and one for the run, returns the run record"""
+        client_options = dict(self.client_options)
+        for option in ("direction", "duration", "warmup"):  # the test's options override the scheduler's
+            if test[option] is not None:
+                client_options[option] = test[option]
+        client = ClientMethods(file_size=test["file_size"], num_of_tcp_conn=test["num_of_tcp_conn"],
+                               num_of_udp_conn=test["num_of_udp_conn"], print_results=False, **client_options)
+        client.server_ip, client.tcp_request_port, client.udp_request_port = test["server"] or self.discover_server(client)
+        if self.engine == "asyncio":
+            results = client.run_transfers_async()
+        elif self.engine == "processes":
+            results = client.run_transfers_in_processes(self.num_of_workers)
+        else:
+            results = client.run_transfers_in_threads()
+
+        for result in results:
+            self.results_collector.publish_record({"record": "transfer", "test": test["name"], "repetition": repetition,
+                                                   "server": client.server_ip, **result})
+        for latency_result in client.latency_results:  # with latency probes, the idle and under load latency of the run
+            self.results_collector.publish_record({**latency_result, "test": test["name"], "repetition": repetition})
+        aggregate = ResultsCollector.aggregate(results)  # the throughput over the wall-clock union of the transfers
+        udp_results = [result for result in results if result["protocol"] == "udp"]
+        run_record = {
+            "record": "test_run", "test": test["name"], "repetition": repetition, "server": client.server_ip,
+            "file_size": test["file_size"], "num_of_tcp_conn": test["num_of_tcp_conn"], "num_of_udp_conn": test["num_of_udp_conn"],
+            "transfers_completed": len(results),
+            "transfers_failed": test["num_of_tcp_conn"] + test["num_of_udp_conn"] - len(results),
+            "bytes_received": aggregate["bytes_delivered"],
+            "wall_time": aggregate["wall_time"],
+            "throughput": aggregate["throughput"],
+            "udp_loss_percent": statistics.mean(result["loss_percent"] for result in udp_results) if udp_results else None,
+        }
+        self.results_collector.publish_record(run_record)
+        return run_record
+
+    def discover_server(self, client):
+        """Listen for a server offer once, and reuse that server for all the tests without an explicit server"""
+        with self.discovery_lock:
+            if self.discovered_server is None:
+                client.listen_for_offers()
+                self.discovered_server = (client.server_ip, client.tcp_request_port, client.udp_request_port)
+                self.discovered_servers = client.servers
+            client.servers = self.discovered_servers  # the servers to spread the transfers over, with a discovery window
+            return self.discovered_server
+
+    @staticmethod
+    def aggregate_test(test, runs):
+        throughputs = [run["throughput"] for run in runs]
+        losses = [run["udp_loss_percent"] for run in runs if run["udp_loss_percent"] is not None]
+        return {
+            "record": "test", "test": test["name"], "file_size": test["file_size"],
+            "num_of_tcp_conn": test["num_of_tcp_conn"], "num_of_udp_conn": test["num_of_udp_conn"],
+            "repetitions": len(runs),
+            "transfers_failed": sum(run["transfers_failed"] for run in runs),
+            "throughput": {"mean": statistics.mean(throughputs), "stdev": statistics.stdev(throughputs) if len(runs) > 1 else 0.0,
+                           "min": min(throughputs), "max": max(throughputs)},
+            "udp_loss_percent": statistics.mean(losses) if losses else None,
+        }
@@ -0,0 +1,118 @@
+from ServerMethods import *
+from ClientMethods import ClientMethods
+import argparse
+import json
+import statistics
+
+# a loopback benchmark of the server and the client, runs both in this process without broadcasts or user input.
+# sweeps file sizes, TCP/UDP connection counts and UDP segment sizes, and writes the results to bench_output.txt/json
+# so hot-path changes can be compared against a baseline
+
+
+def run_benchmark_case(server, file_size, num_of_tcp_conn, num_of_udp_conn, segment_size, engine):
+    """Run one round of transfers against the in-process server, returns the round's measurements"""
+    server.udp_segment_size = segment_size
+    client = ClientMethods(file_size=file_size, num_of_tcp_conn=num_of_tcp_conn, num_of_udp_conn=num_of_udp_conn,
+                           print_results=False)
+    client.server_ip = "127.0.0.1"
+    client.tcp_request_port = server.tcp_main_port
+    client.udp_request_port = server.udp_main_port
+
+    cpu_start = time.process_time()
+    wall_start = time.time()
+    results = client.run_transfers_async() if engine == "asyncio" else client.run_transfers_in_threads()
+    cpu_time = time.process_time() - cpu_start  # client + server, they share this process
+
+    tcp_results = [result for result in results if result["protocol"] == "tcp"]
+    udp_results = [result for result in results if result["protocol"] == "udp"]
+    tcp_bytes = sum(result["bytes_received"] for result in tcp_results)
+    udp_bytes = sum(result["unique_segments"] * segment_size for result in udp_results)
+    # the transfers end when their last byte (segment) arrives. UDP receivers stop on the end-of-stream marker, only if
+    # all its copies are lost they wait for the 1 second timeout, which isn't a part of end_time either way
+    end_time = max((result["end_time"] for result in results), default=time.time())
+    transfer_time = max(end_time - wall_start, 1e-9)
+    return {
+        "gbps": (tcp_bytes + udp_bytes) * 8 / transfer_time / 1e9,
+        "tcp_gbps": tcp_bytes * 8 / transfer_time / 1e9,
+        "udp_gbps": udp_bytes * 8 / transfer_time / 1e9,
+        "cpu_time": cpu_time,
+        "udp_loss_percent": statistics.mean(result["loss_percent"] for result in udp_results) if udp_results else None,
+        "failed_transfers": num_of_tcp_conn + num_of_udp_conn - len(results),
+    }
+
+
+def summarize(values):
+    values = [value for value in values if value is not None]
+    if len(values) == 0:
+        return None
+    return {"mean": statistics.mean(values), "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+            "min": min(values), "max": max(values)}
+
+
+def parse_list(text, parse=int):
+    return [parse(item.strip()) for item in text.split(",") if item.strip() != ""]
+
+
+def format_summary(summary, digits=3):
+    if summary is None:
+        return "-"
+    return f"{round(summary['mean'], digits)} ±{round(summary['stdev'], digits)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback benchmark of the speed test server and client")
+    parser.add_argument("--sizes", default="1MB,10MB,100MB", help="comma separated file sizes (default: 1MB,10MB,100MB)")
+    parser.add_argument("--tcp-conns", default="1,4", help="comma separated TCP connection counts (default: 1,4)")
+    parser.add_argument("--udp-conns", default="0,1", help="comma separated UDP connection counts (default: 0,1)")
+    parser.add_argument("--segment-sizes", default="1024", help="comma separated UDP segment sizes (default: 1024)")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per case, for the variance (default: 3)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="client engine (default: threads)")
+    parser.add_argument("--tcp-mode", choices=["threads", "selectors"], default="threads", help="server TCP mode (default: threads)")
+    parser.add_argument("--udp-rate", type=float, default=None, help="server UDP target rate in Mbit/s (default: as fast as possible)")
+    parser.add_argument("--output", default="bench_output", help="output path without extension (default: bench_output)")
+    args = parser.parse_args()
+
+    server = ServerMethods(udp_target_rate=args.udp_rate * 1000000 if args.udp_rate else None)
+    tcp_listener = server.listen_for_TCP_requests if args.tcp_mode == "threads" else server.listen_for_TCP_requests_selectors
+    threading.Thread(target=tcp_listener, args=(), daemon=True).start()
+    threading.Thread(target=server.listen_for_UDP_requests, args=(), daemon=True).start()
+
+    cases = []
+    for size_text in parse_list(args.sizes, str):
+        for num_of_tcp_conn in parse_list(args.tcp_conns):
+            for num_of_udp_conn in parse_list(args.udp_conns):
+                if num_of_tcp_conn + num_of_udp_conn == 0:
+                    continue
+                # the segment size only matters when there are UDP transfers
+                segment_sizes = parse_list(args.segment_sizes) if num_of_udp_conn > 0 else parse_list(args.segment_sizes)[:1]
+                for segment_size in segment_sizes:
+                    file_size = ClientMethods.parse_file_size(size_text)
+                    runs = [run_benchmark_case(server, file_size, num_of_tcp_conn, num_of_udp_conn, segment_size, args.engine)
+                            for _ in range(args.repeats)]
+                    case = {
+                        "file_size": file_size, "file_size_text": size_text, "num_of_tcp_conn": num_of_tcp_conn,
+                        "num_of_udp_conn": num_of_udp_conn, "segment_size": segment_size,
+                        "gbps": summarize(run["gbps"] for run in runs),
+                        "tcp_gbps": summarize(run["tcp_gbps"] for run in runs),
+                        "udp_gbps": summarize(run["udp_gbps"] for run in runs),
+                        "cpu_time": summarize(run["cpu_time"] for run in runs),
+                        "udp_loss_percent": summarize(run["udp_loss_percent"] for run in runs),
+                        "failed_transfers": sum(run["failed_transfers"] for run in runs),
+                        "runs": runs,
+                    }
+                    cases.append(case)
+                    ServerMethods.print_colored(f"{size_text} tcp={num_of_tcp_conn} udp={num_of_udp_conn} segment={segment_size}: "
+                                                f"{format_summary(case['gbps'])} Gbps", "cyan")
+
+    header = f"{'size':>8} {'tcp':>4} {'udp':>4} {'segment':>8} {'Gbps':>18} {'TCP Gbps':>18} {'UDP Gbps':>18} {'CPU s':>16} {'UDP loss %':>16} {'failed':>6}"
+    lines = [f"engine={args.engine} tcp_mode={args.tcp_mode} repeats={args.repeats} udp_rate={args.udp_rate}", header]
+    for case in cases:
+        lines.append(f"{case['file_size_text']:>8} {case['num_of_tcp_conn']:>4} {case['num_of_udp_conn']:>4} {case['segment_size']:>8} "
+                     f"{format_summary(case['gbps']):>18} {format_summary(case['tcp_gbps']):>18} {format_summary(case['udp_gbps']):>18} "
+                     f"{format_summary(case['cpu_time']):>16} {format_summary(case['udp_loss_percent'], 2):>16} {case['failed_transfers']:>6}")
+    with open(f"{args.output}.txt", "w") as text_file:
+        text_file.write("\n".join(lines) + "\n")
+    with open(f"{args.output}.json", "w") as json_file:
+        json.dump({"engine": args.engine, "tcp_mode": args.tcp_mode, "repeats": args.repeats, "udp_rate": args.udp_rate,
+                   "cases": cases}, json_file, indent=2)
+    print("\n".join(lines))
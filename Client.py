@@ -1,44 +1,121 @@
 from ClientMethods import *
+from BatchScheduler import BatchScheduler
+from ResultsCollector import ResultsCollector
+from PayloadEngine import PAYLOAD_MODES, DEFAULT_PAYLOAD_SEED
 import threading
+import argparse
 
 # broadcast_port == the port that the server will send broadcast offers with.
 # it needs to be known and the same for both the server and the client to initiate communication
 BROADCAST_PORT = 13117
 
 
-def client_loop(client):
+def client_loop(client, engine="threads", num_of_workers=None):
     """The client's Main code, set in a loop, so it'll only be stopped manually"""
     while True:
         # list for server's broadcast offer messages
         client.listen_for_offers()
 
-        # start threads for each requested connection
-        threads = []
-        for i in range(client.num_of_udp_conn):
-            thread = threading.Thread(target=client.run_udp_test, args=(i + 1,), daemon=True)
-            threads.append(thread)
-            thread.start()
+        if engine == "asyncio":
+            # run all the transfers concurrently on a single event loop
+            client.run_transfers_async()
+        elif engine == "processes":
+            # shard the transfers over worker processes that start together
+            client.run_transfers_in_processes(num_of_workers)
+        else:
+            client.run_transfers_in_threads()
 
-        for i in range(client.num_of_tcp_conn):
-            thread = threading.Thread(target=client.run_tcp_test, args=(i + 1,), daemon=True)
-            threads.append(thread)
-            thread.start()
+        # after all transfers are complete, print the round's aggregate throughput and a concluding message
+        client.results_collector.end_round(client.num_of_tcp_conn + client.num_of_udp_conn, {"server": client.server_ip})
+        client.results_collector.publish_lines([client.format_colored("All transfers complete, listening to offer requests", "green"),
+                                                client.format_colored("-" * 40, "blue")])
+        client.results_collector.flush()  # the offer messages are printed directly
 
-        # after all transfers are complete, print a concluding message
-        for thread in threads:
-            thread.join()
 
-        client.print_colored("All transfers complete, listening to offer requests", "green")
-        client.print_colored("-" * 40, "blue")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speed test client")
+    parser.add_argument("--engine", choices=["threads", "asyncio", "processes"], default="threads",
+                        help="'threads' runs a thread per connection, 'asyncio' runs all of them on one event loop, "
+                             "'processes' shards them over worker processes (default: threads)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes of the 'processes' engine (default: 0, one per core)")
+    parser.add_argument("--tcp-rcvbuf", type=int, default=None,
+                        help="SO_RCVBUF of the TCP sockets in bytes (default: the OS default)")
+    parser.add_argument("--sample-interval", type=float, default=0.1,
+                        help="length of the TCP throughput samples in seconds (default: 0.1)")
+    parser.add_argument("--plan", default=None,
+                        help="run the tests of a JSONL test plan without user input instead of the interactive loop")
+    parser.add_argument("--results", default="results.jsonl", help="JSONL file for the transfer, round and test plan results (default: results.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of test plan runs to run at the same time (default: 1)")
+    parser.add_argument("--discovery-window", type=float, default=0,
+                        help="seconds to collect offers from all the servers and choose by connect latency (default: 0, the first offer)")
+    parser.add_argument("--server-selection", choices=["best", "spread"], default="best",
+                        help="with a discovery window, 'best' runs against the lowest latency server, 'spread' spreads the transfers over all of them")
+    parser.add_argument("--offer-ttl", type=float, default=10,
+                        help="seconds discovered servers are reused before listening for offers again (default: 10)")
+    parser.add_argument("--udp-adaptive", action="store_true",
+                        help="UDP transfers search for the highest rate with a loss under --udp-loss-threshold")
+    parser.add_argument("--udp-loss-threshold", type=float, default=1.0,
+                        help="acceptable loss in percent for --udp-adaptive (default: 1.0)")
+    parser.add_argument("--direction", choices=["download", "upload", "bidirectional"], default="download",
+                        help="'upload' sends the data to the server, 'bidirectional' both ways at the same time (default: download)")
+    parser.add_argument("--udp-upload-rate", type=float, default=None,
+                        help="target rate of each UDP upload in Mbit/s (default: as fast as possible)")
+    parser.add_argument("--payload", choices=PAYLOAD_MODES, default="random",
+                        help="the server's payload mode, the uploads send it and --verify expects it (default: random)")
+    parser.add_argument("--payload-seed", type=int, default=DEFAULT_PAYLOAD_SEED,
+                        help="the seed of the server's random payload")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the downloaded data against the payload, each result reports the corrupt blocks")
+    parser.add_argument("--keepalive", type=int, default=1,
+                        help="downloads per TCP connection, more than 1 runs them back to back on a kept-alive connection "
+                             "and reports the cold and warm connection throughput (default: 1)")
+    parser.add_argument("--latency-probes", type=int, default=0,
+                        help="latency probes sent before each round (idle), more probes are sent during its transfers (under load) (default: 0, no latency test)")
+    parser.add_argument("--latency-rate", type=float, default=20, help="latency probes per second (default: 20)")
+    parser.add_argument("--latency-protocol", choices=["udp", "tcp"], default="udp",
+                        help="send the latency probes over UDP or over a TCP connection with TCP_NODELAY (default: udp)")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="download for this many seconds instead of a file size, the rate is measured after the warm-up (default: a file size)")
+    parser.add_argument("--warmup", type=float, default=1,
+                        help="seconds at the start of a --duration download that aren't a part of its rate, ex the TCP slow-start (default: 1)")
+    args = parser.parse_args()
+    if args.duration is not None and (args.direction != "download" or args.udp_adaptive or args.keepalive > 1):
+        parser.error("--duration runs downloads, it can't be combined with --direction, --udp-adaptive or --keepalive")
+    udp_upload_rate = args.udp_upload_rate * 1000000 if args.udp_upload_rate else None
 
+    if args.plan is not None:
+        # headless mode, run the whole plan back to back and exit
+        scheduler = BatchScheduler(args.plan, args.results, args.concurrency, args.engine,
+                                   {"broadcast_port": BROADCAST_PORT, "tcp_rcvbuf": args.tcp_rcvbuf, "sample_interval": args.sample_interval,
+                                    "discovery_window": args.discovery_window, "server_selection": args.server_selection,
+                                    "udp_adaptive": args.udp_adaptive, "udp_loss_threshold": args.udp_loss_threshold,
+                                    "direction": args.direction, "udp_upload_rate": udp_upload_rate,
+                                    "payload_mode": args.payload, "payload_seed": args.payload_seed, "verify_payload": args.verify,
+                                    "keepalive_transfers": args.keepalive, "latency_probes": args.latency_probes,
+                                    "latency_rate": args.latency_rate, "latency_protocol": args.latency_protocol,
+                                    "duration": args.duration, "warmup": args.warmup},
+                                   num_of_workers=args.workers or None)
+        scheduler.run()
+        exit()
 
-if __name__ == "__main__":
-    clnt = ClientMethods(broadcast_port=BROADCAST_PORT)  # init the client and run startup procedure
+    clnt = ClientMethods(broadcast_port=BROADCAST_PORT, tcp_rcvbuf=args.tcp_rcvbuf, sample_interval=args.sample_interval,
+                         discovery_window=args.discovery_window, server_selection=args.server_selection, offer_ttl=args.offer_ttl,
+                         udp_adaptive=args.udp_adaptive, udp_loss_threshold=args.udp_loss_threshold,
+                         direction=args.direction, udp_upload_rate=udp_upload_rate,
+                         payload_mode=args.payload, payload_seed=args.payload_seed, verify_payload=args.verify,
+                         keepalive_transfers=args.keepalive, latency_probes=args.latency_probes,
+                         latency_rate=args.latency_rate, latency_protocol=args.latency_protocol,
+                         duration=args.duration, warmup=args.warmup)  # init the client and run startup procedure
+    # the transfers publish their results to a single writer, that prints them in order and writes them to the results file
+    clnt.results_collector = ResultsCollector(args.results).start()
     try:
         # Run the client Main in a thread, so if the main thread receives a user input to stop, it'll stop the client's loop
-        threading.Thread(target=client_loop, args=(clnt,), daemon=True).start()
+        threading.Thread(target=client_loop, args=(clnt, args.engine, args.workers or None), daemon=True).start()
 
         input()  # stop client by pressing 'Enter'
     except KeyboardInterrupt:
         pass  # doesn't matter if the user stops the client with 'Enter' or Ctrl C
+    finally:
+        clnt.results_collector.close()  # write what was already published
 
@@ -2,13 +2,39 @@ import socket
 import struct
 import time
 import re
+import asyncio
+import threading
+import select
+import os
+import signal
+import queue
+import multiprocessing
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from CustomExceptions import *
+from SocketBatching import DatagramReceiver, DEFAULT_MESSAGE_SIZE
+from TransferAnalysis import UdpLossAnalyzer, ThroughputSampler, LatencyHistogram
+from ServerDiscovery import ServerTable
+from PayloadEngine import PayloadEngine, UdpSegmentSender, PayloadVerifier, DEFAULT_PAYLOAD_SEED
+from ResultsCollector import ResultsQueueForwarder
 
 
 class ClientMethods:
-    def __init__(self, magic_cookie=0xabcddcba, broadcast_port=13117):
+    def __init__(self, magic_cookie=0xabcddcba, broadcast_port=13117, udp_receive_batch_size=64,
+                 tcp_recv_buffer_size=1048576, tcp_rcvbuf=None, sample_interval=0.1,
+                 file_size=None, num_of_tcp_conn=None, num_of_udp_conn=None, print_results=True,
+                 discovery_window=0, server_selection="best", offer_ttl=10,
+                 udp_adaptive=False, udp_loss_threshold=1.0, feedback_interval=0.05,
+                 direction="download", udp_upload_segment_size=1024, udp_upload_rate=None,
+                 payload_mode="random", payload_seed=DEFAULT_PAYLOAD_SEED, verify_payload=False, keepalive_transfers=1,
+                 latency_probes=0, latency_rate=20, latency_protocol="udp", latency_timeout=1, duration=None, warmup=1):
+        # the constructor's arguments, the worker processes of run_transfers_in_processes build their own client from them
+        self.options = {name: value for name, value in locals().items() if name != "self"}
         self.MAGIC_COOKIE = magic_cookie
-        self.file_size, self.num_of_tcp_conn, self.num_of_udp_conn = self.client_startup()
+        if file_size is None or num_of_tcp_conn is None or num_of_udp_conn is None:
+            self.file_size, self.num_of_tcp_conn, self.num_of_udp_conn = self.client_startup()
+        else:  # headless client, ex for benchmarks
+            self.file_size, self.num_of_tcp_conn, self.num_of_udp_conn = file_size, num_of_tcp_conn, num_of_udp_conn
         self.tcp_request_port = None  # the tcp port received in the 'offer' message from the server
         self.udp_request_port = None  # the udp port received in the 'offer' message from the server
         self.server_ip = None
@@ -18,28 +44,85 @@ class ClientMethods:
         self.request_packet_format = '>IBQ'  # Magic cookie (4 bytes), type (1 byte), file size (8 bytes)
         self.payload_msg_type = 0x4
         self.payload_packet_format = '>IBQQ'  # Magic cookie (4 bytes), type (1 byte), total segments (8 bytes), current segment (8 bytes)
+        self.payload_header_size = struct.calcsize(self.payload_packet_format)
+        # adaptive-rate UDP mode, the client sends feedback to the per-client socket and gets the rate the server settled on
+        self.adaptive_request_msg_type = 0x5
+        self.adaptive_request_packet_format = '>IBQH'  # Magic cookie (4 bytes), type (1 byte), file size (8 bytes), acceptable loss in 1/100 % (2 bytes)
+        self.feedback_msg_type = 0x6
+        self.feedback_packet_format = '>IBQQ'  # Magic cookie (4 bytes), type (1 byte), unique segments received (8 bytes), highest segment received (8 bytes)
+        self.adaptive_result_msg_type = 0x7
+        self.adaptive_result_packet_format = '>IBBQQI'  # Magic cookie (4 bytes), type (1 byte), settled (1 byte), rate and goodput in bits/second (8 bytes each), loss in ppm (4 bytes)
+        self.adaptive_result_size = struct.calcsize(self.adaptive_result_packet_format)
+        # upload (client to server) and bidirectional tests use the request format, over TCP the uploaded data follows it
+        self.upload_msg_type = 0x8
+        self.bidirectional_msg_type = 0x9
+        self.ready_msg_type = 0xA
+        self.ready_packet_format = '>IB'  # Magic cookie (4 bytes), type (1 byte), sent from the per-client UDP socket the upload goes to
+        self.upload_result_msg_type = 0xB
+        self.upload_result_packet_format = '>IBQQQdd'  # Magic cookie (4 bytes), type (1 byte), bytes received, unique and lost segments (8 bytes each), receive time and jitter in seconds (8 bytes each)
+        self.upload_result_size = struct.calcsize(self.upload_result_packet_format)
+        # binary TCP downloads (request_packet_format) get a response header before the payload, and keep the connection open
+        self.response_msg_type = 0xC
+        self.response_packet_format = '>IBQ'  # Magic cookie (4 bytes), type (1 byte), payload size that follows (8 bytes)
+        self.response_size = struct.calcsize(self.response_packet_format)
+        # latency probes, the server echoes the sequence and the timestamp of each ping in a pong
+        self.ping_msg_type = 0xD
+        self.pong_msg_type = 0xE
+        self.ping_packet_format = '>IBQd'  # Magic cookie (4 bytes), type (1 byte), sequence (8 bytes), client timestamp (8 bytes)
+        self.ping_size = struct.calcsize(self.ping_packet_format)
+        # the last UDP message of a stream, the receiver stops right away instead of waiting for a timeout
+        self.end_of_stream_msg_type = 0xF
+        self.end_of_stream_packet_format = '>IBQ'  # Magic cookie (4 bytes), type (1 byte), segments sent (8 bytes)
+        self.end_of_stream_size = struct.calcsize(self.end_of_stream_packet_format)
+        # a duration-based download, like a request with the duration in milliseconds instead of the file size
+        self.timed_request_msg_type = 0x10
         self.broadcast_port = broadcast_port
+        self.udp_receive_buffer_size = DEFAULT_MESSAGE_SIZE  # a 1024 bytes segment fits, the receivers grow for larger server segments
+        self.udp_receive_batch_size = udp_receive_batch_size  # max datagrams read with a single recvmmsg call (Linux)
+        self.tcp_recv_buffer_size = tcp_recv_buffer_size  # size of the reusable buffer TCP data is received into
+        self.tcp_rcvbuf = tcp_rcvbuf  # the socket's SO_RCVBUF in bytes, None == the OS default
+        self.sample_interval = sample_interval  # seconds, TCP throughput is sampled in intervals of this length
+        self.async_tcp_buffer = None
+        self.async_executor = None  # the thread pool of the asyncio engine's transfers that run on threads
+        self.print_results = print_results  # print each transfer's result, the transfers also return them
+        # multi-server discovery, 0 == run the tests against the first server that sends an offer
+        self.discovery_window = discovery_window  # seconds to collect offers from all the servers
+        self.server_selection = server_selection  # 'best' == the lowest connect latency, 'spread' == all the servers
+        self.server_table = ServerTable(self.MAGIC_COOKIE, self.offer_msg_type, self.offer_packet_format, offer_ttl)
+        self.servers = []  # the servers the transfers are spread over, when server_selection == 'spread'
+        self.udp_adaptive = udp_adaptive  # UDP transfers search for the highest rate with an acceptable loss
+        self.udp_loss_threshold = udp_loss_threshold  # acceptable loss in percent, for adaptive UDP transfers
+        self.feedback_interval = feedback_interval  # seconds between feedback messages, for adaptive UDP transfers
+        self.direction = direction  # 'download' (server to client), 'upload' (client to server) or 'bidirectional'
+        self.udp_upload_segment_size = udp_upload_segment_size  # the payload size of each uploaded UDP segment
+        self.udp_upload_rate = udp_upload_rate  # bits/second for each UDP upload, None == as fast as possible
+        # the payload stream, the same as the server's: the uploads send it, and the verification expects it
+        self.payload_mode = payload_mode
+        self.payload_seed = payload_seed
+        self.verify_payload = verify_payload  # check the downloaded data against the payload stream
+        # downloads per TCP connection, more than 1 runs them back to back on a kept-alive connection
+        self.keepalive_transfers = keepalive_transfers
+        # latency test, before each round (idle) and during its transfers (under load), 0 probes == no latency test
+        self.latency_probes = latency_probes  # the number of idle probes
+        self.latency_rate = latency_rate  # probes per second
+        self.latency_protocol = latency_protocol  # 'udp' or 'tcp' (a connection of its own with TCP_NODELAY)
+        self.latency_timeout = latency_timeout  # seconds to wait for the pongs after the last ping, later ones are lost
+        self.latency_results = []  # the latency results of the last round
+        # duration-based downloads, the server sends for warmup + duration seconds and the warm-up isn't a part of the rate
+        self.duration = duration  # seconds, None == download file_size bytes
+        self.warmup = warmup  # seconds
+        # the upload payload is built once and shared by all the transfers, like the server's (without sendfile's file,
+        # so there's no file descriptor to close when the client is done)
+        self.upload_engine = PayloadEngine(use_sendfile=False, mode=payload_mode, seed=payload_seed) if direction != "download" else None
+        self.results_collector = None  # a ResultsCollector the transfers publish their results and output to, optional
 
     def client_startup(self):
-        unit_multiplier_dict = {"": 1, "Bytes": 1, "KB": 1024, "MB": 1048576, "GB": 1073741824}
         while True:  # loop until the user provides acceptable values for speed test
             try:
                 # 1) get file size for speed test
                 self.print_colored("-"*40, "blue")
                 file_size_usr_input = input("Insert file size for speed test (format: NUMBER UNIT) ex '5 MB', default UNIT == Bytes: ")
-                input_rgx = re.findall(r"(\d+\.\d+)\s?(\w+)?|(\d+)\s?(\w+)?", file_size_usr_input)
-                if len(input_rgx) == 0:
-                    raise InvalidClientInput()
-                if input_rgx[0][0] != "":  # it means the user has given a float number input
-                    file_size_number = float(input_rgx[0][0])
-                    file_size_units = input_rgx[0][1]
-                else:  # it means the user has given an int number input
-                    file_size_number = int(input_rgx[0][2])
-                    file_size_units = input_rgx[0][3]
-                if file_size_units not in unit_multiplier_dict.keys() and file_size_units != '':  # check if the user has given a valid UNIT size
-                    raise InvalidClientInput(f"Units provided '{file_size_units}' arent supported for this speed test")
-                file_size = round(
-                    file_size_number * unit_multiplier_dict[file_size_units])  # determine final file size to get
+                file_size = self.parse_file_size(file_size_usr_input)
 
                 # 2) get number of TCP connections
                 num_of_tcp_conn_usr_input = input("Insert the number of TCP connections you want to have: ")
@@ -60,8 +143,25 @@ class ClientMethods:
                 self.print_colored(err, "red")
         return file_size, num_of_tcp_conn, num_of_udp_conn
 
-    def listen_for_offers(self):
-        """Listens for broadcasted 'offer' messages from servers."""
+    @staticmethod
+    def parse_file_size(file_size_text):
+        """Parse a file size in the format 'NUMBER UNIT' (ex '5 MB', '1.5GB', '100'), default UNIT == Bytes"""
+        unit_multiplier_dict = {"": 1, "Bytes": 1, "KB": 1024, "MB": 1048576, "GB": 1073741824}
+        input_rgx = re.findall(r"(\d+\.\d+)\s?(\w+)?|(\d+)\s?(\w+)?", file_size_text)
+        if len(input_rgx) == 0:
+            raise InvalidClientInput()
+        if input_rgx[0][0] != "":  # it means the user has given a float number input
+            file_size_number = float(input_rgx[0][0])
+            file_size_units = input_rgx[0][1]
+        else:  # it means the user has given an int number input
+            file_size_number = int(input_rgx[0][2])
+            file_size_units = input_rgx[0][3]
+        if file_size_units not in unit_multiplier_dict.keys() and file_size_units != '':  # check if the user has given a valid UNIT size
+            raise InvalidClientInput(f"Units provided '{file_size_units}' arent supported for this speed test")
+        return round(file_size_number * unit_multiplier_dict[file_size_units])  # determine final file size to get
+
+    def open_offer_socket(self):
+        """A UDP socket bound to the broadcast port, to receive the servers' offers"""
         # Create a UDP socket
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # set socket over UDP with IPv4
         udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)  # option to allow IP wildcard values to work in the network
@@ -72,6 +172,14 @@ class ClientMethods:
             pass # Doesnt work in Windows
         # Bind to the broadcast port to listen for offers
         udp_socket.bind(('', self.broadcast_port))
+        return udp_socket
+
+    def listen_for_offers(self):
+        """Listens for broadcasted 'offer' messages from servers."""
+        if self.discovery_window > 0:
+            self.discover_servers()
+            return
+        udp_socket = self.open_offer_socket()
         self.print_colored("Client started, listening for offer requests...", "cyan")
 
         try:
@@ -101,69 +209,1021 @@ class ClientMethods:
         finally:
             udp_socket.close()
 
-    def run_tcp_test(self, transfer_id):
+    def discover_servers(self):
+        """
+        Collect the offers of all the servers over the discovery window, probe their connect latency and run the tests
+        against the fastest one (or spread them over all of them). Cached offers are reused until they expire,
+        so following rounds don't wait for a broadcast
+        """
+        servers = self.server_table.rank_servers()
+        if len(servers) != 0:
+            self.print_colored(f"Reusing {len(servers)} cached server offer(s)", "cyan")
+        else:
+            udp_socket = self.open_offer_socket()
+            self.print_colored(f"Client started, collecting offer requests for {self.discovery_window} seconds...", "cyan")
+            try:
+                while len(servers) == 0:  # keep listening until a reachable server sends an offer
+                    self.server_table.collect_offers(udp_socket, self.discovery_window)
+                    servers = self.server_table.rank_servers()
+            except KeyboardInterrupt:
+                self.print_colored("Stopped listening for offers", "red")
+                return
+            finally:
+                udp_socket.close()
+        for server in servers:
+            self.print_colored(f"Server {server.ip} (TCP {server.tcp_port}, UDP {server.udp_port}): "
+                               f"connect latency {round(server.rtt * 1000, 3)} ms", "cyan")
+        self.servers = servers if self.server_selection == "spread" else servers[:1]
+        self.server_ip, self.tcp_request_port, self.udp_request_port = servers[0].get_address()
+
+    def get_transfer_server(self, index):
+        """The server of the index-th transfer when the transfers are spread over several servers, None == the chosen server"""
+        if len(self.servers) < 2:
+            return None
+        return self.servers[index % len(self.servers)].get_address()
+
+    def run_tcp_test(self, transfer_id, server=None):
         """
         Establishes a single TCP connection to the server and sends a message.
 
         Parameters:
             transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+
+        Returns the transfer's result as a dict, None if the transfer failed
         """
+        if self.direction != "download":
+            return self.run_tcp_upload_test(transfer_id, server)
+        if self.keepalive_transfers > 1:
+            return self.run_tcp_keepalive_test(transfer_id, server)
+        server_ip, tcp_port, _ = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
         try:
             # Create a socket for the connection
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect((self.server_ip, self.tcp_request_port))
+                self.set_tcp_receive_buffer(client_socket)
+                client_socket.connect((server_ip, tcp_port))
 
-                # Send the file size to get from the server
-                client_socket.sendall(f"{self.file_size}\n".encode('utf-8'))
-
-                # Receive the response
+                # Receive the response into a reusable buffer, and support dynamic file sizes
+                buffer = bytearray(self.tcp_recv_buffer_size)
+                buffer_view = memoryview(buffer)
+                verifier = self.create_verifier()
+                sampler = ThroughputSampler(self.sample_interval)
                 start_time = time.time()
-                while True:  # receive the data in chunks of 1024 Bytes, and support dynamic file sizes
-                    response = client_socket.recv(1024)  # blocking function, not busy-wait
-                    if not response:
+                if self.duration is None:
+                    # Send the file size to get from the server
+                    client_socket.sendall(f"{self.file_size}\n".encode('utf-8'))
+                    sampler.start(start_time)
+                else:
+                    # the server sends for the duration after a response header, then closes the connection
+                    client_socket.sendall(self.get_timed_request())
+                    sampler.start(start_time, self.warmup)
+                    self.check_timed_response(self.receive_exact(client_socket, self.response_size))
+                while True:
+                    num_bytes = client_socket.recv_into(buffer)  # blocking function, not busy-wait
+                    if num_bytes == 0:
                         break  # connection closed
+                    if verifier is not None:
+                        verifier.check_stream(buffer_view[:num_bytes], sampler.total_bytes)
+                    sampler.add(num_bytes, time.time())
                 total_time = time.time() - start_time  # measure the time it took for the whole file size
-                prt = f"TCP transfer #{transfer_id} finished, total time: {round(total_time, 5)} seconds, total speed: {round(self.file_size/total_time*8, 3)} bits/second"
-                self.print_colored(prt, "magenta", 23+len(str(transfer_id)))
+                return self.report_tcp_result(transfer_id, start_time, total_time, sampler, server_ip, verifier)
         except Exception as e:
-            self.print_colored(f"TCP Transfer {transfer_id}: Error: {e}", "red")
+            self.print_transfer_line(f"TCP Transfer {transfer_id}: Error: {e}", "red")
 
+    def run_tcp_keepalive_test(self, transfer_id, server=None):
+        """
+        Runs keepalive_transfers downloads back to back on a single kept-alive TCP connection, with binary requests.
+        The first download pays for the connection's handshake and slow-start (cold), the following ones don't (warm).
 
-    def run_udp_test(self, transfer_id):
+        Parameters:
+            transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+
+        Returns the transfer's result as a dict with the cold and warm throughput, None if the transfer failed
+        """
+        server_ip, tcp_port, _ = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+                self.set_tcp_receive_buffer(client_socket)
+                start_time = time.time()
+                client_socket.connect((server_ip, tcp_port))
+                connect_time = time.time() - start_time
+
+                request_message = struct.pack(self.request_packet_format, self.MAGIC_COOKIE, self.request_msg_type, self.file_size)
+                buffer = bytearray(self.tcp_recv_buffer_size)
+                buffer_view = memoryview(buffer)
+                verifier = self.create_verifier()
+                sampler = ThroughputSampler(self.sample_interval)
+                sampler.start(start_time)
+                transfer_times = []
+                for _ in range(self.keepalive_transfers):
+                    transfer_start = time.time()
+                    client_socket.sendall(request_message)
+                    magic_cookie, message_type, payload_size = struct.unpack(self.response_packet_format,
+                                                                             self.receive_exact(client_socket, self.response_size))
+                    if magic_cookie != self.MAGIC_COOKIE or message_type != self.response_msg_type:
+                        raise InvalidRequestFormat("Invalid response header from the server")
+                    received = 0
+                    while received < payload_size:  # the next response must not be read into this transfer
+                        num_bytes = client_socket.recv_into(buffer, min(len(buffer), payload_size - received))  # blocking function, not busy-wait
+                        if num_bytes == 0:
+                            raise ConnectionResetError("The server closed the connection in the middle of a transfer")
+                        if verifier is not None:
+                            verifier.check_stream(buffer_view[:num_bytes], received)
+                        received += num_bytes
+                        sampler.add(num_bytes, time.time())
+                    transfer_times.append(time.time() - transfer_start)
+                total_time = time.time() - start_time
+            return self.report_tcp_keepalive_result(transfer_id, start_time, total_time, connect_time, transfer_times, sampler, server_ip, verifier)
+        except Exception as e:
+            self.print_transfer_line(f"TCP Transfer {transfer_id}: Error: {e}", "red")
+
+    @staticmethod
+    def receive_exact(client_socket, size):
+        """Read exactly 'size' bytes from a TCP socket, a message may arrive in more than one segment"""
+        data = b''
+        while len(data) < size:
+            chunk = client_socket.recv(size - len(data))  # blocking function, not busy-wait
+            if not chunk:
+                raise ConnectionResetError("The server closed the connection in the middle of a message")
+            data += chunk
+        return data
+
+    def run_latency_test(self, label, server=None, count=None, stop_event=None):
+        """
+        Send timestamped pings to the server at latency_rate per second and measure the round-trip time of each pong.
+
+        Parameters:
+            label: the name of the test in its result, ex 'idle' or 'under load'
+            server: (ip, tcp_port, udp_port) to probe. Optional, default is the chosen server
+            count: the number of pings to send. Optional
+            stop_event: a threading.Event, pings are sent until it's set (instead of 'count'). Optional
+
+        Returns the test's result as a dict, None if the test failed
+        """
+        server_ip, tcp_port, udp_port = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        protocol = self.latency_protocol
+        histogram = LatencyHistogram()
+        outstanding = set()  # the sequences of the pings without a pong yet, so duplicate pongs aren't counted twice
+        sent = 0
+        ipdv_total = 0.0  # the sum of the differences between consecutive RTTs, for the jitter
+        last_rtt = None
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM) as client_socket:
+                if protocol == "tcp":
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # every ping in its own segment, right away
+                    client_socket.connect((server_ip, tcp_port))
+                else:
+                    client_socket.connect((server_ip, udp_port))  # the pongs come from the server's main UDP socket
+                interval = 1 / self.latency_rate
+                next_send = last_send = time.perf_counter()
+                data = b''
+                while True:
+                    now = time.perf_counter()
+                    done_sending = (count is not None and sent >= count) or (stop_event is not None and stop_event.is_set())
+                    if done_sending:
+                        if len(outstanding) == 0 or now >= last_send + self.latency_timeout:
+                            break
+                        wait = last_send + self.latency_timeout - now
+                    elif now >= next_send:
+                        client_socket.send(struct.pack(self.ping_packet_format, self.MAGIC_COOKIE, self.ping_msg_type, sent, now))
+                        outstanding.add(sent)
+                        sent += 1
+                        last_send = now
+                        next_send = max(next_send + interval, now)  # don't burst to catch up after a stall
+                        continue
+                    else:
+                        wait = next_send - now
+                    if not select.select([client_socket], [], [], wait)[0]:  # blocking function, not busy-wait
+                        continue
+                    chunk = client_socket.recv(65535)
+                    receive_time = time.perf_counter()
+                    if protocol == "tcp":
+                        if not chunk:
+                            raise ConnectionResetError("The server closed the latency test connection")
+                        data += chunk
+                    else:
+                        data = chunk if len(chunk) == self.ping_size else b''  # one pong per datagram
+                    while len(data) >= self.ping_size:
+                        magic_cookie, message_type, sequence, timestamp = struct.unpack_from(self.ping_packet_format, data)
+                        data = data[self.ping_size:]
+                        if magic_cookie != self.MAGIC_COOKIE or message_type != self.pong_msg_type or sequence not in outstanding:
+                            continue
+                        outstanding.remove(sequence)
+                        rtt = receive_time - timestamp
+                        histogram.add(rtt)
+                        if last_rtt is not None:
+                            ipdv_total += abs(rtt - last_rtt)
+                        last_rtt = rtt
+        except Exception as e:
+            self.print_transfer_line(f"{protocol.upper()} latency test ({label}): Error: {e}", "red")
+            return None
+        return self.report_latency_result(label, protocol, server_ip, sent, histogram, ipdv_total)
+
+    def run_udp_test(self, transfer_id, server=None):
         """
         Establishes a single UDP connection to the server and sends a message.
 
         Parameters:
             transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+
+        Returns the transfer's result as a dict, None if the transfer failed
         """
+        if self.direction != "download":
+            return self.run_udp_upload_test(transfer_id, server)
+        if self.udp_adaptive:
+            return self.run_udp_adaptive_test(transfer_id, server)
+        server_ip, _, udp_port = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
         try:
             # Create a socket for the connection
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+                # Send the file size (or the duration) to the server and get new dynamic port to run speed test with
+                if self.duration is None:
+                    request_message = struct.pack(self.request_packet_format, self.MAGIC_COOKIE, self.request_msg_type, self.file_size)
+                else:
+                    request_message = self.get_timed_request()
+                client_socket.sendto(request_message, (server_ip, udp_port))
 
-            # Send the file size to the server and get new dynamic port to run speed test with
-            request_message = struct.pack(self.request_packet_format, self.MAGIC_COOKIE, self.request_msg_type, self.file_size)
-            client_socket.sendto(request_message, (self.server_ip, self.udp_request_port))
+                # the datagrams are read into preallocated buffers (batched with recvmmsg on Linux)
+                receiver = DatagramReceiver(client_socket, self.udp_receive_buffer_size, self.udp_receive_batch_size)
+                verifier = self.create_verifier()
+                start_time = time.time()
+                analyzer = UdpLossAnalyzer(self.warmup if self.duration is not None else 0.0)
+                end_of_stream = False
+                while not end_of_stream:  # keep receiving until the end-of-stream marker, or no data for 1 second
+                    count = receiver.receive(timeout=1)  # blocking function, not busy-wait
+                    if count == 0:
+                        break
+                    for i in range(count):
+                        if receiver.lengths[i] == self.end_of_stream_size:
+                            if self.check_end_of_stream(receiver, i, analyzer):
+                                end_of_stream = True
+                            continue
+                        if receiver.lengths[i] < self.payload_header_size:
+                            continue  # not a speed test segment
+                        # read the header of each datagram, the data is only read when it's verified
+                        magic_cookie, message_type, total_segment_count, current_segment_count = struct.unpack_from(
+                            self.payload_packet_format, receiver.buffers, i * receiver.message_size)
+                        if magic_cookie == self.MAGIC_COOKIE and message_type == self.payload_msg_type:
+                            analyzer.add_segment(current_segment_count, total_segment_count, receiver.timestamps[i],
+                                                 receiver.lengths[i] - self.payload_header_size)
+                            if verifier is not None:
+                                self.verify_segment(verifier, receiver, i, current_segment_count)
+                total_time = (analyzer.last_arrival_time or start_time) - start_time  # the time until the last segment arrived
+                return self.report_udp_result(transfer_id, start_time, total_time, analyzer, server_ip, verifier=verifier)
+        except Exception as e:
+            self.print_transfer_line(f"UDP Transfer {transfer_id}: Error: {e}", "red")
 
-            segments_reached = 0
-            start_time = time.time()
-            client_socket.settimeout(1)  # stop receiving if no data has been reached for 1 second
+    def run_udp_adaptive_test(self, transfer_id, server=None):
+        """
+        An adaptive-rate UDP transfer, the server adjusts its send rate from the feedback this transfer sends it and
+        reports the highest rate it found with a loss under udp_loss_threshold.
+
+        Parameters:
+            transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+
+        Returns the transfer's result as a dict, None if the transfer failed
+        """
+        server_ip, _, udp_port = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+                request_message = struct.pack(self.adaptive_request_packet_format, self.MAGIC_COOKIE, self.adaptive_request_msg_type,
+                                              self.file_size, round(self.udp_loss_threshold * 100))
+                client_socket.sendto(request_message, (server_ip, udp_port))
+                start_time = time.time()
+                analyzer = UdpLossAnalyzer()
+                if not select.select([client_socket], [], [], 1)[0]:
+                    return self.report_udp_result(transfer_id, start_time, 0, analyzer, server_ip)
+                # the feedback goes to the server's per-client socket, the source of the segments
+                _, data_address = client_socket.recvfrom(65535, socket.MSG_PEEK)
+                client_socket.connect(data_address)
+
+                receiver = DatagramReceiver(client_socket, self.udp_receive_buffer_size, self.udp_receive_batch_size)
+                verifier = self.create_verifier()
+                adaptive_result = None
+                last_data_time = last_feedback_time = start_time
+                while adaptive_result is None and time.time() - last_data_time < 1:  # until the result, or no data for 1 second
+                    count = receiver.receive(timeout=self.feedback_interval)  # blocking function, not busy-wait
+                    now = time.time()
+                    for i in range(count):
+                        if receiver.lengths[i] < 5:
+                            continue
+                        offset = i * receiver.message_size
+                        magic_cookie, message_type = struct.unpack_from('>IB', receiver.buffers, offset)
+                        if magic_cookie != self.MAGIC_COOKIE:
+                            continue
+                        if message_type == self.payload_msg_type and receiver.lengths[i] >= self.payload_header_size:
+                            _, _, total_segment_count, current_segment_count = struct.unpack_from(self.payload_packet_format, receiver.buffers, offset)
+                            analyzer.add_segment(current_segment_count, total_segment_count, receiver.timestamps[i])
+                            if verifier is not None:
+                                self.verify_segment(verifier, receiver, i, current_segment_count)
+                        elif message_type == self.adaptive_result_msg_type and receiver.lengths[i] == self.adaptive_result_size:
+                            adaptive_result = struct.unpack_from(self.adaptive_result_packet_format, receiver.buffers, offset)[2:]
+                    if count != 0:
+                        last_data_time = now
+                    if now - last_feedback_time >= self.feedback_interval and analyzer.unique_segments != 0:
+                        client_socket.send(struct.pack(self.feedback_packet_format, self.MAGIC_COOKIE, self.feedback_msg_type,
+                                                       analyzer.unique_segments, analyzer.highest_segment))
+                        last_feedback_time = now
+                total_time = (analyzer.last_arrival_time or start_time) - start_time  # the time until the last segment arrived
+                return self.report_udp_result(transfer_id, start_time, total_time, analyzer, server_ip, adaptive_result, verifier)
+        except Exception as e:
+            self.print_transfer_line(f"UDP Transfer {transfer_id}: Error: {e}", "red")
+
+    def run_tcp_upload_test(self, transfer_id, server=None):
+        """
+        A TCP upload (client to server), or with direction == 'bidirectional' an upload and a download at the same time
+        over the same connection. The server measures the upload and sends its result back at the end.
+
+        Parameters:
+            transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+
+        Returns the upload's result as a dict (for a bidirectional transfer the download's result, with the upload's
+        result under 'upload'), None if the transfer failed
+        """
+        server_ip, tcp_port, _ = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        bidirectional = self.direction == "bidirectional"
+        message_type = self.bidirectional_msg_type if bidirectional else self.upload_msg_type
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+                self.set_tcp_receive_buffer(client_socket)
+                client_socket.connect((server_ip, tcp_port))
+                start_time = time.time()
+                client_socket.sendall(struct.pack(self.request_packet_format, self.MAGIC_COOKIE, message_type, self.file_size))
+                if not bidirectional:
+                    self.upload_engine.send(client_socket, self.file_size)
+                    return self.report_upload_result(transfer_id, "tcp", start_time, self.receive_tcp_upload_result(client_socket), server_ip)
+
+                # upload from another thread while this one receives the download, the upload's result follows the download
+                upload_thread = threading.Thread(target=self.upload_engine.send, args=(client_socket, self.file_size), daemon=True)
+                upload_thread.start()
+                buffer = bytearray(self.tcp_recv_buffer_size)
+                buffer_view = memoryview(buffer)
+                verifier = self.create_verifier()
+                sampler = ThroughputSampler(self.sample_interval)
+                sampler.start(start_time)
+                while sampler.total_bytes < self.file_size:
+                    num_bytes = client_socket.recv_into(buffer, min(len(buffer), self.file_size - sampler.total_bytes))  # blocking function, not busy-wait
+                    if num_bytes == 0:
+                        break  # connection closed
+                    if verifier is not None:
+                        verifier.check_stream(buffer_view[:num_bytes], sampler.total_bytes)
+                    sampler.add(num_bytes, time.time())
+                total_time = time.time() - start_time
+                upload_thread.join()
+                upload = self.report_upload_result(transfer_id, "tcp", start_time, self.receive_tcp_upload_result(client_socket), server_ip)
+                result = self.report_tcp_result(transfer_id, start_time, total_time, sampler, server_ip, verifier)
+                result.update(direction="bidirectional", upload=upload)
+                return result
+        except Exception as e:
+            self.print_transfer_line(f"TCP Transfer {transfer_id}: Error: {e}", "red")
+
+    def receive_tcp_upload_result(self, client_socket):
+        """Read the server's upload result message, returns (bytes received, unique segments, lost segments, receive time, jitter)"""
+        data = self.receive_exact(client_socket, self.upload_result_size)
+        magic_cookie, message_type, *upload_result = struct.unpack(self.upload_result_packet_format, data)
+        if magic_cookie != self.MAGIC_COOKIE or message_type != self.upload_result_msg_type:
+            raise InvalidRequestFormat("Invalid upload result from the server")
+        return upload_result
+
+    def run_udp_upload_test(self, transfer_id, server=None):
+        """
+        A UDP upload (client to server), or with direction == 'bidirectional' an upload and a download at the same time.
+        The server answers the request from a per-client socket, the segments are uploaded to it and it sends the
+        upload's result back once no more segments arrive.
+
+        Parameters:
+            transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+
+        Returns the upload's result as a dict (for a bidirectional transfer the download's result, with the upload's
+        result under 'upload'), None if the transfer failed
+        """
+        server_ip, _, udp_port = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        bidirectional = self.direction == "bidirectional"
+        message_type = self.bidirectional_msg_type if bidirectional else self.upload_msg_type
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+                client_socket.sendto(struct.pack(self.request_packet_format, self.MAGIC_COOKIE, message_type, self.file_size), (server_ip, udp_port))
+                start_time = time.time()
+                # the upload goes to the server's per-client socket, the source of the 'ready' message
+                ready_message = struct.pack(self.ready_packet_format, self.MAGIC_COOKIE, self.ready_msg_type)
+                client_socket.settimeout(1)
+                while True:
+                    packet, data_address = client_socket.recvfrom(65535)  # blocking function, not busy-wait
+                    if packet == ready_message:
+                        break
+                client_socket.settimeout(None)
+                client_socket.connect(data_address)
+
+                segment_size = self.udp_upload_segment_size
+                total_segments = (self.file_size + segment_size - 1) // segment_size
+                sender = UdpSegmentSender(client_socket, self.payload_packet_format, self.MAGIC_COOKIE, self.payload_msg_type,
+                                          segment_size, self.udp_receive_batch_size, self.udp_upload_rate,
+                                          payload_mode=self.payload_mode, payload_seed=self.payload_seed)
+                if not bidirectional:
+                    self.send_udp_upload(sender, total_segments)
+                    upload_result = self.receive_udp_upload_result(client_socket)
+                    return self.report_upload_result(transfer_id, "udp", start_time, upload_result, server_ip)
+
+                upload_answered = threading.Event()  # the upload's result arrived, the end-of-stream copies can stop
+                upload_thread = threading.Thread(target=self.send_udp_upload, args=(sender, total_segments, upload_answered), daemon=True)
+                upload_thread.start()
+                receiver = DatagramReceiver(client_socket, self.udp_receive_buffer_size, self.udp_receive_batch_size)
+                analyzer = UdpLossAnalyzer()
+                verifier = self.create_verifier()
+                upload_result = None
+                end_of_stream = False
+                while not end_of_stream:  # keep receiving the download until the end-of-stream marker, or no data for 1 second
+                    try:
+                        count = receiver.receive(timeout=1)  # blocking function, not busy-wait
+                    except ConnectionRefusedError:
+                        # a late end-of-stream copy reached the server's closed socket, the datagrams still wait to be read
+                        continue
+                    if count == 0:
+                        break
+                    for i in range(count):
+                        offset = i * receiver.message_size
+                        if receiver.lengths[i] == self.end_of_stream_size:
+                            if self.check_end_of_stream(receiver, i, analyzer):
+                                end_of_stream = True
+                            continue
+                        if receiver.lengths[i] == self.upload_result_size:
+                            magic_cookie, message_type, *result_fields = struct.unpack_from(self.upload_result_packet_format, receiver.buffers, offset)
+                            if magic_cookie == self.MAGIC_COOKIE and message_type == self.upload_result_msg_type:
+                                upload_result = result_fields
+                                upload_answered.set()
+                                continue
+                        if receiver.lengths[i] < self.payload_header_size:
+                            continue  # not a speed test segment
+                        magic_cookie, message_type, total_segment_count, current_segment_count = struct.unpack_from(
+                            self.payload_packet_format, receiver.buffers, offset)
+                        if magic_cookie == self.MAGIC_COOKIE and message_type == self.payload_msg_type:
+                            analyzer.add_segment(current_segment_count, total_segment_count, receiver.timestamps[i],
+                                                 receiver.lengths[i] - self.payload_header_size)
+                            if verifier is not None:
+                                self.verify_segment(verifier, receiver, i, current_segment_count)
+                total_time = (analyzer.last_arrival_time or start_time) - start_time  # the time until the last segment arrived
+                upload_thread.join()
+                if upload_result is None:
+                    upload_result = self.receive_udp_upload_result(client_socket)
+                upload = self.report_upload_result(transfer_id, "udp", start_time, upload_result, server_ip)
+                result = self.report_udp_result(transfer_id, start_time, total_time, analyzer, server_ip, verifier=verifier)
+                if result is not None:
+                    result.update(direction="bidirectional", upload=upload)
+                return result
+        except Exception as e:
+            self.print_transfer_line(f"UDP Transfer {transfer_id}: Error: {e}", "red")
+
+    def receive_udp_upload_result(self, client_socket, timeout=3):
+        """Wait for the server's upload result message, returns (bytes received, unique segments, lost segments, receive time, jitter)"""
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([client_socket], [], [], remaining)[0]:
+                raise TimeoutError("No upload result from the server")
             try:
-                while True:  # keep receiving until the socket has a 1-second timeout
-                    # 1024+21 makes sure that the speed test packets sent 1KB of data each, compensation for the header
-                    data, server_address = client_socket.recvfrom(1024+21)  # blocking function, not busy-wait
-                    # read the header which is the first 21 Bytes, can ignore the actual data sent
-                    magic_cookie, message_type, total_segment_count, current_segment_count = struct.unpack(self.payload_packet_format, data[:21])
-                    if magic_cookie == self.MAGIC_COOKIE and message_type == self.payload_msg_type:
-                        segments_reached += 1
-            except socket.timeout:
-                total_time = time.time() - start_time - 1  # -1 to compensate for the 1 sec timeout of the socket
-                prt = f"UDP transfer #{transfer_id} finished, total time: {round(total_time, 5)} seconds, total speed: {round(self.file_size/total_time*8, 3)} bits/second, percentage of packets received successfully: {round(segments_reached/total_segment_count*100, 2)}%”."
-                self.print_colored(prt, "blue", 23+len(str(transfer_id)))
+                packet = client_socket.recv(65535)
+            except ConnectionRefusedError:
+                # a late end-of-stream copy reached the server's closed socket, the result may still wait to be read
+                continue
+            if len(packet) != self.upload_result_size:
+                continue  # ex a late download segment
+            magic_cookie, message_type, *upload_result = struct.unpack(self.upload_result_packet_format, packet)
+            if magic_cookie == self.MAGIC_COOKIE and message_type == self.upload_result_msg_type:
+                return upload_result
+
+    def send_udp_upload(self, sender, total_segments, stop_event=None):
+        """
+        Send the upload's segments, then the end-of-stream marker so the server stops receiving right away.
+
+        Parameters:
+            sender: the upload's UdpSegmentSender
+            total_segments: number of segments to send
+            stop_event: set once the server's upload result arrived, the marker's later copies aren't sent. Optional
+        """
+        sender.send_segments(total_segments)
+        sender.send_end_of_stream(self.end_of_stream_packet_format, self.end_of_stream_msg_type, total_segments, stop_event=stop_event)
+
+    def check_end_of_stream(self, receiver, index, analyzer):
+        """Returns True if datagram 'index' of the receiver's batch is the end-of-stream marker, its total is passed to the analyzer"""
+        magic_cookie, message_type, segments_sent = struct.unpack_from(self.end_of_stream_packet_format, receiver.buffers,
+                                                                       index * receiver.message_size)
+        if magic_cookie != self.MAGIC_COOKIE or message_type != self.end_of_stream_msg_type:
+            return False
+        analyzer.end_stream(segments_sent)
+        return True
+
+    def get_timed_request(self):
+        """The request of a duration-based download, the server sends for the warm-up and the measured duration"""
+        return struct.pack(self.request_packet_format, self.MAGIC_COOKIE, self.timed_request_msg_type, round((self.warmup + self.duration) * 1000))
+
+    def check_timed_response(self, response):
+        """Validate the response header of a duration-based TCP download"""
+        magic_cookie, message_type, _ = struct.unpack(self.response_packet_format, response)
+        if magic_cookie != self.MAGIC_COOKIE or message_type != self.response_msg_type:
+            raise InvalidRequestFormat("Invalid response header from the server")
+
+    def get_measurement_window(self, warmup_end, end_time):
+        """
+        The (start, length) the rate of a duration-based download is measured over, after the warm-up. The warm-up
+        starts with the first received byte, not with the request, which may wait in the server's session queue
+        """
+        measure_start = min(warmup_end, end_time)
+        return measure_start, end_time - measure_start
+
+    def create_verifier(self):
+        """A PayloadVerifier for a single download, None if the downloads aren't verified"""
+        if not self.verify_payload:
+            return None
+        return PayloadVerifier(self.payload_mode, self.payload_seed)
+
+    def verify_segment(self, verifier, receiver, index, segment):
+        """Check the payload of datagram 'index' of the receiver's last batch"""
+        if receiver.is_truncated(index):
+            return  # a part of its payload wasn't read, it's only counted by its header
+        offset = index * receiver.message_size
+        verifier.check_segment(memoryview(receiver.buffers)[offset + self.payload_header_size:offset + receiver.lengths[index]], segment)
+
+    def set_tcp_receive_buffer(self, client_socket):
+        """Set the socket's receive buffer (SO_RCVBUF) if configured, must be called before connecting"""
+        if self.tcp_rcvbuf is not None:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.tcp_rcvbuf)
+
+    def report_tcp_result(self, transfer_id, start_time, total_time, sampler, server_ip=None, verifier=None):
+        """Build the result of a TCP transfer (and print it), returns it as a dict"""
+        report = sampler.get_report() or {}
+        file_size, bytes_received, speed = self.file_size, sampler.total_bytes, self.file_size / total_time * 8
+        timed = {}
+        if self.duration is not None:  # the rate of the bytes received after the warm-up, until the server closed the connection
+            file_size = sampler.total_bytes
+            start_time, total_time = self.get_measurement_window(sampler.warmup_end, sampler.last_byte_time or start_time + total_time)
+            bytes_received -= sampler.warmup_bytes
+            speed = bytes_received * 8 / total_time if total_time > 0 else 0
+            timed = {"duration": self.duration, "warmup": self.warmup, "warmup_bytes": sampler.warmup_bytes}
+        result = {"protocol": "tcp", "transfer_id": transfer_id, "server": server_ip or self.server_ip, "direction": "download", "file_size": file_size,
+                  "bytes_received": bytes_received, "start_time": start_time, "end_time": start_time + total_time,
+                  "total_time": total_time, "speed": speed, **timed, **report}
+        if verifier is not None:
+            result.update(verifier.get_report())
+        if not self.print_results:
+            return result
+        prt = f"TCP transfer #{transfer_id} finished, total time: {round(total_time, 5)} seconds, total speed: {round(speed, 3)} bits/second"
+        if self.duration is not None:
+            prt += f" (after a {self.warmup} seconds warm-up)"
+        lines = [self.format_colored(prt, "magenta", 23+len(str(transfer_id)))]
+        if len(report) != 0:
+            prt = (f"TCP transfer #{transfer_id} analysis: time to first byte: {round(report['time_to_first_byte']*1000, 3)} ms, "
+                   f"slow-start ramp: {round(report['ramp_time']*1000, 1)} ms, "
+                   f"steady-state speed: {round(report['steady_state_speed'], 3)} bits/second")
+            lines.append(self.format_colored(prt, "magenta", 23+len(str(transfer_id))))
+        if verifier is not None:
+            lines.append(self.format_verification(f"TCP transfer #{transfer_id}", verifier, "received blocks"))
+        self.print_transfer_lines(lines)
+        return result
+
+    def report_tcp_keepalive_result(self, transfer_id, start_time, total_time, connect_time, transfer_times, sampler, server_ip=None, verifier=None):
+        """Build the result of a kept-alive TCP connection's downloads (and print it), returns it as a dict"""
+        report = sampler.get_report() or {}
+        cold_time, warm_time = transfer_times[0], sum(transfer_times[1:])
+        result = {"protocol": "tcp", "transfer_id": transfer_id, "server": server_ip or self.server_ip, "direction": "download",
+                  "file_size": self.file_size, "bytes_received": sampler.total_bytes, "start_time": start_time,
+                  "end_time": start_time + total_time, "total_time": total_time, "speed": sampler.total_bytes / total_time * 8,
+                  "connect_time": connect_time, "keepalive_transfers": len(transfer_times), "transfer_times": transfer_times,
+                  "cold_speed": self.file_size / cold_time * 8,
+                  "warm_speed": self.file_size * (len(transfer_times) - 1) / warm_time * 8 if warm_time > 0 else 0, **report}
+        if verifier is not None:
+            result.update(verifier.get_report())
+        if not self.print_results:
+            return result
+        prt = (f"TCP transfer #{transfer_id} finished, {len(transfer_times)} transfers on one connection, total time: {round(total_time, 5)} seconds, "
+               f"cold connection: {round(result['cold_speed'], 3)} bits/second, warm connection: {round(result['warm_speed'], 3)} bits/second")
+        lines = [self.format_colored(prt, "magenta", 23+len(str(transfer_id)))]
+        prt = (f"TCP transfer #{transfer_id} analysis: connect time: {round(connect_time*1000, 3)} ms, "
+               f"first transfer: {round(cold_time, 5)} seconds, following transfers: {round(warm_time / (len(transfer_times) - 1), 5)} seconds on average")
+        lines.append(self.format_colored(prt, "magenta", 23+len(str(transfer_id))))
+        if verifier is not None:
+            lines.append(self.format_verification(f"TCP transfer #{transfer_id}", verifier, "received blocks"))
+        self.print_transfer_lines(lines)
+        return result
+
+    def report_latency_result(self, label, protocol, server_ip, sent, histogram, ipdv_total):
+        """Build the result of a latency test (and print it), returns it as a dict"""
+        received = histogram.count
+        result = {"record": "latency", "label": label, "protocol": protocol, "server": server_ip or self.server_ip,
+                  "probes_sent": sent, "probes_received": received, "loss_percent": (sent - received) / sent * 100 if sent else 0,
+                  "jitter_ms": ipdv_total / (received - 1) * 1000 if received > 1 else 0, **(histogram.get_report() or {})}
+        if not self.print_results:
+            return result
+        prt = f"{protocol.upper()} latency ({label}): {received}/{sent} probes answered"
+        if received != 0:
+            prt += (f", RTT min/p50/p90/p99/p99.9/max: " + "/".join(str(round(result[f"rtt_{name}_ms"], 3)) for name in ("min", "p50", "p90", "p99", "p99_9", "max")) +
+                    f" ms, jitter: {round(result['jitter_ms'], 3)} ms")
+        self.print_transfer_lines([self.format_colored(prt, "cyan", len(protocol) + len(label) + 12)])
+        return result
+
+    def report_udp_result(self, transfer_id, start_time, total_time, analyzer, server_ip=None, adaptive_result=None, verifier=None):
+        """Build the result of a UDP transfer (and print it), returns it as a dict, None if no data was received"""
+        report = analyzer.get_report()
+        if report is None:
+            self.print_transfer_line(f"UDP Transfer {transfer_id}: No data received over the connection", "red")
+            return None
+        received_percentage = report["unique_segments"] / report["total_segments"] * 100
+        file_size, speed = self.file_size, self.file_size / total_time * 8 if total_time > 0 else 0
+        timed = {}
+        if self.duration is not None:  # the rate of the unique segments that arrived after the warm-up
+            file_size = round(report["total_segments"] * analyzer.unique_bytes / analyzer.unique_segments)  # what the server sent
+            start_time, total_time = self.get_measurement_window(analyzer.warmup_end, start_time + total_time)
+            bytes_received = analyzer.unique_bytes - analyzer.warmup_bytes
+            speed = bytes_received * 8 / total_time if total_time > 0 else 0
+            timed = {"duration": self.duration, "warmup": self.warmup, "bytes_received": bytes_received, "warmup_bytes": analyzer.warmup_bytes}
+        result = {"protocol": "udp", "transfer_id": transfer_id, "server": server_ip or self.server_ip, "direction": "download", "file_size": file_size,
+                  "start_time": start_time, "end_time": start_time + total_time, "total_time": total_time,
+                  "speed": speed, "received_percentage": received_percentage, **timed, **report}
+        if adaptive_result is not None:  # (settled, rate, goodput, loss in ppm) sent by the server
+            result.update({"adaptive_settled": bool(adaptive_result[0]), "adaptive_rate": adaptive_result[1],
+                           "adaptive_goodput": adaptive_result[2], "adaptive_loss_percent": adaptive_result[3] / 10000})
+        if verifier is not None:
+            result.update(verifier.get_report())
+        if not self.print_results:
+            return result
+        prt = f"UDP transfer #{transfer_id} finished, total time: {round(total_time, 5)} seconds, total speed: {round(speed, 3)} bits/second, percentage of packets received successfully: {round(received_percentage, 2)}%”."
+        lines = [self.format_colored(prt, "blue", 23+len(str(transfer_id)))]
+        prt = (f"UDP transfer #{transfer_id} analysis: loss: {round(report['loss_percent'], 2)}% ({report['lost_segments']} segments), "
+               f"duplicates: {report['duplicates']}, reordered: {report['reordered']} (max depth {report['max_reorder_depth']}), "
+               f"loss bursts: {report['loss_bursts']} (longest {report['max_loss_burst']}, mean {round(report['mean_loss_burst'], 1)}), "
+               f"jitter: {round(report['jitter_ms'], 4)} ms")
+        lines.append(self.format_colored(prt, "blue", 23+len(str(transfer_id))))
+        if adaptive_result is not None:
+            prt = (f"UDP transfer #{transfer_id} adaptive rate: {'settled at' if result['adaptive_settled'] else 'ended at'} "
+                   f"{round(result['adaptive_rate'], 3)} bits/second, goodput: {round(result['adaptive_goodput'], 3)} bits/second, "
+                   f"loss: {round(result['adaptive_loss_percent'], 4)}%")
+            lines.append(self.format_colored(prt, "blue", 23+len(str(transfer_id))))
+        if verifier is not None:
+            lines.append(self.format_verification(f"UDP transfer #{transfer_id}", verifier, "segments"))
+        self.print_transfer_lines(lines)
+        return result
+
+    def format_verification(self, transfer_name, verifier, block_name):
+        """The colored line with the payload verification result of a transfer"""
+        if verifier.errors == 0:
+            return self.format_colored(f"{transfer_name} payload verified: {verifier.verified_bytes} bytes intact", "green", len(transfer_name))
+        return self.format_colored(f"{transfer_name} payload verification failed: {verifier.errors} corrupt {block_name} "
+                                   f"in {verifier.verified_bytes} bytes", "red")
+
+    def report_upload_result(self, transfer_id, protocol, start_time, upload_result, server_ip=None):
+        """Build the result of an upload from the server's measurements (and print it), returns it as a dict, None if no data was received"""
+        bytes_received, unique_segments, lost_segments, receive_time, jitter = upload_result
+        if bytes_received == 0:
+            self.print_transfer_line(f"{protocol.upper()} Transfer {transfer_id}: No upload data received by the server", "red")
+            return None
+        speed = bytes_received * 8 / receive_time if receive_time > 0 else 0
+        result = {"protocol": protocol, "transfer_id": transfer_id, "server": server_ip or self.server_ip, "direction": "upload",
+                  "file_size": self.file_size, "bytes_received": bytes_received, "start_time": start_time,
+                  "end_time": start_time + receive_time, "total_time": receive_time, "speed": speed}
+        if protocol == "udp":
+            total_segments = unique_segments + lost_segments
+            result.update(total_segments=total_segments, unique_segments=unique_segments, lost_segments=lost_segments,
+                          loss_percent=lost_segments / total_segments * 100, received_percentage=unique_segments / total_segments * 100,
+                          jitter_ms=jitter * 1000)
+        if not self.print_results:
+            return result
+        prt = f"{protocol.upper()} upload #{transfer_id} finished, server receive time: {round(receive_time, 5)} seconds, upload speed: {round(speed, 3)} bits/second"
+        if protocol == "udp":
+            prt += f", percentage of packets received by the server: {round(result['received_percentage'], 2)}%, jitter: {round(jitter * 1000, 4)} ms"
+        self.print_transfer_lines([self.format_colored(prt, "magenta" if protocol == "tcp" else "blue", 21+len(str(transfer_id)))])
+        return result
+
+    def print_transfer_line(self, msg, color, limit_index=-1):
+        self.print_transfer_lines([self.format_colored(msg, color, limit_index)])
+
+    def print_transfer_lines(self, lines):
+        """Print a transfer's (already colored) lines together, through the results collector if there is one"""
+        if self.results_collector is not None:
+            self.results_collector.publish_lines(lines)
+        else:
+            print("\n".join(lines))
+
+    def run_transfer(self, run_test, transfer_id, server):
+        """Run a single transfer with run_tcp_test/run_udp_test and publish its result to the results collector"""
+        result = run_test(transfer_id, server)
+        if self.results_collector is not None:
+            self.results_collector.publish_transfer(result)
+        return result
+
+    async def run_transfer_async(self, transfer):
+        """Await a single transfer coroutine and publish its result to the results collector"""
+        result = await transfer
+        if self.results_collector is not None:
+            self.results_collector.publish_transfer(result)
+        return result
+
+    def start_latency_tests(self):
+        """
+        Run the idle latency test, then start the latency test that runs during the round's transfers (under load).
+        Returns (stop event, thread) of the test under load, None if there's no such test
+        """
+        self.latency_results = []
+        if self.latency_probes <= 0:
+            return None
+        self.publish_latency_result(self.run_latency_test("idle", count=self.latency_probes))
+        if self.num_of_tcp_conn + self.num_of_udp_conn == 0:
+            return None
+        stop_event = threading.Event()
+        thread = threading.Thread(target=lambda: self.publish_latency_result(self.run_latency_test("under load", stop_event=stop_event)),
+                                  args=(), daemon=True)
+        thread.start()
+        return stop_event, thread
+
+    def finish_latency_tests(self, latency_test):
+        """Stop the latency test under load (the return value of start_latency_tests) once the transfers are done"""
+        if latency_test is not None:
+            stop_event, thread = latency_test
+            stop_event.set()
+            thread.join()
+
+    def publish_latency_result(self, result):
+        if result is None:
+            return
+        self.latency_results.append(result)
+        if self.results_collector is not None:
+            self.results_collector.publish_record(result)
+
+    def get_transfers(self):
+        """(protocol, transfer id, server) of each requested transfer, in the order they're started"""
+        transfers = [("udp", i + 1, self.get_transfer_server(i)) for i in range(self.num_of_udp_conn)]
+        transfers += [("tcp", i + 1, self.get_transfer_server(self.num_of_udp_conn + i)) for i in range(self.num_of_tcp_conn)]
+        return transfers
+
+    def run_transfers_in_threads(self):
+        """Start a thread for each requested connection, wait for all of them to finish and return their results"""
+        latency_test = self.start_latency_tests()
+        results = self.run_transfer_list_in_threads(self.get_transfers())
+        self.finish_latency_tests(latency_test)
+        return results
+
+    def run_transfer_list_in_threads(self, transfers):
+        """Run the given (protocol, transfer id, server) transfers on a thread each, returns the results of the successful ones"""
+        results = []
+        threads = []
+        for protocol, transfer_id, server in transfers:
+            run_test = self.run_udp_test if protocol == "udp" else self.run_tcp_test
+            thread = threading.Thread(target=lambda run_test, transfer_id, server: results.append(self.run_transfer(run_test, transfer_id, server)),
+                                      args=(run_test, transfer_id, server), daemon=True)
+            threads.append(thread)
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+        return [result for result in results if result is not None]
+
+    def run_transfers_in_processes(self, num_of_workers=None, start_delay=0.05):
+        """
+        Shard the requested connections over worker processes, so a single client can use all its cores to saturate a
+        fast link (a single Python process is capped by the GIL at a few Gbit/s). Each worker runs its share of the
+        transfers in threads, like run_transfers_in_threads, and all of them start at the same time: the workers wait
+        on a barrier and the last one to arrive sets the start time. The workers stream their results and output back
+        to this process, which publishes them like its own transfers'.
+        The workers aren't forked from this process, which runs other threads (the results writer, the test plan's
+        runs) that may hold a lock at the time of the fork. They're started from a clean process (forkserver, or spawn
+        where there's no forkserver) and build a client of their own from this client's options.
+
+        Parameters:
+            num_of_workers: number of worker processes, default is one per core (but never more than the transfers)
+            start_delay: seconds between the moment all the workers are ready and the start time, so they all see it in time
+
+        Returns the results of the successful transfers of all the workers
+        """
+        transfers = self.get_transfers()
+        num_of_workers = min(num_of_workers or os.cpu_count() or 1, len(transfers))
+        if num_of_workers <= 1:
+            return self.run_transfers_in_threads()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+        self.raise_open_files_limit(len(transfers))
+        results_queue = context.Queue()
+        start_time = context.Value("d", 0.0)
+        # the action runs in the last process to reach the barrier, before any of them is released
+        barrier = context.Barrier(num_of_workers + 1, action=functools.partial(set_barrier_start_time, start_time, start_delay))
+        # the workers only run the transfers, the latency tests stay in this process
+        worker_options = dict(self.options, file_size=self.file_size, num_of_tcp_conn=0, num_of_udp_conn=0, latency_probes=0)
+        server = (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        workers = []
+        for worker_id in range(num_of_workers):
+            # round-robin, so the UDP and TCP transfers (and the servers) are spread evenly over the workers
+            worker = context.Process(target=run_client_worker, args=(worker_options, server, worker_id, transfers[worker_id::num_of_workers],
+                                                                     barrier, start_time, results_queue),
+                                     daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        latency_test = self.start_latency_tests()  # the idle test runs while the workers are getting ready
+        try:
+            barrier.wait(timeout=10)
+        except threading.BrokenBarrierError:
+            self.finish_latency_tests(latency_test)
+            self.print_colored("The worker processes didn't start in time", "red")
+            for worker in workers:
+                worker.terminate()
+            return []
+        results = self.receive_worker_results(results_queue, workers)
+        self.finish_latency_tests(latency_test)
+        for worker in workers:
+            worker.join()
+        return results
+
+    def run_worker(self, worker_id, transfers, barrier, start_time, results_queue):
+        """The main code of a worker process, runs its share of the transfers from the shared start time"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl C is handled by the parent process
+        self.results_collector = ResultsQueueForwarder(results_queue, worker_id)  # publish everything to the parent
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:  # the parent gave up waiting for the workers
+            return
+        delay = start_time.value - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        results_queue.put(("started", worker_id, time.time()))
+        self.run_transfer_list_in_threads(transfers)
+        results_queue.put(("done", worker_id, None))
+
+    def receive_worker_results(self, results_queue, workers):
+        """Publish what the workers send until all of them are done (or died), returns the results of their transfers"""
+        results = []
+        start_times = []
+        running_workers = set(range(len(workers)))
+        while len(running_workers) > 0:
+            try:
+                kind, worker_id, payload = results_queue.get(timeout=1)  # blocking function, not busy-wait
+            except queue.Empty:
+                for worker_id in list(running_workers):
+                    if not workers[worker_id].is_alive():  # its transfers that didn't report are counted as failed
+                        self.print_colored(f"Worker process {worker_id} exited with code {workers[worker_id].exitcode}", "red")
+                        running_workers.discard(worker_id)
+                continue
+            if kind == "transfer":
+                result, lines = payload
+                if result is not None:
+                    results.append(result)
+                if self.results_collector is not None:
+                    self.results_collector.publish_transfer(result, lines)
+            elif kind == "lines":
+                self.print_transfer_lines(payload)
+            elif kind == "record":
+                record, lines = payload
+                if self.results_collector is not None:
+                    self.results_collector.publish_record(record, lines)
+            elif kind == "started":
+                start_times.append(payload)
+            elif kind == "done":
+                running_workers.discard(worker_id)
+        if self.print_results and len(start_times) != 0:
+            self.print_transfer_line(f"{len(workers)} worker processes started within {round((max(start_times) - min(start_times)) * 1000, 3)} ms "
+                                     f"of each other, {len(results)} transfers completed", "blue")
+        return results
+
+    def run_transfers_async(self):
+        """
+        Runs all the requested UDP and TCP transfers concurrently on a single asyncio event loop,
+        instead of a thread per connection. Uses the same packet formats and prints the same results
+        """
+        self.raise_open_files_limit(self.num_of_tcp_conn + self.num_of_udp_conn)
+        latency_test = self.start_latency_tests()  # the latency test runs on a thread of its own, next to the loop
+        results = asyncio.run(self.gather_transfers_async())
+        self.finish_latency_tests(latency_test)
+        return [result for result in results if result is not None]
+
+    async def gather_transfers_async(self):
+        # the received data isn't used, so all the transfers on the loop (which run one at a time) can share a receive buffer
+        self.async_tcp_buffer = bytearray(self.tcp_recv_buffer_size)
+        transfers = [self.run_udp_test_async(i + 1, self.get_transfer_server(i)) for i in range(self.num_of_udp_conn)]
+        transfers += [self.run_tcp_test_async(i + 1, self.get_transfer_server(self.num_of_udp_conn + i)) for i in range(self.num_of_tcp_conn)]
+        # the transfers that run on threads (uploads) get a pool with a thread for each of them, so they all run at the
+        # same time. The loop's default pool has cpu_count + 4 threads, the rest would wait for a free one. The pool
+        # only starts threads when they're needed
+        with ThreadPoolExecutor(max_workers=max(1, len(transfers))) as self.async_executor:
+            return await asyncio.gather(*[self.run_transfer_async(transfer) for transfer in transfers])
+
+    async def run_tcp_test_async(self, transfer_id, server=None):
+        """
+        The asyncio version of run_tcp_test, a single TCP transfer running as a coroutine.
+
+        Parameters:
+            transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+        """
+        if self.direction != "download":  # uploads run on a thread of the engine's pool, next to the loop
+            return await asyncio.get_running_loop().run_in_executor(self.async_executor, self.run_tcp_upload_test, transfer_id, server)
+        if self.keepalive_transfers > 1:  # like the uploads, kept-alive connections run on a thread of the engine's pool
+            return await asyncio.get_running_loop().run_in_executor(self.async_executor, self.run_tcp_keepalive_test, transfer_id, server)
+        server_ip, tcp_port, _ = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        try:
+            loop = asyncio.get_running_loop()
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.setblocking(False)
+            self.set_tcp_receive_buffer(client_socket)
+            try:
+                await loop.sock_connect(client_socket, (server_ip, tcp_port))
+            except Exception:
+                client_socket.close()
+                raise
+            sampler = ThroughputSampler(self.sample_interval)
+            verifier = self.create_verifier()
+            # a duration-based download starts with a response header, which isn't a part of the payload
+            header_size = self.response_size if self.duration is not None else 0
+            transport, protocol = await loop.create_connection(
+                lambda: TcpSpeedTestProtocol(self.async_tcp_buffer, sampler, verifier, header_size), sock=client_socket)
+            try:
+                start_time = time.time()
+                if self.duration is None:
+                    # Send the file size to get from the server
+                    sampler.start(start_time)
+                    transport.write(f"{self.file_size}\n".encode('utf-8'))
+                else:
+                    sampler.start(start_time, self.warmup)
+                    transport.write(self.get_timed_request())
+
+                # Receive the response, the protocol reads the data straight into a buffer shared by all the transfers
+                await protocol.done
+                if header_size != 0:
+                    self.check_timed_response(bytes(protocol.header))
+                total_time = time.time() - start_time  # measure the time it took for the whole file size
+                return self.report_tcp_result(transfer_id, start_time, total_time, sampler, server_ip, verifier)
+            finally:
+                transport.close()
         except Exception as e:
-            if e.__str__() == "cannot access local variable 'total_segment_count' where it is not associated with a value":
-                self.print_colored(f"UDP Transfer {transfer_id}: No data received over the connection")
+            self.print_transfer_line(f"TCP Transfer {transfer_id}: Error: {e}", "red")
+
+    async def run_udp_test_async(self, transfer_id, server=None):
+        """
+        The asyncio version of run_udp_test, a single UDP transfer running as a coroutine.
+
+        Parameters:
+            transfer_id: An identifier for the client connection
+            server: (ip, tcp_port, udp_port) to run the transfer against. Optional, default is the chosen server
+        """
+        if self.direction != "download":  # uploads run on a thread of the engine's pool, next to the loop
+            return await asyncio.get_running_loop().run_in_executor(self.async_executor, self.run_udp_upload_test, transfer_id, server)
+        server_ip, _, udp_port = server or (self.server_ip, self.tcp_request_port, self.udp_request_port)
+        transport = None
+        try:
+            loop = asyncio.get_running_loop()
+            if self.udp_adaptive:
+                request_message = struct.pack(self.adaptive_request_packet_format, self.MAGIC_COOKIE, self.adaptive_request_msg_type,
+                                              self.file_size, round(self.udp_loss_threshold * 100))
+            elif self.duration is not None:
+                request_message = self.get_timed_request()
             else:
-                self.print_colored(f"UDP Transfer {transfer_id}: Error: {e}", "red")
+                request_message = struct.pack(self.request_packet_format, self.MAGIC_COOKIE, self.request_msg_type, self.file_size)
+            transport, protocol = await loop.create_datagram_endpoint(
+                lambda: UdpSpeedTestProtocol(self.MAGIC_COOKIE, self.payload_msg_type, self.payload_packet_format,
+                                             self.adaptive_result_msg_type, self.adaptive_result_packet_format, self.create_verifier(),
+                                             self.end_of_stream_msg_type, self.end_of_stream_packet_format),
+                family=socket.AF_INET)
+            transport.sendto(request_message, (server_ip, udp_port))
+
+            start_time = time.time()
+            if self.duration is not None:
+                protocol.analyzer.warmup = self.warmup
+            # stop receiving once the end-of-stream marker (or the adaptive result) arrived, or no data arrived for 1 second
+            while protocol.adaptive_result is None and not protocol.ended.done():
+                idle_time = time.time() - (protocol.analyzer.last_arrival_time or start_time)
+                if idle_time >= 1:
+                    break
+                if not self.udp_adaptive:
+                    await asyncio.wait([protocol.ended], timeout=1 - idle_time)
+                    continue
+                if protocol.server_address is not None and protocol.analyzer.unique_segments != 0:
+                    # the feedback goes to the server's per-client socket, the source of the segments
+                    transport.sendto(struct.pack(self.feedback_packet_format, self.MAGIC_COOKIE, self.feedback_msg_type,
+                                                 protocol.analyzer.unique_segments, protocol.analyzer.highest_segment),
+                                     protocol.server_address)
+                await asyncio.sleep(min(self.feedback_interval, 1 - idle_time))
+
+            analyzer = protocol.analyzer
+            total_time = (analyzer.last_arrival_time or start_time) - start_time  # the time until the last segment arrived
+            return self.report_udp_result(transfer_id, start_time, total_time, analyzer, server_ip, protocol.adaptive_result, protocol.verifier)
+        except Exception as e:
+            self.print_transfer_line(f"UDP Transfer {transfer_id}: Error: {e}", "red")
+        finally:
+            if transport is not None:
+                transport.close()
+
+    @staticmethod
+    def raise_open_files_limit(num_of_sockets):
+        """Thousands of concurrent transfers need a socket each, raise the open files soft limit if it's too low"""
+        try:
+            import resource  # not available on Windows
+            soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+            needed = num_of_sockets + 64  # leave some room for the rest of the process
+            if soft_limit != resource.RLIM_INFINITY and soft_limit < needed:
+                if hard_limit != resource.RLIM_INFINITY:
+                    needed = min(needed, hard_limit)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard_limit))
+        except (ImportError, ValueError, OSError):
+            pass
 
     @staticmethod
     def print_colored(msg, color, limit_index=-1):
@@ -175,6 +1235,11 @@ class ClientMethods:
             color: the color the use, passed as a color 'name'
             limit_index: limit the number of chars to color from the start of the message. Optional
         """
+        print(ClientMethods.format_colored(msg, color, limit_index))
+
+    @staticmethod
+    def format_colored(msg, color, limit_index=-1):
+        """The message (or part of it) wrapped in the color's escape codes, see print_colored"""
         try:
             colors_dict = {
                 "green": "\u001b[32m",
@@ -186,9 +1251,98 @@ class ClientMethods:
             if color not in colors_dict.keys():
                 raise UnsupportedColor()
             if limit_index == -1:
-                print(f"{colors_dict[color]}{msg}\u001b[0m")
-            else:
-                print(f"{colors_dict[color]}{msg[:limit_index]}\u001b[0m{msg[limit_index:]}")
+                return f"{colors_dict[color]}{msg}\u001b[0m"
+            return f"{colors_dict[color]}{msg[:limit_index]}\u001b[0m{msg[limit_index:]}"
         except UnsupportedColor:
-            print(msg)
+            return str(msg)
+
+
+
+def run_client_worker(client_options, server, worker_id, transfers, barrier, start_time, results_queue):
+    """The entry point of a worker process of ClientMethods.run_transfers_in_processes, runs its transfers on a client of its own"""
+    client = ClientMethods(**client_options)
+    client.server_ip, client.tcp_request_port, client.udp_request_port = server
+    client.run_worker(worker_id, transfers, barrier, start_time, results_queue)
+
+
+def set_barrier_start_time(start_time, start_delay):
+    """The action of the workers' barrier, the start time is shared with all of them"""
+    start_time.value = time.time() + start_delay
+
 
+class TcpSpeedTestProtocol(asyncio.BufferedProtocol):
+    """Receives the data of a single TCP transfer for ClientMethods.run_tcp_test_async straight into a given buffer"""
+    def __init__(self, buffer, sampler, verifier=None, header_size=0):
+        self.buffer = buffer
+        self.buffer_view = memoryview(buffer)
+        self.sampler = sampler
+        self.verifier = verifier  # a PayloadVerifier, optional
+        self.header_size = header_size  # the size of the response header before the payload, 0 if there's none
+        self.header = bytearray()
+        self.done = asyncio.get_running_loop().create_future()
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        data = self.buffer_view[:nbytes]
+        if len(self.header) < self.header_size:  # the header may arrive in more than one read, or with the payload
+            header_part = data[:self.header_size - len(self.header)]
+            self.header += header_part
+            data = data[len(header_part):]
+            if len(data) == 0:
+                return
+        if self.verifier is not None:  # the buffer is shared, the data must be checked before the next transfer's read
+            self.verifier.check_stream(data, self.sampler.total_bytes)
+        self.sampler.add(len(data), time.time())
+
+    def eof_received(self):
+        if not self.done.done():
+            self.done.set_result(None)
+        return False  # close the transport
+
+    def connection_lost(self, exc):
+        if not self.done.done():
+            if exc is None:
+                self.done.set_result(None)
+            else:
+                self.done.set_exception(exc)
+
+
+class UdpSpeedTestProtocol(asyncio.DatagramProtocol):
+    """Receives the payload segments (the adaptive-rate result and the end-of-stream marker) of a single UDP transfer for ClientMethods.run_udp_test_async"""
+    def __init__(self, magic_cookie, payload_msg_type, payload_packet_format, adaptive_result_msg_type=None, adaptive_result_packet_format=None,
+                 verifier=None, end_of_stream_msg_type=None, end_of_stream_packet_format=None):
+        self.MAGIC_COOKIE = magic_cookie
+        self.payload_msg_type = payload_msg_type
+        self.payload_packet_format = payload_packet_format
+        self.adaptive_result_msg_type = adaptive_result_msg_type
+        self.adaptive_result_packet_format = adaptive_result_packet_format
+        self.analyzer = UdpLossAnalyzer()
+        self.header_size = struct.calcsize(payload_packet_format)
+        self.verifier = verifier  # a PayloadVerifier, optional
+        self.server_address = None  # the server's per-client socket, the segments' source
+        self.adaptive_result = None  # (settled, rate, goodput, loss in ppm)
+        self.end_of_stream_msg_type = end_of_stream_msg_type
+        self.end_of_stream_packet_format = end_of_stream_packet_format
+        self.ended = asyncio.get_running_loop().create_future()  # done once the end-of-stream marker arrived
+
+    def datagram_received(self, data, addr):
+        try:
+            magic_cookie, message_type = struct.unpack_from('>IB', data)
+            if magic_cookie != self.MAGIC_COOKIE:
+                return
+            if message_type == self.payload_msg_type:
+                # read the header which is the first 21 Bytes, the data is only read when it's verified
+                _, _, total_segment_count, current_segment_count = struct.unpack_from(self.payload_packet_format, data)
+                self.analyzer.add_segment(current_segment_count, total_segment_count, time.time(), len(data) - self.header_size)
+                if self.verifier is not None:
+                    self.verifier.check_segment(memoryview(data)[self.header_size:], current_segment_count)
+                self.server_address = addr
+            elif message_type == self.adaptive_result_msg_type:
+                self.adaptive_result = struct.unpack(self.adaptive_result_packet_format, data)[2:]
+            elif message_type == self.end_of_stream_msg_type and not self.ended.done():
+                self.analyzer.end_stream(struct.unpack(self.end_of_stream_packet_format, data)[2])
+                self.ended.set_result(None)
+        except struct.error:
+            return  # not a speed test segment
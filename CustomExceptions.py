@@ -15,4 +15,9 @@ class InvalidRequestFormat(Exception):
 
 class InvalidOfferFormat(Exception):
     def __init__(self, err_msg="The offer packet format is invalid"):
-        super().__init__(err_msg)
\ No newline at end of file
+        super().__init__(err_msg)
+
+
+class InvalidTestPlan(Exception):
+    def __init__(self, err_msg="The test plan format is invalid"):
+        super().__init__(err_msg)
@@ -0,0 +1,159 @@
+import socket
+import struct
+import platform
+import subprocess
+import re
+import time
+
+# Linux ioctl requests and interface flags, from <linux/sockios.h> and <net/if.h>
+SIOCGIFFLAGS = 0x8913
+SIOCGIFBRDADDR = 0x8919
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+# netlink groups for link and IPv4 address changes, from <linux/rtnetlink.h>
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+
+class BroadcastAddressCache:
+    """
+    Finds the broadcast address of every active IPv4 interface and caches them. On Linux the interfaces are read with
+    ioctl() calls (no subprocesses) and a netlink socket tells when they change, so the cache is refreshed only then.
+    On other systems (or if the ioctls fail) the ifconfig/ipconfig output is parsed, and the cache expires after 'ttl'.
+    """
+    def __init__(self, ttl=30):
+        """
+        Parameters:
+            ttl: seconds until the cached addresses are refreshed, when changes can't be detected with netlink
+        """
+        self.ttl = ttl
+        self.addresses = None  # list of (interface name, broadcast address)
+        self.refresh_time = 0
+        self.netlink_socket = self.open_netlink_socket()
+
+    @staticmethod
+    def open_netlink_socket():
+        """A non-blocking netlink socket that receives a message whenever a link or an IPv4 address changes"""
+        if not hasattr(socket, "AF_NETLINK"):
+            return None
+        try:
+            netlink_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            netlink_socket.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+            netlink_socket.setblocking(False)
+            return netlink_socket
+        except OSError:
+            return None
+
+    def interfaces_changed(self):
+        """Drain the netlink socket, returns True if any change was reported since the last call"""
+        changed = False
+        while True:
+            try:
+                if not self.netlink_socket.recv(65536):
+                    return changed
+                changed = True
+            except BlockingIOError:
+                return changed
+            except OSError:
+                return True  # ex the socket's buffer overflowed, can't know what changed
+
+    def get(self):
+        """The cached (interface name, broadcast address) list, refreshed if the interfaces changed"""
+        if self.addresses is None:
+            self.refresh()
+        elif self.netlink_socket is not None:
+            if self.interfaces_changed():
+                self.refresh()
+        elif time.time() - self.refresh_time > self.ttl:
+            self.refresh()
+        return self.addresses
+
+    def invalidate(self):
+        """Force a refresh on the next get(), ex after sending to an address failed"""
+        self.addresses = None
+
+    def refresh(self):
+        addresses = []
+        if platform.system() == "Linux":
+            try:
+                addresses = self.get_linux_broadcast_addresses()
+            except OSError:
+                addresses = []
+        if len(addresses) == 0:
+            addresses = self.get_broadcast_addresses_from_command()
+        if len(addresses) == 0:
+            raise RuntimeError("Broadcast address not found in network configuration.")
+        self.addresses = addresses
+        self.refresh_time = time.time()
+
+    @staticmethod
+    def get_linux_broadcast_addresses():
+        """The broadcast address of each interface that is up, isn't the loopback and supports broadcast, using ioctl()"""
+        import fcntl  # not available on Windows
+        addresses = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as ioctl_socket:
+            for index, name in socket.if_nameindex():
+                request = struct.pack("256s", name.encode()[:15])
+                try:
+                    flags = struct.unpack_from("H", fcntl.ioctl(ioctl_socket.fileno(), SIOCGIFFLAGS, request), 16)[0]
+                    if not flags & IFF_UP or not flags & IFF_BROADCAST or flags & IFF_LOOPBACK:
+                        continue
+                    # the ifreq's sockaddr_in starts at byte 16, its IPv4 address at byte 20
+                    broadcast = fcntl.ioctl(ioctl_socket.fileno(), SIOCGIFBRDADDR, request)[20:24]
+                except OSError:
+                    continue  # ex the interface has no IPv4 address
+                addresses.append((name, socket.inet_ntoa(broadcast)))
+        return addresses
+
+    @staticmethod
+    def get_broadcast_addresses_from_command():
+        """Fallback: parse the broadcast addresses from ifconfig (macOS/Linux) or ipconfig (Windows)"""
+        try:
+            if platform.system() in ["Linux", "Darwin"]:  # macOS and Linux
+                # Run ifconfig to get network details
+                result = subprocess.run(['ifconfig'], capture_output=True, text=True)
+                return BroadcastAddressCache.parse_ifconfig(result.stdout)
+            elif platform.system() == "Windows":
+                # Run ipconfig to get network details
+                result = subprocess.run(['ipconfig'], capture_output=True, text=True, encoding='oem')
+                return BroadcastAddressCache.parse_ipconfig(result.stdout)
+        except Exception:
+            pass
+        return []
+
+    @staticmethod
+    def parse_ifconfig(output):
+        """The broadcast address of every interface in the ifconfig output"""
+        addresses = []
+        name = ""
+        for row in output.split("\n"):
+            name_match = re.match(r'^(\S+?):? ', row)  # interface blocks start without indentation
+            if name_match:
+                name = name_match.group(1)
+            for broadcast in re.findall(r'(?:broadcast|Bcast:)\s?(\d+\.\d+\.\d+\.\d+)', row):
+                addresses.append((name, broadcast))
+        return addresses
+
+    @staticmethod
+    def parse_ipconfig(output):
+        """Calculate the broadcast address of every adapter in the ipconfig output from its IPv4 address and subnet mask"""
+        addresses = []
+        adapter = ""
+        ipv4_address = ""
+        for row in output.split("\n"):
+            if "adapter" in row:
+                adapter = row.strip().rstrip(":")
+                ipv4_address = ""
+            # Use regex to extract IPv4 and subnet mask
+            ipv4_match = re.findall(r'IPv4 Address.*: (\d+\.\d+\.\d+\.\d+)', row)
+            subnet_match = re.findall(r'Subnet Mask.*: (\d+\.\d+\.\d+\.\d+)', row)
+            if len(ipv4_match) != 0:
+                ipv4_address = ipv4_match[0]
+            if len(subnet_match) != 0 and ipv4_address != "":
+                # Calculate the broadcast address
+                ipv4_parts = list(map(int, ipv4_address.split('.')))
+                subnet_parts = list(map(int, subnet_match[0].split('.')))
+                broadcast_parts = [(ipv4_parts[i] | ~subnet_parts[i] & 0xFF) for i in range(4)]
+                addresses.append((adapter, '.'.join(map(str, broadcast_parts))))
+        return addresses
@@ -0,0 +1,513 @@
+import os
+import errno
+import struct
+import time
+import tempfile
+import select
+import socket
+import random
+import functools
+from SocketBatching import SENDMMSG_AVAILABLE, SendmmsgBatch
+from ServerMetrics import MetricsRegistry
+
+TCP_LABELS = (("protocol", "tcp"),)
+UDP_LABELS = (("protocol", "udp"),)
+
+# errors that mean os.sendfile() can't be used with this socket/file pair, so the engine should fall back to sendall()
+SENDFILE_UNSUPPORTED_ERRORS = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.EBADF}
+
+# 'random' can't be compressed by middleboxes (WAN optimizers, compressed VPNs), the other modes are kept for comparison
+PAYLOAD_MODES = ("random", "fill", "zeros")
+DEFAULT_PAYLOAD_SEED = 0x5EED
+PAYLOAD_RING_SIZE = 1048576
+
+
+@functools.lru_cache(maxsize=None)
+def get_payload_ring(mode="random", ring_size=PAYLOAD_RING_SIZE, seed=DEFAULT_PAYLOAD_SEED):
+    """
+    The payload of every transfer is the same endless stream, byte i of a transfer is byte i % ring_size of the ring.
+    The ring is generated once per process and stored twice in a row, so a slice of up to ring_size bytes from any
+    offset is contiguous and can be sent (or compared) without copying. Callers must not modify it.
+
+    Parameters:
+        mode: 'random' (seeded pseudo-random bytes), 'fill' (the letter x) or 'zeros'
+        ring_size: the length of the stream's period
+        seed: the seed of the 'random' mode, the sender and the verifier must use the same one
+    """
+    if mode == "random":
+        ring = random.Random(seed).randbytes(ring_size)
+    elif mode == "fill":
+        ring = b'x' * ring_size
+    elif mode == "zeros":
+        ring = bytes(ring_size)
+    else:
+        raise ValueError(f"Unknown payload mode {mode!r}, expected one of {PAYLOAD_MODES}")
+    return bytearray(ring * 2)  # a bytearray, so iovecs can point into it (SendmmsgBatch)
+
+
+class PayloadVerifier:
+    """
+    Checks received data against the payload stream of the same mode and seed. Each received block is compared to the
+    ring with a single memcmp (bytearray.startswith at an offset, no copies), so verifying runs at memory speed and
+    doesn't lower the measured throughput.
+    """
+    def __init__(self, mode="random", seed=DEFAULT_PAYLOAD_SEED, ring_size=PAYLOAD_RING_SIZE):
+        self.ring = get_payload_ring(mode, ring_size, seed)
+        self.ring_size = ring_size
+        self.verified_bytes = 0
+        self.errors = 0  # received blocks (or segments) that didn't match the payload
+
+    def check_stream(self, data, position):
+        """
+        Check a block of a TCP stream.
+
+        Parameters:
+            data: memoryview of the received bytes
+            position: the position of the block's first byte in the stream (the bytes received before it)
+        """
+        while len(data) > 0:
+            count = min(len(data), self.ring_size)
+            if not self.ring.startswith(data[:count], position % self.ring_size):
+                self.errors += 1
+            self.verified_bytes += count
+            position += count
+            data = data[count:]
+
+    def check_segment(self, data, segment):
+        """
+        Check the payload of a UDP segment, segment i carries the stream from byte i * segment size.
+
+        Parameters:
+            data: memoryview of the segment's payload (without the header)
+            segment: the segment's number
+        """
+        if not self.ring.startswith(data, segment * len(data) % self.ring_size):
+            self.errors += 1
+        self.verified_bytes += len(data)
+
+    def get_report(self):
+        return {"payload_verified": self.errors == 0, "payload_verified_bytes": self.verified_bytes, "payload_errors": self.errors}
+
+
+class PayloadEngine:
+    """
+    Builds the speed-test payload once and shares it between all the TCP connections of the server.
+    Where the OS supports it, the payload is written once to an in-memory (memfd / tmpfs) file and sent with
+    os.sendfile(), so the data never passes through Python. Otherwise it's sent with sendall() over memoryview
+    slices of the shared payload, so no new bytes objects are allocated per chunk.
+    """
+    def __init__(self, chunk_size=PAYLOAD_RING_SIZE, use_sendfile=True, metrics=None, mode="random", seed=DEFAULT_PAYLOAD_SEED):
+        """
+        Parameters:
+            chunk_size: the max bytes sent per call, and the period of the payload stream
+            use_sendfile: send from an in-memory file with os.sendfile() where the OS supports it
+            metrics: MetricsRegistry to count the bytes sent and the CPU time in, optional
+            mode: the payload mode, see get_payload_ring
+            seed: the seed of the 'random' mode
+        """
+        self.chunk_size = chunk_size
+        self.payload = get_payload_ring(mode, chunk_size, seed)  # generated once, shared by all connections
+        self.payload_view = memoryview(self.payload)
+        self.payload_fd = self.create_payload_file(self.payload) if use_sendfile else None
+        self.metrics = metrics if metrics is not None else MetricsRegistry()  # bytes actually sent and CPU time spent
+
+    @staticmethod
+    def create_payload_file(payload):
+        """Write the payload to an in-memory file and return its fd, or None if sendfile can't be used on this OS"""
+        if not hasattr(os, "sendfile"):
+            return None  # Windows
+        try:
+            if hasattr(os, "memfd_create"):  # Linux, anonymous file that lives in RAM
+                fd = os.memfd_create("speedtest-payload")
+            elif os.path.isdir("/dev/shm"):  # tmpfs backed file
+                fd, path = tempfile.mkstemp(dir="/dev/shm")
+                os.unlink(path)
+            else:
+                return None
+            view = memoryview(payload)
+            while len(view) > 0:
+                view = view[os.write(fd, view):]
+            return fd
+        except OSError:
+            return None
+
+    @property
+    def send_method(self):
+        return "sendfile" if self.payload_fd is not None else "sendall"
+
+    def send(self, sock, size, deadline=None):
+        """
+        Sends 'size' bytes of payload over a connected TCP socket.
+
+        Parameters:
+            sock: the connected socket to send the payload on
+            size: number of bytes to send
+            deadline: stop once time.time() passes it, even if less than 'size' bytes were sent (a duration-based test). Optional
+
+        Returns the number of bytes sent, the metrics are updated as the data is sent
+        """
+        total_sent = 0
+        cpu_start = time.thread_time()
+        # sendfile doesn't play well with socket timeouts (non-blocking sockets), use sendall for those
+        use_sendfile = self.payload_fd is not None and sock.gettimeout() is None
+        try:
+            while total_sent < size and (deadline is None or time.time() < deadline):
+                offset = total_sent % self.chunk_size
+                count = min(self.chunk_size, size - total_sent)  # the ring is stored twice, no need to stop at its end
+                if use_sendfile:
+                    try:
+                        sent = os.sendfile(sock.fileno(), self.payload_fd, offset, count)
+                        total_sent += sent
+                        self.metrics.inc("speedtest_bytes_sent_total", sent, TCP_LABELS)
+                        continue
+                    except OSError as e:
+                        if e.errno not in SENDFILE_UNSUPPORTED_ERRORS:
+                            raise
+                        use_sendfile = False  # not supported for this socket, continue with sendall
+                sock.sendall(self.payload_view[offset:offset + count])
+                total_sent += count
+                self.metrics.inc("speedtest_bytes_sent_total", count, TCP_LABELS)
+            return total_sent
+        finally:
+            self.metrics.inc("speedtest_payload_cpu_seconds_total", time.thread_time() - cpu_start)
+
+    def send_some(self, sock, total_sent, size):
+        """
+        Sends the next part of the payload over a non-blocking TCP socket, used by the event-driven server.
+
+        Parameters:
+            sock: the connected non-blocking socket to send the payload on
+            total_sent: number of bytes already sent on this connection (the position in the payload)
+            size: the overall number of bytes to send on this connection
+
+        Returns the number of bytes the socket accepted, 0 if its send buffer is full
+        """
+        offset = total_sent % self.chunk_size
+        count = min(self.chunk_size, size - total_sent)
+        cpu_start = time.thread_time()
+        sent = 0
+        try:
+            if self.payload_fd is not None:
+                try:
+                    sent = os.sendfile(sock.fileno(), self.payload_fd, offset, count)
+                    return sent
+                except OSError as e:
+                    if e.errno not in SENDFILE_UNSUPPORTED_ERRORS:
+                        raise
+            sent = sock.send(self.payload_view[offset:offset + count])
+            return sent
+        except BlockingIOError:
+            return 0  # the socket's send buffer is full, wait for the next write event
+        finally:
+            self.metrics.inc("speedtest_bytes_sent_total", sent, TCP_LABELS)
+            self.metrics.inc("speedtest_payload_cpu_seconds_total", time.thread_time() - cpu_start)
+
+    def close(self):
+        if self.payload_fd is not None:
+            os.close(self.payload_fd)
+            self.payload_fd = None
+
+
+class TokenBucket:
+    """Paces a sender to a target rate, the sender has to consume tokens (bytes) before sending them"""
+    def __init__(self, rate, burst):
+        """
+        Parameters:
+            rate: the target rate in bytes/second
+            burst: the max number of bytes that can be sent back to back
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.perf_counter()
+
+    def set_rate(self, rate):
+        self.refill()
+        self.rate = rate
+
+    def refill(self):
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def consume(self, amount):
+        """Block until 'amount' bytes can be sent without going over the target rate"""
+        self.refill()
+        if self.tokens < amount:
+            time.sleep((amount - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= amount
+
+
+class AdaptiveRateController:
+    """
+    Finds the highest UDP send rate the path carries with a loss under a threshold, from the client's feedback
+    (its unique segments received and highest segment so far). The rate is held for a step, doubled while the step's loss
+    is acceptable, and after the first lossy step binary searched between the last good and the first bad rate.
+    Once they are within 'precision' of each other the sender settles on the good rate for the rest of the transfer,
+    and the goodput and loss measured at that rate are the test's result.
+    """
+    def __init__(self, udp_socket, feedback_packet_format, magic_cookie, feedback_msg_type, segment_size, loss_threshold,
+                 initial_rate=10000000, step_time=0.2, min_step_segments=64, precision=0.05, min_rate=100000, warmup_steps=1):
+        """
+        Parameters:
+            udp_socket: the UDP socket connected to the client, the feedback arrives on it
+            feedback_packet_format: struct format of a feedback message (cookie, type, unique segments, highest segment)
+            magic_cookie: feedback without this cookie is ignored
+            feedback_msg_type: the message type of a feedback message
+            segment_size: the payload size of each segment, for the goodput
+            loss_threshold: the highest acceptable loss in percent
+            initial_rate: the rate of the first step in bits/second
+            step_time: min seconds of feedback per step
+            min_step_segments: min segments a step's loss is measured over
+            precision: settle once the bad rate is within this fraction of the good rate
+            min_rate: the rate isn't lowered under this, in bits/second
+            warmup_steps: the first steps only warm up the path (start-up loss while buffers/caches fill), they don't change the rate
+        """
+        self.udp_socket = udp_socket
+        self.feedback_packet_format = feedback_packet_format
+        self.feedback_size = struct.calcsize(feedback_packet_format)
+        self.magic_cookie = magic_cookie
+        self.feedback_msg_type = feedback_msg_type
+        self.segment_size = segment_size
+        self.loss_threshold = loss_threshold
+        self.step_time = step_time
+        self.min_step_segments = min_step_segments
+        self.precision = precision
+        self.min_rate = min_rate
+        self.warmup_steps = warmup_steps
+        self.rate = initial_rate
+        self.good_rate = None  # the highest rate with an acceptable loss so far
+        self.bad_rate = None  # the lowest rate with too much loss so far
+        self.settled = False
+        self.steps = []  # (rate, loss percent, goodput) of each finished step
+        # the current step only counts feedback windows that start after its first segment
+        self.step_start_segment = 0
+        self.step_expected = 0
+        self.step_received = 0
+        self.step_duration = 0.0
+        # cumulative counters from the last feedback
+        self.last_unique = 0
+        self.last_highest = -1
+        self.last_feedback_time = None
+
+    def poll_feedback(self, next_segment):
+        """
+        Read the feedback that arrived so far without blocking, called by the sender after each batch.
+
+        Parameters:
+            next_segment: the next segment the sender will send, a new step starts from it
+
+        Returns the new rate in bits/second if it changed, otherwise None
+        """
+        while select.select([self.udp_socket], [], [], 0)[0]:
+            try:
+                packet = self.udp_socket.recv(1024)
+            except BlockingIOError:
+                break
+            self.add_feedback(packet, time.time())
+        if self.settled or self.step_expected < self.min_step_segments or self.step_duration < self.step_time:
+            return None
+        return self.end_step(next_segment)
+
+    def add_feedback(self, packet, now):
+        if len(packet) != self.feedback_size:
+            return
+        magic_cookie, message_type, unique_segments, highest_segment = struct.unpack(self.feedback_packet_format, packet)
+        if magic_cookie != self.magic_cookie or message_type != self.feedback_msg_type or highest_segment <= self.last_highest:
+            return  # not feedback, or older than feedback that was already counted
+        if self.last_highest + 1 >= self.step_start_segment and self.last_feedback_time is not None:
+            # every segment of this window was sent at the current step's rate
+            self.step_expected += highest_segment - self.last_highest
+            self.step_received += unique_segments - self.last_unique
+            self.step_duration += now - self.last_feedback_time
+        self.last_unique, self.last_highest, self.last_feedback_time = unique_segments, highest_segment, now
+
+    def get_step_loss(self):
+        if self.step_expected == 0:
+            return 0.0
+        return max(0.0, 1 - self.step_received / self.step_expected) * 100
+
+    def get_step_goodput(self):
+        if self.step_duration <= 0:
+            return 0.0
+        return self.step_received * self.segment_size * 8 / self.step_duration
+
+    def end_step(self, next_segment):
+        loss, goodput = self.get_step_loss(), self.get_step_goodput()
+        self.steps.append((self.rate, loss, goodput))
+        if len(self.steps) > self.warmup_steps:  # the warm-up steps keep the initial rate
+            self.update_rate(loss, goodput)
+        self.step_start_segment = next_segment
+        self.step_expected = 0
+        self.step_received = 0
+        self.step_duration = 0.0
+        return self.rate
+
+    def update_rate(self, loss, goodput):
+        if loss <= self.loss_threshold:
+            self.good_rate = self.rate
+            if goodput < self.rate / 2:
+                self.settled = True  # no loss but far under the target rate, the sender itself can't go faster
+                return
+        else:
+            self.bad_rate = self.rate
+        if self.bad_rate is None:
+            self.rate = self.rate * 2  # no loss yet, keep doubling
+        elif self.good_rate is None:
+            self.rate = max(self.min_rate, self.rate / 2)  # too much loss even at the lowest rate so far
+            self.settled = self.rate == self.min_rate
+        elif self.bad_rate <= self.good_rate * (1 + self.precision):
+            self.rate = self.good_rate
+            self.settled = True
+        else:
+            self.rate = (self.good_rate + self.bad_rate) / 2
+
+    def wait_for_final_feedback(self, total_segments, timeout=0.5):
+        """After the last segment was sent, wait a little for the feedback that covers the end of the transfer"""
+        deadline = time.time() + timeout
+        while self.last_highest < total_segments - 1:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.udp_socket], [], [], remaining)[0]:
+                return
+            try:
+                self.add_feedback(self.udp_socket.recv(1024), time.time())
+            except OSError:
+                return
+
+    def get_result(self):
+        """(settled, rate, goodput, loss percent) at the rate the transfer ended on"""
+        if self.step_expected == 0 and len(self.steps) != 0:
+            # the transfer ended right after a step, report that step
+            rate, loss, goodput = self.steps[-1]
+            return self.settled, rate, goodput, loss
+        return self.settled, self.rate, self.get_step_goodput(), self.get_step_loss()
+
+
+class UdpSegmentSender:
+    """
+    Sends the segments of a UDP speed test over a connected UDP socket. The datagrams are built once,
+    only the segment counter is patched (struct.pack_into) before each send. On Linux the segments are sent in
+    batches with sendmmsg(), elsewhere one send() per segment. An optional target rate paces the batches
+    with a token bucket, so the client's receive buffer isn't flooded by bursts.
+    With the 'random' payload each segment carries its own slice of the payload ring, the datagrams are gathered
+    from the header and the ring slice (iovecs) so the payload is never copied.
+    """
+    def __init__(self, udp_socket, payload_packet_format, magic_cookie, payload_msg_type, segment_size,
+                 batch_size=64, target_rate=None, metrics=None, payload_mode="random", payload_seed=DEFAULT_PAYLOAD_SEED):
+        """
+        Parameters:
+            udp_socket: a UDP socket connected to the client
+            payload_packet_format: struct format of the payload header, the segment counter is its last field (Q)
+            magic_cookie: the magic cookie to put in each header
+            payload_msg_type: the message type to put in each header
+            segment_size: the payload size of each segment
+            batch_size: number of segments per sendmmsg() call / pacing round
+            target_rate: target send rate in bits/second, None to send as fast as possible
+            metrics: MetricsRegistry to count the bytes sent in, optional
+            payload_mode: the payload mode, see get_payload_ring
+            payload_seed: the seed of the 'random' mode
+        """
+        self.udp_socket = udp_socket
+        self.payload_packet_format = payload_packet_format
+        self.header_size = struct.calcsize(payload_packet_format)
+        self.counter_offset = self.header_size - 8  # the current segment is the last 8 bytes of the header
+        self.magic_cookie = magic_cookie
+        self.payload_msg_type = payload_msg_type
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.datagram_size = self.header_size + segment_size
+        self.metrics = metrics
+        self.pacer = None
+        if target_rate:
+            self.pacer = TokenBucket(target_rate / 8, 2 * batch_size * self.datagram_size)
+        self.ring = get_payload_ring(payload_mode, PAYLOAD_RING_SIZE, payload_seed)
+        # the other modes repeat a single byte, so every segment can share the same payload
+        self.ring_offsets = payload_mode == "random"
+        self.payload = self.ring if self.ring_offsets else bytearray(self.ring[:segment_size])
+        self.headers = bytearray(self.header_size * batch_size)
+        self.batch = SendmmsgBatch(self.headers, self.header_size, self.payload, batch_size, segment_size) if SENDMMSG_AVAILABLE else None
+        self.datagram = bytearray(self.header_size) + self.payload[:segment_size]  # reusable datagram for the portable path
+        self.ring_view = memoryview(self.ring)
+        self.use_sendmsg = hasattr(socket.socket, "sendmsg")  # not available on Windows
+
+    def get_ring_offset(self, segment):
+        """Segment i carries the payload stream from byte i * segment_size"""
+        return segment * self.segment_size % PAYLOAD_RING_SIZE
+
+    def send_segments(self, total_segments, controller=None, deadline=None):
+        """
+        Send segments 0..total_segments-1, returns the number of segments sent
+
+        Parameters:
+            total_segments: the number of segments to send
+            controller: an AdaptiveRateController that changes the target rate from the client's feedback. Optional
+            deadline: time.time() to send until instead, for a duration-based test. The headers then carry 0 total
+                segments (unknown in advance), total_segments is ignored. Optional
+        """
+        if deadline is not None:
+            total_segments = 0
+        if controller is not None and self.pacer is None:
+            self.pacer = TokenBucket(controller.rate / 8, 2 * self.batch_size * self.datagram_size)
+        for i in range(self.batch_size):
+            struct.pack_into(self.payload_packet_format, self.headers, i * self.header_size,
+                             self.magic_cookie, self.payload_msg_type, total_segments, 0)
+        struct.pack_into(self.payload_packet_format, self.datagram, 0, self.magic_cookie, self.payload_msg_type, total_segments, 0)
+
+        segment = 0
+        while segment < total_segments if deadline is None else time.time() < deadline:
+            count = min(self.batch_size, total_segments - segment) if deadline is None else self.batch_size
+            if self.pacer is not None:
+                self.pacer.consume(count * self.datagram_size)
+            if self.batch is not None:
+                for i in range(count):
+                    struct.pack_into('>Q', self.headers, i * self.header_size + self.counter_offset, segment + i)
+                    if self.ring_offsets:
+                        self.batch.set_payload_offset(i, self.get_ring_offset(segment + i))
+                self.batch.send(self.udp_socket, count)
+            elif self.ring_offsets and self.use_sendmsg:
+                header = memoryview(self.datagram)[:self.header_size]
+                for i in range(count):
+                    struct.pack_into('>Q', self.datagram, self.counter_offset, segment + i)
+                    offset = self.get_ring_offset(segment + i)
+                    self.udp_socket.sendmsg([header, self.ring_view[offset:offset + self.segment_size]])
+            else:
+                for i in range(count):
+                    struct.pack_into('>Q', self.datagram, self.counter_offset, segment + i)
+                    if self.ring_offsets:
+                        offset = self.get_ring_offset(segment + i)
+                        self.datagram[self.header_size:] = self.ring_view[offset:offset + self.segment_size]
+                    self.udp_socket.send(self.datagram)
+            segment += count
+            if self.metrics is not None:
+                self.metrics.inc("speedtest_bytes_sent_total", count * self.datagram_size, UDP_LABELS)
+            if controller is not None:
+                rate = controller.poll_feedback(segment)
+                if rate is not None:
+                    self.pacer.set_rate(rate / 8)
+        return segment
+
+    def send_end_of_stream(self, end_of_stream_packet_format, end_of_stream_msg_type, segments_sent, delays=(0, 0.01, 0.05), stop_event=None):
+        """
+        Tell the receiver that the stream ended, so it stops right away instead of waiting for a receive timeout. The
+        marker may be lost like any segment (ex in the full receive buffer right behind the last segments), so a few
+        copies are sent, spaced by 'delays' seconds.
+
+        Parameters:
+            end_of_stream_packet_format: struct format of the marker, magic cookie, type and the number of segments sent
+            end_of_stream_msg_type: the message type of the marker
+            segments_sent: the number of segments that were sent, the total of a duration-based stream
+            delays: seconds to wait before each copy
+            stop_event: a threading.Event set once the receiver answered, no more copies are sent after it. Optional
+        """
+        message = struct.pack(end_of_stream_packet_format, self.magic_cookie, end_of_stream_msg_type, segments_sent)
+        for delay in delays:
+            if stop_event is not None:
+                if stop_event.wait(delay):
+                    return  # the receiver got an earlier copy, later ones would only reach its closed socket
+            else:
+                time.sleep(delay)
+            try:
+                self.udp_socket.send(message)
+            except ConnectionRefusedError:
+                return  # the receiver got an earlier copy and already closed its socket
@@ -0,0 +1,195 @@
+import json
+import queue
+import sys
+import threading
+
+
+class ResultsCollector:
+    """
+    Collects the results of concurrent transfers without blocking them: the transfers only put their result (and its
+    console lines) on a queue, and a single writer thread prints the lines in the order they were published and writes
+    the JSONL records. At the end of each round the writer adds up the round's transfers into a round record, with the
+    aggregate throughput over the wall-clock union of the transfers' intervals.
+    """
+    def __init__(self, results_path=None, print_output=True):
+        """
+        Parameters:
+            results_path: path of the JSONL file to write the records to. Optional, None == console only
+            print_output: print the published console lines
+        """
+        self.results_path = results_path
+        self.print_output = print_output
+        self.queue = queue.Queue()
+        self.round = 0
+        self.round_results = []  # the results published since the last round ended, only used by the writer thread
+        self.results_file = None
+        self.writer_thread = None
+
+    def start(self):
+        if self.results_path is not None:
+            self.results_file = open(self.results_path, "w")
+        self.writer_thread = threading.Thread(target=self.write_loop, args=(), daemon=True)
+        self.writer_thread.start()
+        return self
+
+    def close(self):
+        """Write everything that was published and stop the writer"""
+        self.queue.put(("stop", None, []))
+        self.writer_thread.join()
+        if self.results_file is not None:
+            self.results_file.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def publish_transfer(self, result, lines=()):
+        """Publish a transfer's result (None if it failed) and its console lines, returns right away"""
+        self.queue.put(("transfer", result, list(lines)))
+
+    def publish_lines(self, lines):
+        """Publish console lines, printed in order with the transfers' lines"""
+        self.queue.put(("lines", None, list(lines)))
+
+    def publish_record(self, record, lines=()):
+        """Publish a ready-made JSONL record, ex a test plan's run or aggregate record"""
+        self.queue.put(("record", record, list(lines)))
+
+    def end_round(self, expected_transfers, info=None):
+        """
+        Close the current round, the writer writes the round record once it gets to it.
+
+        Parameters:
+            expected_transfers: how many transfers the round started, the missing ones are counted as failed
+            info: extra fields for the round record (ex the server). Optional
+        """
+        self.queue.put(("round", (expected_transfers, info or {}), []))
+
+    def flush(self):
+        """Wait until the writer handled everything that was published so far"""
+        self.queue.join()
+
+    def write_loop(self):
+        while True:
+            items = [self.queue.get()]  # blocking function, not busy-wait
+            while True:  # batch whatever else is waiting into a single console write
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            output = []
+            stop = False
+            for kind, payload, lines in items:
+                if kind == "transfer":
+                    if payload is not None:
+                        self.round_results.append(payload)
+                        self.write_record({"record": "transfer", "round": self.round, **payload})
+                elif kind == "record":
+                    self.write_record(payload)
+                elif kind == "round":
+                    lines = self.write_round(*payload)
+                elif kind == "stop":
+                    stop = True
+                output.extend(lines)
+            if self.print_output and len(output) != 0:
+                sys.stdout.write("\n".join(output) + "\n")
+                sys.stdout.flush()
+            if self.results_file is not None:
+                self.results_file.flush()
+            for _ in items:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def write_record(self, record):
+        if self.results_file is not None:
+            self.results_file.write(json.dumps(record) + "\n")
+
+    def write_round(self, expected_transfers, info):
+        """Write the record of the round that just ended, returns its console lines"""
+        results = self.round_results
+        record = {"record": "round", "round": self.round, **info, **self.aggregate(results),
+                  "transfers_failed": max(0, expected_transfers - len(results))}
+        self.write_record(record)
+        self.round += 1
+        self.round_results = []
+        if len(results) == 0:
+            return [f"Round {record['round']}: no transfer completed"]
+        line = (f"Round {record['round']}: {len(results)} transfers, aggregate throughput: {round(record['throughput'], 3)} bits/second "
+                f"(TCP {round(record['tcp_throughput'], 3)}, UDP {round(record['udp_throughput'], 3)}) over {round(record['wall_time'], 5)} seconds")
+        if record["transfers_failed"] != 0:
+            line += f", {record['transfers_failed']} failed"
+        return [line]
+
+    @staticmethod
+    def aggregate(results):
+        """The bytes delivered by all the transfers, and the throughput over the time at least one of them was running"""
+        tcp_results = [result for result in results if result["protocol"] == "tcp"]
+        udp_results = [result for result in results if result["protocol"] == "udp"]
+        wall_time = ResultsCollector.get_union_time(results)
+        tcp_wall_time = ResultsCollector.get_union_time(tcp_results)
+        udp_wall_time = ResultsCollector.get_union_time(udp_results)
+        bytes_delivered = sum(ResultsCollector.get_bytes_delivered(result) for result in results)
+        tcp_bytes = sum(ResultsCollector.get_bytes_delivered(result) for result in tcp_results)
+        udp_bytes = bytes_delivered - tcp_bytes
+        return {
+            "transfers_completed": len(results),
+            "bytes_delivered": bytes_delivered,
+            "wall_time": wall_time,
+            "throughput": bytes_delivered * 8 / wall_time if wall_time > 0 else 0,
+            "tcp_throughput": tcp_bytes * 8 / tcp_wall_time if tcp_wall_time > 0 else 0,
+            "udp_throughput": udp_bytes * 8 / udp_wall_time if udp_wall_time > 0 else 0,
+        }
+
+    @staticmethod
+    def get_bytes_delivered(result):
+        """The bytes the transfer delivered, in both directions for a bidirectional transfer"""
+        if "bytes_received" in result:  # TCP, uploads and duration-based UDP downloads
+            bytes_delivered = result["bytes_received"]
+        else:
+            bytes_delivered = result["file_size"] * result["unique_segments"] / result["total_segments"]
+        if result.get("upload") is not None:
+            bytes_delivered += ResultsCollector.get_bytes_delivered(result["upload"])
+        return bytes_delivered
+
+    @staticmethod
+    def get_union_time(results):
+        """The length of the union of the transfers' [start_time, end_time] intervals, gaps between them aren't counted"""
+        total = 0.0
+        union_start = union_end = None
+        for start, end in sorted((result["start_time"], result["end_time"]) for result in results):
+            if union_end is None or start > union_end:
+                if union_end is not None:
+                    total += union_end - union_start
+                union_start, union_end = start, end
+            else:
+                union_end = max(union_end, end)
+        if union_end is not None:
+            total += union_end - union_start
+        return total
+
+
+class ResultsQueueForwarder:
+    """
+    Takes the place of the ResultsCollector in a client worker process: what the transfers publish is sent to the
+    parent process over a multiprocessing queue, and the parent hands it to its own collector (or prints it)
+    """
+    def __init__(self, results_queue, worker_id):
+        """
+        Parameters:
+            results_queue: a multiprocessing queue read by the parent process
+            worker_id: sent with every message, so the parent knows which worker it came from
+        """
+        self.queue = results_queue
+        self.worker_id = worker_id
+
+    def publish_transfer(self, result, lines=()):
+        self.queue.put(("transfer", self.worker_id, (result, list(lines))))
+
+    def publish_lines(self, lines):
+        self.queue.put(("lines", self.worker_id, list(lines)))
+
+    def publish_record(self, record, lines=()):
+        self.queue.put(("record", self.worker_id, (record, list(lines))))
@@ -1,25 +1,64 @@
 from ServerMethods import *
+from PayloadEngine import PAYLOAD_MODES, DEFAULT_PAYLOAD_SEED
+import argparse
 
 # broadcast_port == the port that the server will send broadcast offers with.
 # it needs to be known and the same for both the server and the client to initiate communication
 BROADCAST_PORT = 13117
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speed test server")
+    parser.add_argument("--tcp-mode", choices=["threads", "selectors"], default="threads",
+                        help="'threads' runs a thread per TCP connection, 'selectors' multiplexes the downloads in one event loop, "
+                             "uploads, bidirectional tests and TCP pings still run on a thread each")
+    parser.add_argument("--udp-rate", type=float, default=None,
+                        help="target send rate of each UDP transfer in Mbit/s, paced with a token bucket (default: as fast as possible)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of pre-forked worker processes that run the speed tests (default: 0, run everything in this process)")
+    parser.add_argument("--metrics-port", type=int, default=9117,
+                        help="localhost port that serves Prometheus metrics on /metrics while the server runs, 0 to disable (default: 9117)")
+    parser.add_argument("--max-sessions", type=int, default=128,
+                        help="maximum number of speed test sessions running at the same time, per worker process with --workers "
+                             "(N workers run up to N times as many), 0 for no limit (default: 128)")
+    parser.add_argument("--max-sessions-per-client", type=int, default=32,
+                        help="maximum number of running sessions of a single client IP, per worker process with --workers "
+                             "(a client can hold up to N times as many, and the fair sharing is per worker), 0 for no limit (default: 32)")
+    parser.add_argument("--max-queued-sessions", type=int, default=1024,
+                        help="sessions over the limits wait in a queue of this size, the following ones are rejected (default: 1024)")
+    parser.add_argument("--queue-timeout", type=float, default=10,
+                        help="seconds a TCP session may wait for a free slot before it's rejected (default: 10)")
+    parser.add_argument("--payload", choices=PAYLOAD_MODES, default="random",
+                        help="the data sent to the clients: 'random' bytes can't be compressed by middleboxes, 'fill' is the letter x (default: random)")
+    parser.add_argument("--payload-seed", type=int, default=DEFAULT_PAYLOAD_SEED,
+                        help="the seed of the random payload, clients that verify the data must use the same seed")
+    args = parser.parse_args()
+
     # start a server instance
-    server = ServerMethods(broadcast_port=BROADCAST_PORT)
+    udp_target_rate = args.udp_rate * 1000000 if args.udp_rate else None
+    server = ServerMethods(broadcast_port=BROADCAST_PORT, udp_target_rate=udp_target_rate,
+                           max_sessions=args.max_sessions or None, max_sessions_per_client=args.max_sessions_per_client or None,
+                           max_queued_sessions=args.max_queued_sessions, session_queue_timeout=args.queue_timeout,
+                           payload_mode=args.payload, payload_seed=args.payload_seed)
     try:
+        # the workers must be forked before this process starts any threads
+        if args.workers <= 0 or not server.start_workers(args.workers, args.tcp_mode):
+            # start TCP and UDP servers in separate threads
+            tcp_listener = server.listen_for_TCP_requests if args.tcp_mode == "threads" else server.listen_for_TCP_requests_selectors
+            threading.Thread(target=tcp_listener, args=(), daemon=True).start()
+            threading.Thread(target=server.listen_for_UDP_requests, args=(), daemon=True).start()
+
+        if args.metrics_port:
+            server.start_metrics_server(args.metrics_port)
+
         # on a separate thread, broadcast an offer message every second
         threading.Thread(target=server.broadcast_offer, args=(), daemon=True).start()
 
-        # start TCP and UDP servers in separate threads
-        threading.Thread(target=server.listen_for_TCP_requests, args=(), daemon=True).start()
-        threading.Thread(target=server.listen_for_UDP_requests, args=(), daemon=True).start()
-
         input()  # stop server by pressing 'Enter'
     except KeyboardInterrupt:
         pass  # doesn't matter if the user stops the server with 'Enter' or Ctrl C
     finally:
         server.print_colored("Manual server shut down", "blue")
+        server.stop_workers()
         server.get_server_stats()
 
 
@@ -0,0 +1,125 @@
+import socket
+import struct
+import time
+import threading
+import statistics
+
+
+class ServerEntry:
+    """A server that sent an offer, with the connect latency measured by the last probe"""
+    def __init__(self, ip, tcp_port, udp_port, last_seen):
+        self.ip = ip
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.last_seen = last_seen  # when the last offer from the server arrived
+        self.rtt = None  # median TCP connect time in seconds, None == not probed yet
+        self.probe_time = None
+
+    def get_address(self):
+        """(ip, tcp_port, udp_port), the server parameter of ClientMethods.run_tcp_test/run_udp_test"""
+        return self.ip, self.tcp_port, self.udp_port
+
+
+class ServerTable:
+    """
+    The servers that sent offers, collected over a discovery window and cached for 'ttl' seconds after their last offer,
+    so following test rounds can start right away instead of waiting for the next broadcast.
+    The servers are ranked by their TCP connect latency (a connect without a request, the server closes it silently).
+    """
+    def __init__(self, magic_cookie, offer_msg_type, offer_packet_format, ttl=10):
+        """
+        Parameters:
+            magic_cookie: offers without this cookie are ignored
+            offer_msg_type: the message type of an offer
+            offer_packet_format: the struct format of an offer
+            ttl: seconds a server stays in the table after its last offer
+        """
+        self.MAGIC_COOKIE = magic_cookie
+        self.offer_msg_type = offer_msg_type
+        self.offer_packet_format = offer_packet_format
+        self.ttl = ttl
+        self.servers = {}  # (ip, tcp_port, udp_port) -> ServerEntry
+        self.lock = threading.Lock()
+
+    def add_offer(self, packet, server_ip, now):
+        """Parse an offer packet and add (or refresh) its server, returns False if it isn't a valid offer"""
+        try:
+            magic_cookie, message_type, udp_port, tcp_port = struct.unpack(self.offer_packet_format, packet)
+        except struct.error:
+            return False
+        if magic_cookie != self.MAGIC_COOKIE or message_type != self.offer_msg_type:
+            return False
+        with self.lock:
+            entry = self.servers.get((server_ip, tcp_port, udp_port))
+            if entry is None:
+                self.servers[(server_ip, tcp_port, udp_port)] = ServerEntry(server_ip, tcp_port, udp_port, now)
+            else:
+                entry.last_seen = now
+        return True
+
+    def get_servers(self, now=None):
+        """The servers whose last offer is younger than the ttl, expired servers are dropped"""
+        now = time.time() if now is None else now
+        with self.lock:
+            for key in [key for key, entry in self.servers.items() if now - entry.last_seen > self.ttl]:
+                del self.servers[key]
+            return list(self.servers.values())
+
+    def remove(self, entry):
+        with self.lock:
+            self.servers.pop((entry.ip, entry.tcp_port, entry.udp_port), None)
+
+    def collect_offers(self, udp_socket, window):
+        """
+        Receive offers for 'window' seconds into the table.
+
+        Parameters:
+            udp_socket: a socket bound to the broadcast port
+            window: how long to collect offers, in seconds
+        """
+        deadline = time.time() + window
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            udp_socket.settimeout(remaining)
+            try:
+                packet, server_address = udp_socket.recvfrom(1024)  # blocking function, not busy-wait
+            except socket.timeout:
+                return
+            self.add_offer(packet, server_address[0], time.time())
+
+    @staticmethod
+    def probe(entry, count=3, timeout=1):
+        """Measure the server's TCP connect time 'count' times, returns the median in seconds, None if unreachable"""
+        rtts = []
+        for _ in range(count):
+            try:
+                start_time = time.perf_counter()
+                with socket.create_connection((entry.ip, entry.tcp_port), timeout=timeout):
+                    rtts.append(time.perf_counter() - start_time)
+            except OSError:
+                pass
+        return statistics.median(rtts) if rtts else None
+
+    def rank_servers(self, probe_count=3, timeout=1):
+        """
+        Probe the servers that weren't probed since their cache entry was created (in parallel), drop the unreachable
+        ones and return the rest sorted by connect latency, fastest first
+        """
+        entries = self.get_servers()
+        unprobed = [entry for entry in entries if entry.rtt is None]
+
+        def probe_entry(entry):
+            entry.rtt = self.probe(entry, probe_count, timeout)
+            entry.probe_time = time.time()
+
+        threads = [threading.Thread(target=probe_entry, args=(entry,), daemon=True) for entry in unprobed]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for entry in unprobed:
+            if entry.rtt is None:
+                self.remove(entry)  # not reachable over TCP, maybe the server already stopped
+        return sorted((entry for entry in entries if entry.rtt is not None), key=lambda entry: entry.rtt)
@@ -1,15 +1,43 @@
 import socket
 import struct
 import time
-import re
 import threading
-import subprocess
-import platform
+import selectors
+import signal
+import multiprocessing
+import heapq
+import itertools
+from collections import deque
 from CustomExceptions import *
+from PayloadEngine import PayloadEngine, UdpSegmentSender, AdaptiveRateController, DEFAULT_PAYLOAD_SEED
+from ServerMetrics import MetricsRegistry, start_metrics_http_server
+from SocketBatching import DatagramReceiver, DEFAULT_MESSAGE_SIZE
+from TransferAnalysis import UdpLossAnalyzer
+from NetworkInterfaces import BroadcastAddressCache
+from SessionScheduler import SessionScheduler
+
+
+class TcpConnectionState:
+    """Bookkeeping of a single speed-test connection in the event-driven TCP server"""
+    def __init__(self, client_socket, client_address):
+        self.client_socket = client_socket
+        self.client_address = client_address
+        self.request_data = b''  # the request may arrive in several segments
+        self.file_size = None  # known after the whole request was read
+        self.total_sent = 0  # partial-write bookkeeping, how much of the payload the socket accepted so far
+        self.start_time = time.time()
+        self.admitted = False  # the session scheduler let the transfer start
+        self.header = b''  # the response header of a binary download, sent before its payload
+        self.duration = None  # seconds a timed download sends for, its deadline is set once it's admitted
+        self.deadline = None  # when the loop acts on the connection without an event: a timed download ends, an idle kept-alive connection is closed
+        self.keepalive = False  # framed downloads, the connection waits for the client's next request after each payload
+        self.transfers = 0  # downloads done on the connection
 
 
 class ServerMethods:
-    def __init__(self, magic_cookie=0xabcddcba, broadcast_port=13117, udp_speed_test_segment_size=1024):
+    def __init__(self, magic_cookie=0xabcddcba, broadcast_port=13117, udp_speed_test_segment_size=1024, udp_target_rate=None, udp_batch_size=64,
+                 max_sessions=None, max_sessions_per_client=None, max_queued_sessions=1024, session_queue_timeout=10,
+                 payload_mode="random", payload_seed=DEFAULT_PAYLOAD_SEED):
         self.MAGIC_COOKIE = magic_cookie
         self.offer_msg_type = 0x2
         self.offer_packet_format = '>IBHH'  # Magic cookie (4 bytes), type (1 byte), ports (2 bytes each)
@@ -17,17 +45,69 @@ class ServerMethods:
         self.request_packet_format = '>IBQ'  # Magic cookie (4 bytes), type (1 byte), file size (8 bytes)
         self.payload_msg_type = 0x4
         self.payload_packet_format = '>IBQQ'  # Magic cookie (4 bytes), type (1 byte), total segments (8 bytes), current segment (8 bytes)
+        # adaptive-rate UDP mode, the client sends feedback to the per-client socket and gets the rate the server settled on
+        self.adaptive_request_msg_type = 0x5
+        self.adaptive_request_packet_format = '>IBQH'  # Magic cookie (4 bytes), type (1 byte), file size (8 bytes), acceptable loss in 1/100 % (2 bytes)
+        self.feedback_msg_type = 0x6
+        self.feedback_packet_format = '>IBQQ'  # Magic cookie (4 bytes), type (1 byte), unique segments received (8 bytes), highest segment received (8 bytes)
+        self.adaptive_result_msg_type = 0x7
+        self.adaptive_result_packet_format = '>IBBQQI'  # Magic cookie (4 bytes), type (1 byte), settled (1 byte), rate and goodput in bits/second (8 bytes each), loss in ppm (4 bytes)
+        # upload (client to server) and bidirectional tests use the request format, over TCP the uploaded data follows it
+        self.upload_msg_type = 0x8
+        self.bidirectional_msg_type = 0x9
+        self.ready_msg_type = 0xA
+        self.ready_packet_format = '>IB'  # Magic cookie (4 bytes), type (1 byte), sent from the per-client UDP socket the upload goes to
+        self.upload_result_msg_type = 0xB
+        self.upload_result_packet_format = '>IBQQQdd'  # Magic cookie (4 bytes), type (1 byte), bytes received, unique and lost segments (8 bytes each), receive time and jitter in seconds (8 bytes each)
+        # a binary TCP download request (request_packet_format) is answered with a response header before the payload,
+        # and the connection stays open for the client's next request
+        self.response_msg_type = 0xC
+        self.response_packet_format = '>IBQ'  # Magic cookie (4 bytes), type (1 byte), payload size that follows (8 bytes)
+        # latency probes, answered right away on the main UDP socket or on a TCP connection (TCP_NODELAY) of their own
+        self.ping_msg_type = 0xD
+        self.pong_msg_type = 0xE
+        self.ping_packet_format = '>IBQd'  # Magic cookie (4 bytes), type (1 byte), sequence (8 bytes), client timestamp (8 bytes), a pong echoes them
+        self.ping_size = struct.calcsize(self.ping_packet_format)
+        # the last UDP message of a stream, so the receiver stops right away instead of waiting for a timeout
+        self.end_of_stream_msg_type = 0xF
+        self.end_of_stream_packet_format = '>IBQ'  # Magic cookie (4 bytes), type (1 byte), segments sent (8 bytes)
+        self.end_of_stream_size = struct.calcsize(self.end_of_stream_packet_format)
+        # a duration-based download, like a request (request_packet_format) with the duration in milliseconds instead of the file size
+        self.timed_request_msg_type = 0x10
+        self.max_test_duration = 60  # seconds, longer duration-based tests are cut to it
+        self.magic_cookie_bytes = struct.pack('>I', magic_cookie)  # binary requests start with it, legacy TCP requests are text
+        self.request_size = struct.calcsize(self.request_packet_format)
+        self.payload_header_size = struct.calcsize(self.payload_packet_format)
+        self.tcp_recv_buffer_size = 262144  # size of the reusable buffer each TCP upload is received into
+        self.tcp_keepalive_timeout = 10  # seconds a kept-alive TCP connection waits for the client's next request
         self.broadcast_port = broadcast_port
+        self.broadcast_address_cache = BroadcastAddressCache()  # refreshed only when the network interfaces change
         self.tcp_main_socket, self.tcp_main_port, self.udp_main_socket, self.udp_main_port = self.server_startup()
         self.udp_segment_size = udp_speed_test_segment_size
-        # vars for server stats
-        self.num_of_broadcast_offers_sent = 0
-        self.num_of_tcp_speed_tests = 0
-        self.clients_tcp_tests_list = set()
-        self.num_of_udp_speed_tests = 0
-        self.clients_udp_tests_list = set()
-        self.overall_data_sent = 0
-
+        self.udp_target_rate = udp_target_rate  # bits/second for each UDP transfer, None == as fast as possible
+        self.udp_batch_size = udp_batch_size  # number of segments sent per batch (a single sendmmsg call on Linux)
+        # server stats, each thread updates its own shard without locks, the shards are added up when read
+        self.metrics = MetricsRegistry()
+        self.describe_metrics()
+        self.metrics_http_server = None
+        # the payload stream of all the transfers, clients that verify the data must use the same mode and seed
+        self.payload_mode = payload_mode
+        self.payload_seed = payload_seed
+        self.payload_engine = PayloadEngine(metrics=self.metrics, mode=payload_mode, seed=payload_seed)  # the TCP payload is built once and shared by all connections
+        # bounds the running sessions (threads and sockets), the rest wait in a queue and get the free slots fairly per client
+        self.session_scheduler = SessionScheduler(max_sessions, max_sessions_per_client, max_queued_sessions, session_queue_timeout, self.metrics)
+        self.udp_queue_timeout = 0.5  # the client gives up on a UDP transfer after 1 second without data
+        # TCP connections admitted by the scheduler, handed over to the selectors loop
+        self.admitted_tcp_connections = deque()
+        self.selectors_wakeup_socket = None
+        # (deadline, tie breaker, connection) heap of the selectors loop, an entry is stale once the connection's deadline changed
+        self.tcp_deadlines = []
+        self.tcp_deadline_counter = itertools.count()
+        # vars for the pre-fork worker mode
+        self.workers = []
+        self.workers_stop_event = None
+        self.workers_stats_queue = None
+        self.workers_stats_thread = None
 
     @staticmethod
     def server_startup():
@@ -41,58 +121,17 @@ class ServerMethods:
         udp_main_port = udp_main_socket.getsockname()[1]
         return tcp_main_socket, tcp_main_port, udp_main_socket, udp_main_port
 
-    @staticmethod
-    def get_broadcast_address():
-        """Determine the broadcast address dynamically for macOS/Linux and Windows."""
+    def get_broadcast_addresses(self):
+        """The (interface name, broadcast address) of every active interface, cached until the interfaces change"""
         try:
-            if platform.system() in ["Linux", "Darwin"]:  # macOS and Linux
-                # Run ifconfig to get network details
-                result = subprocess.run(['ifconfig'], capture_output=True, text=True)
-                output = result.stdout
-
-                # Find the broadcast address using regex
-                match = re.search(r'broadcast (\d+\.\d+\.\d+\.\d+)', output)
-                if match:
-                    return match.group(1)
-                else:
-                    raise RuntimeError("Broadcast address not found in network configuration.")
-
-            elif platform.system() == "Windows":
-                # Run ipconfig to get network details
-                result = subprocess.run(['ipconfig'], capture_output=True, text=True, encoding='oem')
-                output = result.stdout
-
-                try:
-                    flag = False
-                    ipv4_address = ""
-                    subnet_mask = ""
-                    for row in output.split("\n"):
-                        if "Wireless LAN adapter" in row:
-                            flag = True
-                        if flag:
-                            # Use regex to extract IPv4 and subnet mask
-                            ipv4_match = re.findall(r'IPv4 Address.*: (\d+\.\d+\.\d+\.\d+)', row)
-                            subnet_match = re.findall(r'Subnet Mask.*: (\d+\.\d+\.\d+\.\d+)', row)
-
-                            if len(ipv4_match) != 0:
-                                ipv4_address = ipv4_match[0]
-                            if len(subnet_match) != 0:
-                                subnet_mask = subnet_match[0]
-
-                    # Calculate the broadcast address
-                    ipv4_parts = list(map(int, ipv4_address.split('.')))
-                    subnet_parts = list(map(int, subnet_mask.split('.')))
-                    broadcast_parts = [(ipv4_parts[i] | ~subnet_parts[i] & 0xFF) for i in range(4)]
-                    broadcast_address = '.'.join(map(str, broadcast_parts))
-                    return broadcast_address
-                except Exception:
-                    raise RuntimeError("Could not determine broadcast address from ipconfig output.")
-            else:
-                raise RuntimeError("Unsupported operating system.")
-
+            return self.broadcast_address_cache.get()
         except Exception as e:
             raise RuntimeError(f"Failed to determine broadcast address: {e}")
 
+    def get_broadcast_address(self):
+        """The broadcast address of the first active interface"""
+        return self.get_broadcast_addresses()[0][1]
+
     def broadcast_offer(self, interval=1):
         """
         Broadcasts an 'offer' message to clients.
@@ -108,12 +147,18 @@ class ServerMethods:
         packet = struct.pack(self.offer_packet_format, self.MAGIC_COOKIE, self.offer_msg_type, self.udp_main_port, self.tcp_main_port)
 
         try:
-            broadcast_address = self.get_broadcast_address()
+            broadcast_addresses = self.get_broadcast_addresses()
             self.print_colored(f"Server started, listening on IP address {self.get_server_ip()}", "green")
+            self.print_colored("Broadcasting offers on " + ", ".join(f"{name} ({address})" for name, address in broadcast_addresses), "cyan")
             while True:
-                # Broadcast the packet to the determined broadcast address
-                udp_broadcast_socket.sendto(packet, (broadcast_address, self.broadcast_port))
-                self.num_of_broadcast_offers_sent += 1
+                # Broadcast the packet on every active interface, the address list is only re-read when an interface changes
+                for name, broadcast_address in self.get_broadcast_addresses():
+                    try:
+                        udp_broadcast_socket.sendto(packet, (broadcast_address, self.broadcast_port))
+                        self.metrics.inc("speedtest_broadcast_offers_total")  # add for server stats
+                    except OSError as e:
+                        self.broadcast_address_cache.invalidate()  # ex the interface went down since the last refresh
+                        self.print_colored(f"Failed to broadcast an offer on {name} ({broadcast_address}): {e}", "red")
                 time.sleep(interval)
         except KeyboardInterrupt:
             self.print_colored("Broadcasting stopped.", "red")
@@ -122,47 +167,401 @@ class ServerMethods:
 
     def handle_tcp_client(self, client_socket, client_address):
         try:
-            # Read file size from client
-            file_size = int(client_socket.recv(1024).decode().strip())
-            self.overall_data_sent += file_size  # add for server stats
+            request = client_socket.recv(1024)
+        except OSError:
+            request = b''
+        if not request:
+            # clients open connections without a request to measure the connect latency, when choosing a server
+            self.metrics.inc("speedtest_probe_connections_total")  # add for server stats
+            client_socket.close()
+            self.metrics.retire_shard()  # this thread is done
+            return
+
+        if request.startswith(self.magic_cookie_bytes[:len(request)]):
+            self.handle_binary_tcp_request(client_socket, client_address, request)
+            return
 
-            # Chunk size for sending data
-            chunk_size = 1048576  # 1 MB
+        start_time = self.start_session("tcp", client_address)
+        try:
+            # the text request ends with a newline, it may arrive in more than one segment
+            while b'\n' not in request and len(request) <= 1024:
+                data = client_socket.recv(1024)
+                if not data:
+                    break
+                request += data
+            # Read file size from client
+            file_size = int(request.decode().strip())
+            self.metrics.inc("speedtest_bytes_requested_total", file_size, (("protocol", "tcp"),))  # add for server stats
 
-            # Generate and send data in chunks, will be easier on memory and CPU + supports files_size > 2GB
-            total_sent = 0
-            while total_sent < file_size:
-                remaining = file_size - total_sent
-                chunk_size_to_send = min(chunk_size, remaining)
-                chunk = b'x' * chunk_size_to_send  # Generate chunk dynamically
-                client_socket.sendall(chunk)
-                total_sent += chunk_size_to_send
+            # send the shared payload in chunks (no per-chunk allocations), supports files_size > 2GB
+            self.payload_engine.send(client_socket, file_size)
 
         except Exception as e:
+            self.record_error(e)
             if e.__str__() == "[Errno 32] Broken pipe":
                 self.print_colored(f"TCP client {client_address} cut the connection to the server", "red")
             else:
                 self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
         finally:
             client_socket.close()
+            self.end_session("tcp", start_time)
+            self.metrics.retire_shard()  # this thread is done
+
+    def handle_binary_tcp_request(self, client_socket, client_address, request):
+        """A TCP request that starts with the magic cookie (a download or an upload), 'request' is what was read of it so far"""
+        try:
+            message_type, file_size, request = self.receive_binary_request(client_socket, client_address, request)
+            if message_type not in (self.request_msg_type, self.upload_msg_type, self.bidirectional_msg_type, self.ping_msg_type,
+                                    self.timed_request_msg_type):
+                raise InvalidRequestFormat(f"Invalid request from {client_address}")
+        except Exception as e:
+            self.record_error(e)
+            self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
+            client_socket.close()
+            self.metrics.retire_shard()  # this thread is done
+            return
+        if message_type == self.request_msg_type:
+            self.handle_tcp_session(client_socket, client_address, file_size, request)
+        elif message_type == self.timed_request_msg_type:
+            self.handle_tcp_timed_session(client_socket, client_address, self.get_test_duration(file_size))
+        elif message_type == self.ping_msg_type:
+            # a ping starts like a request (its sequence was read as the file size), put it back together
+            first_ping = struct.pack(self.request_packet_format, self.MAGIC_COOKIE, message_type, file_size) + request
+            self.handle_tcp_ping_session(client_socket, client_address, first_ping)
+        else:
+            self.handle_tcp_upload(client_socket, client_address, message_type, file_size, len(request))
+
+    def receive_binary_request(self, client_socket, client_address, data=b''):
+        """
+        Read a whole binary request (request_packet_format), it may arrive in more than one segment.
+
+        Parameters:
+            client_socket: the client's blocking TCP socket
+            client_address: the client's (ip, port)
+            data: what was already read from the socket
+
+        Returns (message type, file size, the bytes read after the request), None if the client closed the connection
+        before sending anything
+        """
+        while len(data) < self.request_size:
+            chunk = client_socket.recv(1024)  # blocking function, not busy-wait
+            if not chunk:
+                if len(data) == 0:
+                    return None
+                raise ConnectionResetError("Connection closed before the request was received")
+            data += chunk
+        magic_cookie, message_type, file_size = struct.unpack_from(self.request_packet_format, data)
+        if magic_cookie != self.MAGIC_COOKIE:
+            raise InvalidRequestFormat(f"Invalid request from {client_address}")
+        return message_type, file_size, data[self.request_size:]
+
+    def handle_tcp_session(self, client_socket, client_address, file_size, pending=b''):
+        """
+        A kept-alive TCP session: send each requested payload after a response header, then wait for the client's next
+        download request on the same connection, so back-to-back tests don't pay for a new handshake and slow-start.
+        The session ends when the client closes the connection or sends nothing for tcp_keepalive_timeout seconds.
+
+        Parameters:
+            client_socket: the client's blocking TCP socket
+            client_address: the client's (ip, port)
+            file_size: the size the first request asked for
+            pending: bytes of the client's next request that were already read
+        """
+        start_time = self.start_session("tcp", client_address)
+        more_flag = getattr(socket, "MSG_MORE", 0)  # Linux, the header goes out in the same segment as the payload
+        transfers = 0
+        try:
+            while True:
+                self.metrics.inc("speedtest_bytes_requested_total", file_size, (("protocol", "tcp"),))  # add for server stats
+                self.metrics.inc("speedtest_tcp_transfers_total", 1, (("connection", "cold" if transfers == 0 else "warm"),))  # add for server stats
+                client_socket.sendall(struct.pack(self.response_packet_format, self.MAGIC_COOKIE, self.response_msg_type, file_size), more_flag)
+                self.payload_engine.send(client_socket, file_size)
+                transfers += 1
+
+                client_socket.settimeout(self.tcp_keepalive_timeout)
+                try:
+                    request = self.receive_binary_request(client_socket, client_address, pending)
+                except socket.timeout:
+                    break  # an idle kept-alive connection gives its session slot back
+                client_socket.settimeout(None)  # the payload is sent with sendfile, which needs a blocking socket
+                if request is None:
+                    break  # the client is done
+                message_type, file_size, pending = request
+                if message_type != self.request_msg_type:
+                    raise InvalidRequestFormat(f"Invalid request from {client_address}, only downloads can follow on a kept-alive connection")
+        except Exception as e:
+            self.record_error(e)
+            if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                self.print_colored(f"TCP client {client_address} cut the connection to the server", "red")
+            else:
+                self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
+        finally:
+            client_socket.close()
+            self.end_session("tcp", start_time)
+            self.metrics.retire_shard()  # this thread is done
 
-    def handle_udp_request(self, file_size, client_address, udp_socket):
+    def handle_tcp_timed_session(self, client_socket, client_address, duration):
+        """
+        A duration-based TCP download: a response header with a payload size of 0 (unknown in advance), then the payload
+        until 'duration' seconds passed. The end of the payload is the end of the stream, the connection isn't kept alive.
+
+        Parameters:
+            client_socket: the client's blocking TCP socket
+            client_address: the client's (ip, port)
+            duration: seconds to send for
+        """
+        start_time = self.start_session("tcp", client_address)
+        more_flag = getattr(socket, "MSG_MORE", 0)  # Linux, the header goes out in the same segment as the payload
+        try:
+            self.metrics.inc("speedtest_tcp_transfers_total", 1, (("connection", "cold"),))  # add for server stats
+            client_socket.sendall(struct.pack(self.response_packet_format, self.MAGIC_COOKIE, self.response_msg_type, 0), more_flag)
+            self.payload_engine.send(client_socket, 1 << 62, deadline=time.time() + duration)
+            client_socket.shutdown(socket.SHUT_WR)  # the client reads until the end of the stream
+        except Exception as e:
+            self.record_error(e)
+            if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+                self.print_colored(f"TCP client {client_address} cut the connection to the server", "red")
+            else:
+                self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
+        finally:
+            client_socket.close()
+            self.end_session("tcp", start_time)
+            self.metrics.retire_shard()  # this thread is done
+
+    def get_test_duration(self, duration_ms):
+        """The duration of a duration-based test in seconds, from the milliseconds in its request"""
+        return min(duration_ms / 1000, self.max_test_duration)
+
+    def handle_tcp_ping_session(self, client_socket, client_address, data=b''):
+        """
+        Answer each ping on the connection with a pong right away, until the client closes it. TCP_NODELAY sends every
+        pong in its own segment without waiting for an ACK (Nagle), so the client measures the network's RTT.
+
+        Parameters:
+            client_socket: the client's blocking TCP socket
+            client_address: the client's (ip, port)
+            data: what was already read from the socket
+        """
+        pings = 0
+        try:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while True:
+                pongs = []
+                while len(data) >= self.ping_size:  # a read may hold several pings, or a part of one
+                    magic_cookie, message_type, sequence, timestamp = struct.unpack_from(self.ping_packet_format, data)
+                    if magic_cookie != self.MAGIC_COOKIE or message_type != self.ping_msg_type:
+                        raise InvalidRequestFormat(f"Invalid ping from {client_address}")
+                    pongs.append(struct.pack(self.ping_packet_format, self.MAGIC_COOKIE, self.pong_msg_type, sequence, timestamp))
+                    data = data[self.ping_size:]
+                if len(pongs) != 0:
+                    client_socket.sendall(b''.join(pongs))
+                    pings += len(pongs)
+                chunk = client_socket.recv(1024)  # blocking function, not busy-wait
+                if not chunk:
+                    break  # the client is done
+                data += chunk
+        except Exception as e:
+            self.record_error(e)
+            self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
+        finally:
+            client_socket.close()
+            self.metrics.inc("speedtest_pings_total", pings, (("protocol", "tcp"),))  # add for server stats
+            self.metrics.retire_shard()  # this thread is done
+
+    def handle_tcp_upload(self, client_socket, client_address, message_type, file_size, early_bytes=0):
+        """
+        Receive the client's upload (and send it the payload at the same time, for a bidirectional test), then send the
+        client the result of the receive side.
+
+        Parameters:
+            client_socket: the client's blocking TCP socket
+            client_address: the client's (ip, port)
+            message_type: upload_msg_type or bidirectional_msg_type
+            file_size: the number of bytes to receive (and send)
+            early_bytes: uploaded bytes that were already read together with the request
+        """
+        start_time = self.start_session("tcp", client_address)
+        sender_thread = None
+        try:
+            if message_type == self.bidirectional_msg_type:
+                self.metrics.inc("speedtest_bytes_requested_total", file_size, (("protocol", "tcp"),))  # add for server stats
+                sender_thread = threading.Thread(target=self.send_tcp_download, args=(client_socket, client_address, file_size), daemon=True)
+                sender_thread.start()
+
+            # received into a reusable buffer, like the client's download
+            buffer = bytearray(self.tcp_recv_buffer_size)
+            received = early_bytes
+            receive_start = last_byte_time = time.time()
+            while received < file_size:
+                num_bytes = client_socket.recv_into(buffer, min(len(buffer), file_size - received))  # blocking function, not busy-wait
+                if num_bytes == 0:
+                    break  # the client stopped the upload
+                received += num_bytes
+                last_byte_time = time.time()
+            self.metrics.inc("speedtest_bytes_received_total", received, (("protocol", "tcp"),))  # add for server stats
+
+            if sender_thread is not None:
+                sender_thread.join()
+            client_socket.sendall(struct.pack(self.upload_result_packet_format, self.MAGIC_COOKIE, self.upload_result_msg_type,
+                                              received, 0, 0, last_byte_time - receive_start, 0.0))
+        except Exception as e:
+            self.record_error(e)
+            self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
+        finally:
+            client_socket.close()
+            self.end_session("tcp", start_time)
+            self.metrics.retire_shard()  # this thread is done
+
+    def send_tcp_download(self, client_socket, client_address, file_size):
+        """The download half of a bidirectional TCP test, runs in its own thread"""
+        try:
+            self.payload_engine.send(client_socket, file_size)
+        except Exception as e:
+            self.record_error(e)
+            self.print_colored(f"Error with TCP client {client_address}: {e}", "red")
+        finally:
+            self.metrics.retire_shard()  # this thread is done
+
+    def handle_udp_request(self, file_size, client_address, udp_socket, loss_threshold=None, duration=None):
+        """
+        Send the requested file size to the client as UDP segments, followed by the end-of-stream marker.
+
+        Parameters:
+            file_size: the requested number of bytes
+            client_address: the client's (ip, port)
+            udp_socket: a new UDP socket for this client
+            loss_threshold: acceptable loss in percent for an adaptive-rate test. Optional, None == a regular test
+            duration: send for this many seconds instead of file_size bytes. Optional
+        """
+        start_time = self.start_session("udp", client_address)
         try:
-            # check if the requested file size fits in a segment size window,
-            # if not, add another segment for the trailing data
-            if file_size % self.udp_segment_size == 0:
-                total_segments = file_size // self.udp_segment_size
+            total_segments = self.get_total_segments(file_size)
+            udp_socket.connect(client_address)  # the sender works with send()/sendmmsg() without a destination per datagram
+            sender = UdpSegmentSender(udp_socket, self.payload_packet_format, self.MAGIC_COOKIE, self.payload_msg_type,
+                                      self.udp_segment_size, self.udp_batch_size, self.udp_target_rate, self.metrics,
+                                      self.payload_mode, self.payload_seed)
+            if duration is not None:
+                segments_sent = sender.send_segments(0, deadline=time.time() + duration)
+                sender.send_end_of_stream(self.end_of_stream_packet_format, self.end_of_stream_msg_type, segments_sent)
+            elif loss_threshold is None:
+                sender.send_segments(total_segments)
+                sender.send_end_of_stream(self.end_of_stream_packet_format, self.end_of_stream_msg_type, total_segments)
             else:
-                total_segments = file_size // self.udp_segment_size + 1
-            segment = 0
-            while segment < total_segments:
-                payload = struct.pack(self.payload_packet_format, self.MAGIC_COOKIE, self.payload_msg_type, total_segments, segment) + b'x' * self.udp_segment_size
-                udp_socket.sendto(payload, client_address)
-                segment += 1
+                self.run_adaptive_udp_test(sender, total_segments, loss_threshold, udp_socket, client_address)
         except Exception as e:
+            self.record_error(e)
             self.print_colored(f"Error with UDP client {client_address}: {e}", "red")
         finally:
             udp_socket.close()
+            self.end_session("udp", start_time)
+            self.metrics.retire_shard()  # this thread is done
+
+    def get_total_segments(self, file_size):
+        # check if the requested file size fits in a segment size window,
+        # if not, add another segment for the trailing data
+        if file_size % self.udp_segment_size == 0:
+            return file_size // self.udp_segment_size
+        return file_size // self.udp_segment_size + 1
+
+    def handle_udp_upload(self, file_size, client_address, udp_socket, bidirectional=False):
+        """
+        Receive the client's UDP upload on a per-client socket (and send it the payload segments at the same time, for a
+        bidirectional test), then send the client the result of the receive side.
+
+        Parameters:
+            file_size: the number of bytes the client uploads (and requests)
+            client_address: the client's (ip, port)
+            udp_socket: a new UDP socket for this client
+            bidirectional: also send file_size bytes to the client
+        """
+        start_time = self.start_session("udp", client_address)
+        sender_thread = None
+        try:
+            udp_socket.connect(client_address)
+            # tells the client where to send the upload, the source of this message
+            udp_socket.send(struct.pack(self.ready_packet_format, self.MAGIC_COOKIE, self.ready_msg_type))
+            if bidirectional:
+                sender = UdpSegmentSender(udp_socket, self.payload_packet_format, self.MAGIC_COOKIE, self.payload_msg_type,
+                                          self.udp_segment_size, self.udp_batch_size, self.udp_target_rate, self.metrics,
+                                          self.payload_mode, self.payload_seed)
+                sender_thread = threading.Thread(target=self.send_udp_download, args=(sender, self.get_total_segments(file_size), client_address), daemon=True)
+                sender_thread.start()
+
+            # the datagrams are read into preallocated buffers (batched with recvmmsg on Linux), like the client's download.
+            # the slots fit the default 1024 bytes upload segments and grow if the client sends larger ones, a 64 KB
+            # slot per datagram would take 4 MB per session
+            receiver = DatagramReceiver(udp_socket, DEFAULT_MESSAGE_SIZE, self.udp_batch_size)
+            analyzer = UdpLossAnalyzer()
+            receive_start = time.time()
+            end_of_stream = False
+            while not end_of_stream:  # keep receiving until the end-of-stream marker, or no data for 1 second
+                count = receiver.receive(timeout=1)  # blocking function, not busy-wait
+                if count == 0:
+                    break
+                for i in range(count):
+                    if receiver.lengths[i] == self.end_of_stream_size:
+                        magic_cookie, message_type, _ = struct.unpack_from(self.end_of_stream_packet_format, receiver.buffers, i * receiver.message_size)
+                        if magic_cookie == self.MAGIC_COOKIE and message_type == self.end_of_stream_msg_type:
+                            end_of_stream = True
+                        continue
+                    if receiver.lengths[i] < self.payload_header_size:
+                        continue  # not a speed test segment
+                    magic_cookie, message_type, total_segment_count, current_segment_count = struct.unpack_from(
+                        self.payload_packet_format, receiver.buffers, i * receiver.message_size)
+                    if magic_cookie == self.MAGIC_COOKIE and message_type == self.payload_msg_type:
+                        analyzer.add_segment(current_segment_count, total_segment_count, receiver.timestamps[i])
+            if sender_thread is not None:
+                sender_thread.join()
+
+            report = analyzer.get_report()
+            unique_segments = report["unique_segments"] if report else 0
+            lost_segments = report["lost_segments"] if report else 0
+            received = file_size * unique_segments // report["total_segments"] if report else 0
+            self.metrics.inc("speedtest_bytes_received_total", received, (("protocol", "udp"),))  # add for server stats
+            receive_time = (analyzer.last_arrival_time or receive_start) - receive_start
+            result_message = struct.pack(self.upload_result_packet_format, self.MAGIC_COOKIE, self.upload_result_msg_type,
+                                         received, unique_segments, lost_segments, receive_time, analyzer.jitter)
+            try:
+                for _ in range(3):  # the result may be lost like any other datagram, send a few copies
+                    udp_socket.send(result_message)
+            except ConnectionRefusedError:
+                pass  # the client got the first copy and already closed its socket
+        except Exception as e:
+            self.record_error(e)
+            self.print_colored(f"Error with UDP client {client_address}: {e}", "red")
+        finally:
+            udp_socket.close()
+            self.end_session("udp", start_time)
+            self.metrics.retire_shard()  # this thread is done
+
+    def send_udp_download(self, sender, total_segments, client_address):
+        """The download half of a bidirectional UDP test, runs in its own thread"""
+        try:
+            sender.send_segments(total_segments)
+            sender.send_end_of_stream(self.end_of_stream_packet_format, self.end_of_stream_msg_type, total_segments)
+        except Exception as e:
+            self.record_error(e)
+            self.print_colored(f"Error with UDP client {client_address}: {e}", "red")
+        finally:
+            self.metrics.retire_shard()  # this thread is done
+
+    def run_adaptive_udp_test(self, sender, total_segments, loss_threshold, udp_socket, client_address):
+        """Send the segments at a rate adjusted from the client's feedback, then send the client the rate it settled on"""
+        controller = AdaptiveRateController(udp_socket, self.feedback_packet_format, self.MAGIC_COOKIE, self.feedback_msg_type,
+                                            self.udp_segment_size, loss_threshold, initial_rate=self.udp_target_rate or 10000000)
+        sender.send_segments(total_segments, controller)
+        controller.wait_for_final_feedback(total_segments)
+        settled, rate, goodput, loss = controller.get_result()
+        result_message = struct.pack(self.adaptive_result_packet_format, self.MAGIC_COOKIE, self.adaptive_result_msg_type,
+                                     settled, round(rate), round(goodput), min(round(loss * 10000), 0xFFFFFFFF))
+        try:
+            for _ in range(3):  # the result may be lost like any other datagram, send a few copies
+                udp_socket.send(result_message)
+        except ConnectionRefusedError:
+            pass  # the client got the first copy and already closed its socket
+        self.metrics.inc("speedtest_udp_adaptive_tests_total", 1, (("settled", str(bool(settled)).lower()),))  # add for server stats
+        self.print_colored(f"Adaptive UDP test of {client_address} {'settled' if settled else 'ended'} at "
+                           f"{round(rate / 1e6, 3)} Mbit/s, goodput {round(goodput / 1e6, 3)} Mbit/s, loss {round(loss, 3)}%", "cyan")
 
     def listen_for_TCP_requests(self):
         """A function that runs concurrent threads for each speed-test connection over TCP"""
@@ -170,56 +569,451 @@ class ServerMethods:
         while True:
             try:
                 client_socket, client_address = self.tcp_main_socket.accept()  # blocking function, not busy-wait
-                self.num_of_tcp_speed_tests += 1  # add for server stats
-                self.clients_tcp_tests_list.add(client_address[0])  # add for server stats
-                threading.Thread(target=self.handle_tcp_client, args=(client_socket, client_address)).start()
+                # the connection's thread starts once the scheduler admits it, until then the request waits in the socket
+                self.schedule_session_thread("tcp", client_address, self.handle_tcp_client, (client_socket, client_address),
+                                             reject=client_socket.close)
             except Exception as e:
+                self.record_error(e)
                 self.print_colored(e, "red")
 
+    def listen_for_TCP_requests_selectors(self):
+        """
+        An event-driven alternative for listen_for_TCP_requests, a single thread multiplexes all the speed-test
+        connections over TCP with non-blocking sockets instead of running a thread per connection.
+        The downloads (text, kept-alive and timed requests) are served by the loop, uploads, bidirectional tests and
+        pings still get a blocking thread each, like in the threads mode.
+        """
+        selector = selectors.DefaultSelector()  # epoll on Linux, kqueue on macOS
+        self.tcp_main_socket.listen()
+        self.tcp_main_socket.setblocking(False)
+        selector.register(self.tcp_main_socket, selectors.EVENT_READ, None)
+        # the session scheduler may admit a connection from another thread, it wakes the loop up through this socket pair
+        wakeup_reader, self.selectors_wakeup_socket = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        self.selectors_wakeup_socket.setblocking(False)
+        selector.register(wakeup_reader, selectors.EVENT_READ, "wakeup")
+        while True:
+            # wakes up for the next deadline (a timed download's end, an idle kept-alive connection), if there's one
+            timeout = max(0, self.tcp_deadlines[0][0] - time.time()) if len(self.tcp_deadlines) != 0 else None
+            for key, events in selector.select(timeout):  # blocking function, not busy-wait
+                try:
+                    if key.data is None:
+                        self.accept_tcp_connection(selector)
+                    elif key.data == "wakeup":
+                        self.start_admitted_tcp_connections(selector, wakeup_reader)
+                    elif events & selectors.EVENT_READ:
+                        self.read_tcp_request(selector, key.data)
+                    elif events & selectors.EVENT_WRITE:
+                        self.write_tcp_payload(selector, key.data)
+                except Exception as e:
+                    self.record_error(e)
+                    if key.data is None or key.data == "wakeup":
+                        self.print_colored(e, "red")
+                    else:
+                        self.close_tcp_connection(selector, key.data, e)
+            self.expire_tcp_deadlines(selector)
+
+    def accept_tcp_connection(self, selector):
+        try:
+            client_socket, client_address = self.tcp_main_socket.accept()
+        except BlockingIOError:
+            return  # the connection was already taken
+        client_socket.setblocking(False)
+        connection = TcpConnectionState(client_socket, client_address)
+        selector.register(client_socket, selectors.EVENT_READ, connection)
+
+    def read_tcp_request(self, selector, connection):
+        """Read the file size request, once it's complete, start waiting for the socket to be writable"""
+        data = connection.client_socket.recv(1024)
+        if not data:
+            if connection.request_data == b'':
+                if not connection.admitted:
+                    # a connect-latency probe from a client choosing a server, not a speed test
+                    self.metrics.inc("speedtest_probe_connections_total")  # add for server stats
+                self.close_tcp_connection(selector, connection)  # a kept-alive client is done
+                return
+            raise ConnectionResetError("Connection closed before the request was received")
+        connection.request_data += data
+        if connection.admitted:
+            self.read_next_tcp_request(selector, connection)
+            return
+        if connection.request_data.startswith(self.magic_cookie_bytes[:len(connection.request_data)]):
+            if len(connection.request_data) < self.request_size:
+                return  # wait for the rest of the request
+            _, message_type, file_size = struct.unpack_from(self.request_packet_format, connection.request_data)
+            if message_type not in (self.request_msg_type, self.timed_request_msg_type):
+                # an upload (or pings) is received by a blocking thread of its own, like in the threads mode
+                selector.unregister(connection.client_socket)
+                connection.client_socket.setblocking(True)
+                self.schedule_session_thread("tcp", connection.client_address, self.handle_binary_tcp_request,
+                                             (connection.client_socket, connection.client_address, connection.request_data),
+                                             reject=connection.client_socket.close)
+                return
+            self.prepare_tcp_download(connection, message_type, file_size)
+            connection.request_data = connection.request_data[self.request_size:]  # the start of the client's next request
+        else:
+            if b'\n' not in connection.request_data:
+                if len(connection.request_data) > 1024:
+                    raise InvalidRequestFormat(f"Invalid request from {connection.client_address}")
+                return  # wait for the rest of the request
+            connection.file_size = int(connection.request_data.decode().strip())
+            self.metrics.inc("speedtest_bytes_requested_total", connection.file_size, (("protocol", "tcp"),))  # add for server stats
+        # the socket isn't watched while the transfer waits for a slot, the loop starts writing once it's admitted
+        selector.unregister(connection.client_socket)
+        self.session_scheduler.submit(connection.client_address[0], "tcp", lambda: self.admit_tcp_connection(connection),
+                                      connection.client_socket.close)
+
+    def read_next_tcp_request(self, selector, connection):
+        """A kept-alive connection waits for the client's next download request, once it's complete the payload is sent"""
+        if len(connection.request_data) < self.request_size:
+            return  # wait for the rest of the request
+        magic_cookie, message_type, file_size = struct.unpack_from(self.request_packet_format, connection.request_data)
+        if magic_cookie != self.MAGIC_COOKIE:
+            raise InvalidRequestFormat(f"Invalid request from {connection.client_address}")
+        if message_type != self.request_msg_type:
+            raise InvalidRequestFormat(f"Invalid request from {connection.client_address}, only downloads can follow on a kept-alive connection")
+        self.prepare_tcp_download(connection, message_type, file_size)
+        connection.request_data = connection.request_data[self.request_size:]
+        connection.deadline = None  # not idle anymore
+        selector.modify(connection.client_socket, selectors.EVENT_WRITE, connection)
+
+    def prepare_tcp_download(self, connection, message_type, file_size):
+        """
+        Set up the connection's next binary download, its payload follows a response header.
+
+        Parameters:
+            connection: the connection's TcpConnectionState
+            message_type: request_msg_type (a kept-alive download) or timed_request_msg_type
+            file_size: the size the request asked for, or the duration in milliseconds of a timed request
+        """
+        if message_type == self.timed_request_msg_type:
+            connection.duration = self.get_test_duration(file_size)
+            connection.file_size = 1 << 62  # sent until the deadline
+            payload_size = 0  # unknown in advance
+        else:
+            connection.keepalive = True
+            connection.file_size = payload_size = file_size
+            self.metrics.inc("speedtest_bytes_requested_total", file_size, (("protocol", "tcp"),))  # add for server stats
+        self.metrics.inc("speedtest_tcp_transfers_total", 1, (("connection", "cold" if connection.transfers == 0 else "warm"),))  # add for server stats
+        connection.header = struct.pack(self.response_packet_format, self.MAGIC_COOKIE, self.response_msg_type, payload_size)
+        connection.total_sent = 0
+
+    def set_tcp_deadline(self, connection, deadline):
+        """The selectors loop wakes up at 'deadline' to end the connection's timed download, or close it if it's idle"""
+        connection.deadline = deadline
+        heapq.heappush(self.tcp_deadlines, (deadline, next(self.tcp_deadline_counter), connection))
+
+    def expire_tcp_deadlines(self, selector):
+        now = time.time()
+        while len(self.tcp_deadlines) != 0 and self.tcp_deadlines[0][0] <= now:
+            deadline, _, connection = heapq.heappop(self.tcp_deadlines)
+            if connection.deadline != deadline or connection.client_socket.fileno() == -1:
+                continue  # the connection got a new deadline, or was already closed
+            try:
+                if connection.duration is not None:
+                    self.end_timed_tcp_download(selector, connection)
+                else:
+                    self.close_tcp_connection(selector, connection)  # an idle kept-alive connection gives its session slot back
+            except Exception as e:
+                self.record_error(e)
+                self.close_tcp_connection(selector, connection, e)
+
+    def end_timed_tcp_download(self, selector, connection):
+        connection.client_socket.shutdown(socket.SHUT_WR)  # the client reads until the end of the stream
+        self.close_tcp_connection(selector, connection)
+
+    def admit_tcp_connection(self, connection):
+        """Called by the session scheduler (from any thread), the selectors loop starts the transfer when it wakes up"""
+        self.admitted_tcp_connections.append(connection)
+        try:
+            self.selectors_wakeup_socket.send(b'\0')
+        except BlockingIOError:
+            pass  # the wakeup socket is full, the loop will wake up anyway
+
+    def start_admitted_tcp_connections(self, selector, wakeup_reader):
+        try:
+            while wakeup_reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        while len(self.admitted_tcp_connections) != 0:
+            connection = self.admitted_tcp_connections.popleft()
+            connection.admitted = True
+            connection.start_time = self.start_session("tcp", connection.client_address)  # probes aren't counted as sessions
+            if connection.duration is not None:
+                self.set_tcp_deadline(connection, connection.start_time + connection.duration)
+            selector.register(connection.client_socket, selectors.EVENT_WRITE, connection)
+
+    def write_tcp_payload(self, selector, connection):
+        """
+        Send as much of the payload as the socket accepts without blocking. When the transfer is done, a kept-alive
+        connection waits for the next request and any other one is closed.
+        """
+        if connection.header != b'':
+            more_flag = getattr(socket, "MSG_MORE", 0)  # Linux, the header goes out in the same segment as the payload
+            try:
+                connection.header = connection.header[connection.client_socket.send(connection.header, more_flag):]
+            except BlockingIOError:
+                return  # the socket's send buffer is full, wait for the next write event
+            if connection.header != b'':
+                return
+        if connection.duration is not None and time.time() >= connection.deadline:
+            self.end_timed_tcp_download(selector, connection)
+            return
+        connection.total_sent += self.payload_engine.send_some(connection.client_socket, connection.total_sent, connection.file_size)
+        if connection.total_sent < connection.file_size:
+            return
+        if not connection.keepalive:
+            self.close_tcp_connection(selector, connection)
+            return
+        connection.transfers += 1
+        selector.modify(connection.client_socket, selectors.EVENT_READ, connection)
+        self.set_tcp_deadline(connection, time.time() + self.tcp_keepalive_timeout)
+        self.read_next_tcp_request(selector, connection)  # the client may have sent it already
+
+    def close_tcp_connection(self, selector, connection, error=None):
+        if error is not None:
+            if isinstance(error, (BrokenPipeError, ConnectionResetError)):
+                self.print_colored(f"TCP client {connection.client_address} cut the connection to the server", "red")
+            else:
+                self.print_colored(f"Error with TCP client {connection.client_address}: {error}", "red")
+        try:
+            selector.unregister(connection.client_socket)
+        except KeyError:
+            pass  # already unregistered, ex the hand-off of an upload to its thread failed
+        connection.client_socket.close()
+        if connection.admitted:  # the session started once the scheduler admitted it
+            self.end_session("tcp", connection.start_time)
+            self.session_scheduler.release(connection.client_address[0])
+
     def listen_for_UDP_requests(self):
         """A function that runs concurrent threads for each speed-test connection over UDP"""
         while True:
             try:
                 request_packet, client_address = self.udp_main_socket.recvfrom(1024)  # blocking function, not busy-wait
-                magic_cookie, message_type, file_size = struct.unpack(self.request_packet_format, request_packet)
-                if magic_cookie != self.MAGIC_COOKIE or message_type != self.request_msg_type:
+                magic_cookie, message_type = struct.unpack_from('>IB', request_packet)
+                if magic_cookie != self.MAGIC_COOKIE:
+                    raise InvalidRequestFormat(f"Invalid request from {client_address}")
+                if message_type == self.ping_msg_type:
+                    # latency probes don't start a session, the pong goes out of the main socket right away
+                    _, _, sequence, timestamp = struct.unpack(self.ping_packet_format, request_packet)
+                    self.udp_main_socket.sendto(struct.pack(self.ping_packet_format, self.MAGIC_COOKIE, self.pong_msg_type, sequence, timestamp), client_address)
+                    self.metrics.inc("speedtest_pings_total", 1, (("protocol", "udp"),))  # add for server stats
+                    continue
+                loss_threshold = None
+                if message_type in (self.request_msg_type, self.upload_msg_type, self.bidirectional_msg_type, self.timed_request_msg_type):
+                    _, _, file_size = struct.unpack(self.request_packet_format, request_packet)
+                elif message_type == self.adaptive_request_msg_type:
+                    _, _, file_size, loss_threshold = struct.unpack(self.adaptive_request_packet_format, request_packet)
+                    loss_threshold /= 100
+                else:
                     raise InvalidRequestFormat(f"Invalid request from {client_address}")
 
-                # Create a new UDP socket for the client
-                udp_client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                udp_client_socket.bind(('', 0))  # Dynamically assign port
-
-                self.num_of_udp_speed_tests += 1  # add for server stats
-                self.clients_udp_tests_list.add(client_address[0])  # add for server stats
-                self.overall_data_sent += file_size  # add for server stats
+                if message_type not in (self.upload_msg_type, self.timed_request_msg_type):  # no file size in these requests
+                    self.metrics.inc("speedtest_bytes_requested_total", file_size, (("protocol", "udp"),))  # add for server stats
 
-                threading.Thread(target=self.handle_udp_request, args=(file_size, client_address, udp_client_socket)).start()
+                # the client's socket and thread are only created once the scheduler admits the session
+                self.schedule_session_thread("udp", client_address, self.run_udp_session,
+                                             (message_type, file_size, client_address, loss_threshold), queue_timeout=self.udp_queue_timeout)
             except Exception as e:
+                self.record_error(e)
                 self.print_colored(e, "red")
 
+    def run_udp_session(self, message_type, file_size, client_address, loss_threshold):
+        # Create a new UDP socket for the client
+        udp_client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_client_socket.bind(('', 0))  # Dynamically assign port
+        if message_type in (self.upload_msg_type, self.bidirectional_msg_type):
+            self.handle_udp_upload(file_size, client_address, udp_client_socket, message_type == self.bidirectional_msg_type)
+        elif message_type == self.timed_request_msg_type:  # the 'file size' of a duration-based test is its duration in ms
+            self.handle_udp_request(0, client_address, udp_client_socket, duration=self.get_test_duration(file_size))
+        else:
+            self.handle_udp_request(file_size, client_address, udp_client_socket, loss_threshold)
+
+    def schedule_session_thread(self, protocol, client_address, target, args, reject=None, queue_timeout=None):
+        """
+        Run target(*args) on a thread of its own once the session scheduler admits it, and free its slot when it returns.
+
+        Parameters:
+            protocol: 'tcp' or 'udp'
+            client_address: the client's (ip, port), the scheduler limits and shares the slots per client IP
+            target: the session's function
+            args: the arguments of target
+            reject: called if the session is rejected (the queue is full or it waited too long). Optional
+            queue_timeout: seconds the session may wait for a slot. Optional, default is the scheduler's
+        """
+        def run_session():
+            try:
+                target(*args)
+            finally:
+                self.session_scheduler.release(client_address[0])
+                self.metrics.retire_shard()  # this thread is done
+
+        self.session_scheduler.submit(client_address[0], protocol, lambda: threading.Thread(target=run_session, args=()).start(),
+                                      reject, queue_timeout)
+
+    def start_workers(self, num_of_workers, tcp_mode="threads"):
+        """
+        Pre-fork worker processes that share the main TCP and UDP sockets with the server process, so the speed tests
+        run on all the cores instead of one. The server process keeps owning the advertised ports and broadcasting
+        offers, the kernel hands each connection / request datagram to one of the workers.
+        Each worker admits its sessions with its own SessionScheduler, so the session limits and the fair sharing between
+        the clients apply per worker, not to the whole server.
+
+        Parameters:
+            num_of_workers: number of worker processes to start
+            tcp_mode: 'threads' or 'selectors', the TCP server mode each worker runs
+
+        Returns False if the OS can't fork, in that case the caller should run the listeners in this process
+        """
+        try:
+            context = multiprocessing.get_context("fork")  # the workers inherit the listening sockets
+        except ValueError:
+            self.print_colored("Worker processes aren't supported on this OS, running a single process", "red")
+            return False
+        self.tcp_main_socket.listen()  # listen before forking, so all the workers share the same accept queue
+        self.workers_stop_event = context.Event()
+        self.workers_stats_queue = context.Queue()
+        for worker_id in range(num_of_workers):
+            worker = context.Process(target=self.run_worker, args=(worker_id, tcp_mode), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        # the workers' metrics are kept as remote shards of this process's registry, so they're scraped and summed live
+        self.workers_stats_thread = threading.Thread(target=self.receive_workers_metrics, args=(), daemon=True)
+        self.workers_stats_thread.start()
+        self.print_colored(f"Started {num_of_workers} worker processes", "green")
+        return True
+
+    def run_worker(self, worker_id, tcp_mode, report_interval=1):
+        """The main code of a worker process, runs the listeners and reports its metrics until the server asks it to stop"""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl C is handled by the server process
+        self.metrics.reset()
+        tcp_listener = self.listen_for_TCP_requests if tcp_mode == "threads" else self.listen_for_TCP_requests_selectors
+        threading.Thread(target=tcp_listener, args=(), daemon=True).start()
+        threading.Thread(target=self.listen_for_UDP_requests, args=(), daemon=True).start()
+        while not self.workers_stop_event.wait(report_interval):  # blocking function, not busy-wait
+            self.workers_stats_queue.put((worker_id, self.metrics.snapshot(), False))
+        self.workers_stats_queue.put((worker_id, self.metrics.snapshot(), True))  # final report
+
+    def receive_workers_metrics(self):
+        """Keep the latest metrics snapshot of each worker, until all of them sent their final report"""
+        running_workers = len(self.workers)
+        while running_workers > 0:
+            worker_id, snapshot, final = self.workers_stats_queue.get()  # blocking function, not busy-wait
+            self.metrics.set_remote_snapshot(worker_id, snapshot)
+            if final:
+                running_workers -= 1
+
+    def stop_workers(self, timeout=5):
+        """Stop the worker processes, their final metrics are added to the server stats"""
+        if len(self.workers) == 0:
+            return
+        self.workers_stop_event.set()
+        self.workers_stats_thread.join(timeout)
+        if self.workers_stats_thread.is_alive():
+            self.print_colored("A worker process didn't report its stats", "red")
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def describe_metrics(self):
+        self.metrics.describe("speedtest_broadcast_offers_total", "counter", "Offer messages broadcast")
+        self.metrics.describe("speedtest_sessions_total", "counter", "Speed test sessions started")
+        self.metrics.describe("speedtest_active_sessions", "gauge", "Speed test sessions running right now")
+        self.metrics.describe("speedtest_session_duration_seconds", "histogram", "Duration of finished speed test sessions")
+        self.metrics.describe("speedtest_bytes_requested_total", "counter", "Bytes requested by clients")
+        self.metrics.describe("speedtest_bytes_received_total", "counter", "Bytes uploaded by clients and received by the server")
+        self.metrics.describe("speedtest_bytes_sent_total", "counter", "Bytes actually sent to clients (including UDP headers)")
+        self.metrics.describe("speedtest_payload_cpu_seconds_total", "counter", "CPU time spent sending TCP payload")
+        self.metrics.describe("speedtest_tcp_transfers_total", "counter", "Binary-framed TCP downloads, by cold (first on the connection) or warm (kept alive)")
+        self.metrics.describe("speedtest_pings_total", "counter", "Latency probes answered with a pong")
+        self.metrics.describe("speedtest_probe_connections_total", "counter", "TCP connections closed without a request (client latency probes)")
+        self.metrics.describe("speedtest_udp_adaptive_tests_total", "counter", "Adaptive-rate UDP tests, by whether the rate settled")
+        self.metrics.describe("speedtest_queued_sessions", "gauge", "Speed test sessions waiting for a free slot")
+        self.metrics.describe("speedtest_session_queue_wait_seconds", "histogram", "Time admitted and timed out sessions waited for a slot")
+        self.metrics.describe("speedtest_sessions_rejected_total", "counter", "Sessions rejected because the queue was full or they waited too long")
+        self.metrics.describe("speedtest_errors_total", "counter", "Errors by exception type")
+        self.metrics.describe("speedtest_unique_clients_tcp", "gauge", "Unique client IPs that ran TCP speed tests")
+        self.metrics.describe("speedtest_unique_clients_udp", "gauge", "Unique client IPs that ran UDP speed tests")
+
+    def start_session(self, protocol, client_address):
+        """Count a new speed test session, returns its start time for end_session"""
+        labels = (("protocol", protocol),)
+        self.metrics.inc("speedtest_sessions_total", 1, labels)  # add for server stats
+        self.metrics.inc("speedtest_active_sessions", 1, labels)
+        self.metrics.add_to_set(f"speedtest_unique_clients_{protocol}", client_address[0])  # add for server stats
+        return time.time()
+
+    def end_session(self, protocol, start_time):
+        labels = (("protocol", protocol),)
+        self.metrics.inc("speedtest_active_sessions", -1, labels)
+        self.metrics.observe("speedtest_session_duration_seconds", time.time() - start_time, labels)
+
+    def record_error(self, error):
+        self.metrics.inc("speedtest_errors_total", 1, (("type", type(error).__name__),))
+
+    def start_metrics_server(self, port):
+        """Serve the server metrics as Prometheus text on http://127.0.0.1:port/metrics while the server runs"""
+        try:
+            self.metrics_http_server = start_metrics_http_server(self.metrics, port)
+            self.print_colored(f"Serving metrics on http://127.0.0.1:{port}/metrics", "green")
+        except OSError as e:
+            self.print_colored(f"Could not serve metrics on port {port}: {e}", "red")
+
     def get_server_stats(self):
         """A function to print some stats about the server after the user manually closes it"""
+        snapshot = self.metrics.snapshot()
+        num_of_tcp_speed_tests = self.metrics.get_total(snapshot, "speedtest_sessions_total", protocol="tcp")
+        num_of_udp_speed_tests = self.metrics.get_total(snapshot, "speedtest_sessions_total", protocol="udp")
+        clients_tcp_tests_list = snapshot["sets"].get("speedtest_unique_clients_tcp", set())
+        clients_udp_tests_list = snapshot["sets"].get("speedtest_unique_clients_udp", set())
+        tcp_data_sent = self.metrics.get_total(snapshot, "speedtest_bytes_sent_total", protocol="tcp")
+        payload_cpu_time = self.metrics.get_total(snapshot, "speedtest_payload_cpu_seconds_total")
+        errors = {labels[0][1]: value for (name, labels), value in snapshot["counters"].items() if name == "speedtest_errors_total"}
+
         self.print_colored("Server Statistics and information:", "background green")
-        print(f"Number of broadcast offer sent while running: {self.num_of_broadcast_offers_sent}")
-        print(f"Number of Speed Tests: {self.num_of_tcp_speed_tests+self.num_of_udp_speed_tests}")
-        print(f"Number of TCP Speed Tests: {self.num_of_tcp_speed_tests}")
-        print(f"Number of UDP Speed Tests: {self.num_of_udp_speed_tests}")
-        if len(self.clients_tcp_tests_list) != 0:
-            print(f"Unique clients that ran TCP speed tests: {self.clients_tcp_tests_list}")
-        if len(self.clients_udp_tests_list) != 0:
-            print(f"Unique clients that ran UDP speed tests: {self.clients_udp_tests_list}")
-        formatted_data_sent = self.overall_data_sent
+        print(f"Number of broadcast offer sent while running: {self.metrics.get_total(snapshot, 'speedtest_broadcast_offers_total')}")
+        print(f"Number of Speed Tests: {num_of_tcp_speed_tests+num_of_udp_speed_tests}")
+        print(f"Number of TCP Speed Tests: {num_of_tcp_speed_tests}")
+        print(f"Number of UDP Speed Tests: {num_of_udp_speed_tests}")
+        if len(clients_tcp_tests_list) != 0:
+            print(f"Unique clients that ran TCP speed tests: {clients_tcp_tests_list}")
+        if len(clients_udp_tests_list) != 0:
+            print(f"Unique clients that ran UDP speed tests: {clients_udp_tests_list}")
+        print(f"Overall requested data: {self.format_size(self.metrics.get_total(snapshot, 'speedtest_bytes_requested_total'))}")
+        print(f"Overall sent data: {self.format_size(self.metrics.get_total(snapshot, 'speedtest_bytes_sent_total'))}")
+        data_received = self.metrics.get_total(snapshot, "speedtest_bytes_received_total")
+        if data_received != 0:
+            print(f"Overall received (uploaded) data: {self.format_size(data_received)}")
+        if tcp_data_sent != 0 and payload_cpu_time != 0:
+            print(f"TCP payload sent per CPU-second ({self.payload_engine.send_method}): "
+                  f"{self.format_size(tcp_data_sent / payload_cpu_time)}")
+        pings = self.metrics.get_total(snapshot, "speedtest_pings_total")
+        if pings != 0:
+            print(f"Latency probes answered: {pings}")
+        warm_transfers = self.metrics.get_total(snapshot, "speedtest_tcp_transfers_total", connection="warm")
+        if warm_transfers != 0:
+            print(f"TCP transfers on kept-alive connections: {warm_transfers}")
+        sessions_rejected = self.metrics.get_total(snapshot, "speedtest_sessions_rejected_total")
+        if sessions_rejected != 0:
+            print(f"Sessions rejected while the server was busy: {sessions_rejected}")
+        if len(errors) != 0:
+            print(f"Errors by type: {errors}")
+
+    @staticmethod
+    def format_size(size):
+        """Format a number of bytes with the largest fitting unit, ex '1.5 GB'"""
         unit = "Bytes"
-        if formatted_data_sent >= 1073741824:  # 1GB
-            formatted_data_sent /= 1073741824
+        if size >= 1073741824:  # 1GB
+            size /= 1073741824
             unit = "GB"
-        elif formatted_data_sent >= 1048576:  # 1MB
-            formatted_data_sent /= 1048576
+        elif size >= 1048576:  # 1MB
+            size /= 1048576
             unit = "MB"
-        elif formatted_data_sent >= 1024:  # 1KB
-            formatted_data_sent /= 1024
+        elif size >= 1024:  # 1KB
+            size /= 1024
             unit = "KB"
-        print(f"Overall sent data: {round(formatted_data_sent, 1)} {unit}")
+        return f"{round(size, 1)} {unit}"
 
     @staticmethod
     def get_server_ip():
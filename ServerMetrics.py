@@ -0,0 +1,188 @@
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# upper bounds of the session duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class MetricsShard:
+    """The metrics written by a single thread. Only the owning thread writes to it, so the hot path takes no locks"""
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value, gauges are counters that also go down
+        self.histograms = {}  # (name, labels) -> [count per bucket (+inf last), sum, count]
+        self.sets = {}  # name -> set of unique values
+
+
+class MetricsRegistry:
+    """
+    Server metrics (counters, gauges, histograms and unique-value sets) with a shard per writing thread.
+    The shards are only added up when the metrics are read (stats / scrape), and worker processes send their
+    snapshots in as remote shards.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()  # taken once per thread, when its shard is created / retired
+        self.retired = {"counters": {}, "histograms": {}, "sets": {}}  # the metrics of threads that already finished
+        self.remote_snapshots = {}  # worker id -> the latest snapshot of the worker
+        self.descriptions = {}  # name -> (type, help text)
+
+    def reset(self):
+        """Drop all the metrics, used by forked worker processes so they don't report the parent's metrics again"""
+        with self.shards_lock:
+            self.shards = []
+            self.retired = {"counters": {}, "histograms": {}, "sets": {}}
+        self.local = threading.local()
+        self.remote_snapshots = {}
+
+    def describe(self, name, metric_type, help_text):
+        self.descriptions[name] = (metric_type, help_text)
+
+    def get_shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = MetricsShard()
+            with self.shards_lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def retire_shard(self):
+        """
+        Fold the calling thread's shard into the retired metrics, called by short-lived (per session) threads
+        before they exit, so the number of shards doesn't grow with every connection the server ever had
+        """
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            return
+        with self.shards_lock:
+            self.shards.remove(shard)
+            self.add_up(self.retired, [(shard.counters, shard.histograms, shard.sets)])
+        del self.local.shard
+
+    def inc(self, name, value=1, labels=()):
+        """
+        Add 'value' to a counter (or a gauge, with a negative value to decrease it).
+
+        Parameters:
+            name: the metric name
+            value: the amount to add
+            labels: tuple of (label name, label value) pairs
+        """
+        counters = self.get_shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """Add a value (ex a session duration in seconds) to a histogram"""
+        histograms = self.get_shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(DURATION_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def add_to_set(self, name, value):
+        """Add a value to a set of unique values (ex client IPs)"""
+        self.get_shard().sets.setdefault(name, set()).add(value)
+
+    def set_remote_snapshot(self, worker_id, snapshot):
+        """Replace the metrics reported by a worker process with its latest snapshot"""
+        self.remote_snapshots[worker_id] = snapshot
+
+    def snapshot(self, include_remote=True):
+        """Add up all the shards, returns a dict that can be sent between processes"""
+        with self.shards_lock:
+            shards = list(self.shards)
+            result = self.add_up({"counters": {}, "histograms": {}, "sets": {}},
+                                 [(self.retired["counters"], self.retired["histograms"], self.retired["sets"])])
+        parts = [(dict(shard.counters), dict(shard.histograms), dict(shard.sets)) for shard in shards]  # copied atomically
+        if include_remote:
+            parts += [(remote["counters"], remote["histograms"], remote["sets"]) for remote in list(self.remote_snapshots.values())]
+        return self.add_up(result, parts)
+
+    @staticmethod
+    def add_up(result, parts):
+        """Add (counters, histograms, sets) parts into a snapshot dict"""
+        counters, histograms, sets = result["counters"], result["histograms"], result["sets"]
+        for part_counters, part_histograms, part_sets in parts:
+            for key, value in part_counters.items():
+                counters[key] = counters.get(key, 0) + value
+            for key, (buckets, total, count) in part_histograms.items():
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+            for name, values in part_sets.items():
+                sets.setdefault(name, set()).update(set(values))
+        return result
+
+    @staticmethod
+    def get_total(snapshot, name, **labels):
+        """The sum of a counter over all its labels, or only over the ones that match 'labels'"""
+        total = 0
+        for (metric_name, metric_labels), value in snapshot["counters"].items():
+            if metric_name == name and all((key, value) in metric_labels for key, value in labels.items()):
+                total += value
+        return total
+
+    def to_prometheus_text(self):
+        """Format all the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def add_description(name):
+            if name not in described and name in self.descriptions:
+                metric_type, help_text = self.descriptions[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                described.add(name)
+
+        def format_labels(labels):
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            add_description(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(snapshot["histograms"].items()):
+            add_description(name)
+            cumulative = 0
+            for upper_bound, bucket_count in zip(DURATION_BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', upper_bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for name, values in sorted(snapshot["sets"].items()):
+            add_description(name)
+            lines.append(f"{name} {len(values)}")
+        return "\n".join(lines) + "\n"
+
+
+def start_metrics_http_server(registry, port, host="127.0.0.1"):
+    """Serve the registry's metrics as Prometheus text on http://host:port/metrics, in a daemon thread"""
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.to_prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # don't mix scrape logs into the server output
+
+    http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, args=(), daemon=True).start()
+    return http_server
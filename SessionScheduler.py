@@ -0,0 +1,188 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+
+class QueuedSession:
+    """A session waiting for a free slot"""
+    def __init__(self, protocol, start, reject, deadline):
+        self.protocol = protocol
+        self.start = start  # called once the session is admitted
+        self.reject = reject  # called if the session is dropped from the queue, optional
+        self.queued_time = time.time()
+        self.deadline = deadline  # the session is rejected if it's still waiting by then
+
+
+class SessionScheduler:
+    """
+    Admission control for the speed test sessions: at most 'max_sessions' run at the same time and at most
+    'max_sessions_per_client' of them for a single client IP. The sessions over the limits wait in a bounded queue,
+    one FIFO per client, and a freed slot goes to the waiting client with the fewest running sessions (round-robin
+    between equal clients). So a client that asks for 100 connections doesn't starve the others, each client gets an
+    equal share of the slots (and of the bandwidth), and the server never runs more sessions than it can serve.
+    """
+    def __init__(self, max_sessions=None, max_sessions_per_client=None, max_queued_sessions=1024, queue_timeout=10, metrics=None):
+        """
+        Parameters:
+            max_sessions: the maximum number of sessions running at the same time, None == no limit
+            max_sessions_per_client: the maximum number of running sessions of a single client IP, None == no limit
+            max_queued_sessions: the maximum number of waiting sessions, the following ones are rejected
+            queue_timeout: default seconds a session may wait before it's rejected
+            metrics: a MetricsRegistry to count the queued and rejected sessions in. Optional
+        """
+        self.max_sessions = max_sessions
+        self.max_sessions_per_client = max_sessions_per_client
+        self.max_queued_sessions = max_queued_sessions
+        self.queue_timeout = queue_timeout
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.active_sessions = 0
+        self.active_per_client = {}  # client ip -> number of running sessions
+        self.waiting = OrderedDict()  # client ip -> deque of QueuedSession, in round-robin order
+        self.queued_sessions = 0
+        # rejects the sessions that waited too long, also when no session arrives or ends to notice it
+        self.expiry_timer = None
+        self.expiry_deadline = None
+
+    def submit(self, client_ip, protocol, start, reject=None, queue_timeout=None):
+        """
+        Start a session now if there's a free slot for it, otherwise queue it. 'start' is called (without arguments)
+        when the session is admitted, the session must call release() when it ends.
+
+        Parameters:
+            client_ip: the IP of the client that asked for the session
+            protocol: 'tcp' or 'udp', for the metrics
+            start: starts the session, called from the submitting thread or from the thread of a releasing session
+            reject: called if the session can't run (the queue is full or it waited too long). Optional
+            queue_timeout: seconds this session may wait. Optional, default is the scheduler's queue_timeout
+
+        Returns True if the session was started or queued, False if it was rejected
+        """
+        with self.lock:
+            expired = self.remove_expired(time.time())
+            if self.can_start(client_ip) and client_ip not in self.waiting:  # don't overtake the client's queued sessions
+                self.add_active(client_ip)
+                admitted = True
+            elif self.queued_sessions < self.max_queued_sessions:
+                timeout = self.queue_timeout if queue_timeout is None else queue_timeout
+                self.waiting.setdefault(client_ip, deque()).append(QueuedSession(protocol, start, reject, time.time() + timeout))
+                self.queued_sessions += 1
+                self.schedule_expiry(time.time() + timeout)
+                admitted = None
+            else:
+                admitted = False
+        self.reject_sessions(expired, "timeout")
+        if admitted:
+            start()
+        elif admitted is None:
+            self.update_queue_metrics(1)
+        else:
+            self.reject_sessions([QueuedSession(protocol, start, reject, 0)], "queue_full")
+        return admitted is not False
+
+    def release(self, client_ip):
+        """A session of client_ip ended, admit the next waiting sessions that fit"""
+        admitted = []
+        with self.lock:
+            self.active_sessions -= 1
+            self.active_per_client[client_ip] -= 1
+            if self.active_per_client[client_ip] == 0:
+                del self.active_per_client[client_ip]
+            now = time.time()
+            expired = self.remove_expired(now)
+            while True:
+                session = self.next_waiting_session()
+                if session is None:
+                    break
+                admitted.append(session)
+        self.reject_sessions(expired, "timeout")
+        for session in admitted:
+            self.update_queue_metrics(-1, now - session.queued_time)
+            session.start()
+
+    def can_start(self, client_ip):
+        if self.max_sessions is not None and self.active_sessions >= self.max_sessions:
+            return False
+        return self.max_sessions_per_client is None or self.active_per_client.get(client_ip, 0) < self.max_sessions_per_client
+
+    def add_active(self, client_ip):
+        self.active_sessions += 1
+        self.active_per_client[client_ip] = self.active_per_client.get(client_ip, 0) + 1
+
+    def next_waiting_session(self):
+        """Pop the session to admit next and mark it as running, None if none can start. Called with the lock held"""
+        chosen_ip = None
+        for client_ip in self.waiting:  # the waiting client with the fewest running sessions, the first in order on a tie
+            if self.can_start(client_ip) and (chosen_ip is None or
+                                              self.active_per_client.get(client_ip, 0) < self.active_per_client.get(chosen_ip, 0)):
+                chosen_ip = client_ip
+        if chosen_ip is None:
+            return None
+        sessions = self.waiting[chosen_ip]
+        session = sessions.popleft()
+        if len(sessions) == 0:
+            del self.waiting[chosen_ip]
+        else:
+            self.waiting.move_to_end(chosen_ip)  # the other clients go first on the next tie
+        self.queued_sessions -= 1
+        self.add_active(chosen_ip)
+        return session
+
+    def remove_expired(self, now):
+        """Remove the waiting sessions whose deadline passed, returns them. Called with the lock held"""
+        if self.queued_sessions == 0:
+            return []
+        expired = []
+        for client_ip in list(self.waiting):
+            sessions = self.waiting[client_ip]
+            if any(session.deadline <= now for session in sessions):
+                expired.extend(session for session in sessions if session.deadline <= now)
+                sessions = deque(session for session in sessions if session.deadline > now)
+                if len(sessions) == 0:
+                    del self.waiting[client_ip]
+                else:
+                    self.waiting[client_ip] = sessions
+        self.queued_sessions -= len(expired)
+        return expired
+
+    def schedule_expiry(self, deadline):
+        """Make sure the expiry timer fires by 'deadline'. Called with the lock held"""
+        if self.expiry_timer is not None and self.expiry_deadline <= deadline:
+            return  # it fires earlier and re-arms itself for the next deadline
+        if self.expiry_timer is not None:
+            self.expiry_timer.cancel()
+        self.expiry_deadline = deadline
+        self.expiry_timer = threading.Timer(max(0.0, deadline - time.time()), self.expire_waiting_sessions)
+        self.expiry_timer.daemon = True
+        self.expiry_timer.start()
+
+    def expire_waiting_sessions(self):
+        """The expiry timer's function, rejects the sessions whose deadline passed and re-arms for the next one"""
+        try:
+            with self.lock:
+                if self.expiry_timer is threading.current_thread():
+                    self.expiry_timer = None
+                expired = self.remove_expired(time.time())
+                next_deadline = min((session.deadline for sessions in self.waiting.values() for session in sessions), default=None)
+                if next_deadline is not None:
+                    self.schedule_expiry(next_deadline)
+            self.reject_sessions(expired, "timeout")
+        finally:
+            if self.metrics is not None:
+                self.metrics.retire_shard()  # this thread is done
+
+    def reject_sessions(self, sessions, reason):
+        for session in sessions:
+            if self.metrics is not None:
+                if reason == "timeout":
+                    self.update_queue_metrics(-1, time.time() - session.queued_time)
+                self.metrics.inc("speedtest_sessions_rejected_total", 1, (("protocol", session.protocol), ("reason", reason)))  # add for server stats
+            if session.reject is not None:
+                session.reject()
+
+    def update_queue_metrics(self, change, wait_time=None):
+        if self.metrics is None:
+            return
+        self.metrics.inc("speedtest_queued_sessions", change)
+        if wait_time is not None:
+            self.metrics.observe("speedtest_session_queue_wait_seconds", wait_time)
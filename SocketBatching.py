@@ -0,0 +1,226 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import select
+import socket
+import struct
+import time
+
+# a small ctypes shim for the Linux sendmmsg()/recvmmsg() syscalls, which send/receive many datagrams with a single call.
+# on other systems (or if libc can't be loaded) SENDMMSG_AVAILABLE/RECVMMSG_AVAILABLE are False and callers use
+# plain send()/recv_into() loops
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def load_libc():
+    if platform.system() != "Linux":
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+    except OSError:
+        return None
+
+
+LIBC = load_libc()
+SENDMMSG_AVAILABLE = LIBC is not None and hasattr(LIBC, "sendmmsg")
+if SENDMMSG_AVAILABLE:
+    LIBC.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    LIBC.sendmmsg.restype = ctypes.c_int
+
+RECVMMSG_AVAILABLE = LIBC is not None and hasattr(LIBC, "recvmmsg") and hasattr(select, "poll")
+if RECVMMSG_AVAILABLE:
+    LIBC.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    LIBC.recvmmsg.restype = ctypes.c_int
+
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = getattr(socket, "MSG_TRUNC", 0x20)  # set in msg_flags when a datagram didn't fit its buffer
+MAX_DATAGRAM_SIZE = 65535
+DEFAULT_MESSAGE_SIZE = 2048  # fits a 1024 bytes segment and its header with room to spare, larger datagrams grow the slots
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)  # kernel receive timestamps, as a control message
+CMSG_HEADER_SIZE = struct.calcsize("@NiiP") - struct.calcsize("@P")  # cmsg_len, cmsg_level, cmsg_type + alignment
+TIMESPEC_FORMAT = "@qq"  # tv_sec, tv_nsec
+CONTROL_SIZE = CMSG_HEADER_SIZE + 2 * struct.calcsize(TIMESPEC_FORMAT)  # room for the timestamp with padding
+
+# errors that mean the socket buffer is full for a moment, the batch should be retried
+RETRY_ERRORS = {errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS, errno.EINTR}
+
+
+def buffer_address(buffer):
+    """The memory address of a bytearray, so iovecs can point into it without copying"""
+    return ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer))
+
+
+class SendmmsgBatch:
+    """
+    A batch of datagrams for a connected UDP socket, each one made of its own header and a shared payload,
+    that are sent with a single sendmmsg() call. The headers live in one bytearray so callers can patch them
+    in place between batches.
+    """
+    def __init__(self, headers, header_size, payload, batch_size, payload_size=None):
+        """
+        Parameters:
+            headers: bytearray of batch_size * header_size bytes, the header of datagram i starts at i * header_size
+            header_size: the size of a single header
+            payload: bytearray with the payload that follows each header (shared, not copied)
+            batch_size: the max number of datagrams in a batch
+            payload_size: the payload bytes of each datagram. Optional, default is the whole payload buffer
+        """
+        self.headers = headers
+        self.payload = payload
+        self.batch_size = batch_size
+        self.iovecs = (iovec * (2 * batch_size))()
+        self.messages = (mmsghdr * batch_size)()
+        headers_address = buffer_address(headers)
+        self.payload_address = buffer_address(payload)
+        for i in range(batch_size):
+            self.iovecs[2 * i].iov_base = headers_address + i * header_size
+            self.iovecs[2 * i].iov_len = header_size
+            self.iovecs[2 * i + 1].iov_base = self.payload_address
+            self.iovecs[2 * i + 1].iov_len = len(payload) if payload_size is None else payload_size
+            self.messages[i].msg_hdr.msg_iov = ctypes.cast(ctypes.byref(self.iovecs, 2 * i * ctypes.sizeof(iovec)), ctypes.POINTER(iovec))
+            self.messages[i].msg_hdr.msg_iovlen = 2
+
+    def set_payload_offset(self, index, offset):
+        """Point the payload of datagram 'index' at payload[offset:offset + payload_size], for per-datagram payloads"""
+        self.iovecs[2 * index + 1].iov_base = self.payload_address + offset
+
+    def send(self, sock, count):
+        """Send the first 'count' datagrams of the batch, blocks until the socket accepted all of them"""
+        fd = sock.fileno()
+        sent = 0
+        while sent < count:
+            result = LIBC.sendmmsg(fd, ctypes.addressof(self.messages) + sent * ctypes.sizeof(mmsghdr), count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err in RETRY_ERRORS:
+                    time.sleep(0)  # give the NIC a moment to drain the socket buffer
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += result
+
+
+class DatagramReceiver:
+    """
+    Receives datagrams into preallocated buffers, no new bytes objects per datagram. On Linux up to batch_size
+    datagrams are read with a single recvmmsg() call, each one with its kernel receive timestamp.
+    Elsewhere it reads one datagram per call with recv_into().
+    The buffer slots are sized for the expected datagrams, not for the largest possible one (64 KB * batch_size per
+    receiver adds up to gigabytes with a thousand transfers). A datagram that didn't fit is truncated (its header is
+    still read) and the slots are doubled before the next receive() call.
+    """
+    def __init__(self, sock, message_size=DEFAULT_MESSAGE_SIZE, batch_size=64):
+        """
+        Parameters:
+            sock: the UDP socket to receive from
+            message_size: the expected max size of a single datagram
+            batch_size: the max number of datagrams returned by a single receive() call
+        """
+        self.sock = sock
+        self.batch_size = batch_size if RECVMMSG_AVAILABLE else 1
+        self.lengths = [0] * self.batch_size
+        self.timestamps = [0.0] * self.batch_size
+        self.kernel_timestamps = False
+        if RECVMMSG_AVAILABLE:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                self.kernel_timestamps = True
+            except OSError:
+                pass
+            self.control = bytearray(CONTROL_SIZE * self.batch_size)
+            self.iovecs = (iovec * self.batch_size)()
+            self.messages = (mmsghdr * self.batch_size)()
+            control_address = buffer_address(self.control)
+            for i in range(self.batch_size):
+                self.messages[i].msg_hdr.msg_iov = ctypes.cast(ctypes.byref(self.iovecs, i * ctypes.sizeof(iovec)), ctypes.POINTER(iovec))
+                self.messages[i].msg_hdr.msg_iovlen = 1
+                if self.kernel_timestamps:
+                    self.messages[i].msg_hdr.msg_control = control_address + i * CONTROL_SIZE
+            self.poller = select.poll()
+            self.poller.register(sock.fileno(), select.POLLIN)
+        else:
+            message_size = MAX_DATAGRAM_SIZE  # a single slot, it can fit any datagram
+        self.truncated = 0  # datagrams that didn't fit their slot
+        self.grow = False  # grow the slots before the next receive
+        self.allocate(message_size)
+
+    def allocate(self, message_size):
+        """(Re)allocate the buffer slots, the previous batch's data is gone"""
+        self.message_size = message_size
+        self.buffers = bytearray(message_size * self.batch_size)  # datagram i starts at i * message_size
+        if RECVMMSG_AVAILABLE:
+            buffers_address = buffer_address(self.buffers)
+            for i in range(self.batch_size):
+                self.iovecs[i].iov_base = buffers_address + i * message_size
+                self.iovecs[i].iov_len = message_size
+
+    def receive(self, timeout):
+        """
+        Wait up to 'timeout' seconds for datagrams and read them into the buffers.
+        Returns the number of datagrams read, 0 on timeout. Datagram i is
+        self.buffers[i * self.message_size: i * self.message_size + self.lengths[i]], it arrived at self.timestamps[i]
+        """
+        if not RECVMMSG_AVAILABLE:
+            self.sock.settimeout(timeout)
+            try:
+                self.lengths[0] = self.sock.recv_into(self.buffers)  # blocking function, not busy-wait
+            except socket.timeout:
+                return 0
+            self.timestamps[0] = time.time()
+            return 1
+
+        if self.grow:  # the caller is done with the batch that had the truncated datagrams
+            self.grow = False
+            self.allocate(min(2 * self.message_size, MAX_DATAGRAM_SIZE))
+        while True:
+            if not self.poller.poll(timeout * 1000):  # blocking function, not busy-wait
+                return 0
+            if self.kernel_timestamps:
+                for i in range(self.batch_size):  # the kernel overwrites the control length on each call
+                    self.messages[i].msg_hdr.msg_controllen = CONTROL_SIZE
+            count = LIBC.recvmmsg(self.sock.fileno(), ctypes.addressof(self.messages), self.batch_size, MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in RETRY_ERRORS:
+                    continue
+                raise OSError(err, os.strerror(err))
+            now = time.time()
+            for i in range(count):
+                self.lengths[i] = self.messages[i].msg_len
+                self.timestamps[i] = self.get_kernel_timestamp(i) if self.kernel_timestamps else now
+                if self.messages[i].msg_hdr.msg_flags & MSG_TRUNC:
+                    self.truncated += 1
+                    self.grow = self.message_size < MAX_DATAGRAM_SIZE
+            return count
+
+    def is_truncated(self, index):
+        """True if datagram 'index' of the last batch didn't fit its slot, only its first message_size bytes were read"""
+        return RECVMMSG_AVAILABLE and bool(self.messages[index].msg_hdr.msg_flags & MSG_TRUNC)
+
+    def get_kernel_timestamp(self, index):
+        """The receive time of datagram 'index' from its SO_TIMESTAMPNS control message (same clock as time.time())"""
+        offset = index * CONTROL_SIZE
+        if self.messages[index].msg_hdr.msg_controllen < CMSG_HEADER_SIZE:
+            return time.time()
+        tv_sec, tv_nsec = struct.unpack_from(TIMESPEC_FORMAT, self.control, offset + CMSG_HEADER_SIZE)
+        return tv_sec + tv_nsec / 1e9
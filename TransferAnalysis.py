@@ -0,0 +1,273 @@
+import re
+import math
+
+
+class UdpLossAnalyzer:
+    """
+    Tracks the segments received in a UDP transfer in a compact bitmap (1 bit per segment, sized from the total
+    segments in the header), so duplicates aren't counted twice and gaps / reordering can be measured.
+    A duration-based stream has 0 total segments in its headers, its bitmap grows with the segments and the total
+    comes from the end-of-stream marker (end_stream()).
+    """
+    def __init__(self, warmup=0.0):
+        """
+        Parameters:
+            warmup: the segments that arrive in the first 'warmup' seconds after the first segment are the warm-up of a
+                duration-based test, their bytes are counted apart. Optional
+        """
+        self.total_segments = None
+        self.open_ended = False  # the total segments is only known once the stream ends
+        self.bitmap = None
+        self.segments_received = 0  # including duplicates
+        self.unique_segments = 0
+        self.duplicates = 0
+        self.highest_segment = -1
+        self.reordered = 0  # segments that arrived after a segment with a higher number
+        self.max_reorder_depth = 0  # how far back (in segments) the latest reordered segment was
+        # inter-arrival jitter, smoothed like RFC 3550 over the variation between consecutive inter-arrival gaps
+        self.jitter = 0.0
+        self.first_arrival_time = None
+        self.last_arrival_time = None
+        self.last_gap = None
+        self.warmup = warmup
+        self.warmup_end = 0.0  # set by the first segment, the stream may have waited for a session slot on the server
+        self.unique_bytes = 0  # payload bytes of the unique segments, when add_segment() is given their size
+        self.warmup_bytes = 0  # the part of unique_bytes that arrived before warmup_end
+
+    def add_segment(self, segment, total_segments, arrival_time, size=0):
+        """
+        Record a received segment.
+
+        Parameters:
+            segment: the current segment number from the payload header
+            total_segments: the total segments from the payload header, 0 for a duration-based stream
+            arrival_time: when the segment arrived, in seconds (any clock, only differences are used)
+            size: the segment's payload size in bytes. Optional
+        """
+        if self.bitmap is None:
+            self.warmup_end = arrival_time + self.warmup
+            self.open_ended = total_segments == 0
+            self.total_segments = total_segments
+            self.bitmap = bytearray((total_segments + 7) // 8)
+            if total_segments % 8 != 0:  # mark the padding bits of the last byte as received
+                self.bitmap[-1] = 0xFF ^ ((1 << (total_segments % 8)) - 1)
+        if self.open_ended:
+            if segment >= len(self.bitmap) * 8:
+                self.bitmap.extend(bytes((segment >> 3) + 1 - len(self.bitmap)))  # amortized, like a list append
+        elif segment >= self.total_segments:
+            return  # not a part of this transfer
+        self.segments_received += 1
+
+        byte_index, bit = segment >> 3, 1 << (segment & 7)
+        if self.bitmap[byte_index] & bit:
+            self.duplicates += 1
+        else:
+            self.bitmap[byte_index] |= bit
+            self.unique_segments += 1
+            self.unique_bytes += size
+            if arrival_time < self.warmup_end:
+                self.warmup_bytes += size
+
+        if segment < self.highest_segment:
+            self.reordered += 1
+            self.max_reorder_depth = max(self.max_reorder_depth, self.highest_segment - segment)
+        else:
+            self.highest_segment = segment
+
+        if self.last_arrival_time is None:
+            self.first_arrival_time = arrival_time
+        else:
+            gap = arrival_time - self.last_arrival_time
+            if self.last_gap is not None:
+                self.jitter += (abs(gap - self.last_gap) - self.jitter) / 16
+            self.last_gap = gap
+        self.last_arrival_time = arrival_time
+
+    def end_stream(self, total_segments):
+        """The end-of-stream marker arrived with the number of segments the sender sent, the total of an open-ended stream"""
+        if not self.open_ended:
+            return
+        self.open_ended = False
+        self.total_segments = total_segments
+        self.bitmap = self.bitmap[:(total_segments + 7) // 8]  # later segments (none, unless the marker lies) aren't counted
+        self.bitmap.extend(bytes((total_segments + 7) // 8 - len(self.bitmap)))
+        if total_segments % 8 != 0:  # mark the padding bits of the last byte as received
+            self.bitmap[-1] |= 0xFF ^ ((1 << (total_segments % 8)) - 1)
+
+    def get_loss_bursts(self):
+        """The lengths of the runs of consecutive lost segments"""
+        bursts = []
+        run = 0
+        previous_end = 0
+        # only the bytes with a missing segment need to be checked bit by bit, full bytes are skipped by the regex engine
+        for match in re.finditer(rb'[^\xff]+', self.bitmap):
+            if match.start() != previous_end and run != 0:  # a fully received byte ends the run
+                bursts.append(run)
+                run = 0
+            for byte in self.bitmap[match.start():match.end()]:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        if run != 0:
+                            bursts.append(run)
+                            run = 0
+                    else:
+                        run += 1
+            previous_end = match.end()
+        if run != 0:
+            bursts.append(run)
+        return bursts
+
+    def get_report(self):
+        """A summary of the transfer, returns None if no segment was received"""
+        if self.bitmap is None:
+            return None
+        if self.open_ended:  # the end-of-stream marker was lost, the stream ended with the last segment that arrived
+            self.end_stream(self.highest_segment + 1)
+        bursts = self.get_loss_bursts()
+        lost = self.total_segments - self.unique_segments
+        return {
+            "total_segments": self.total_segments,
+            "segments_received": self.segments_received,
+            "unique_segments": self.unique_segments,
+            "lost_segments": lost,
+            "loss_percent": lost / self.total_segments * 100 if self.total_segments else 0,
+            "duplicates": self.duplicates,
+            "reordered": self.reordered,
+            "max_reorder_depth": self.max_reorder_depth,
+            "loss_bursts": len(bursts),
+            "max_loss_burst": max(bursts, default=0),
+            "mean_loss_burst": sum(bursts) / len(bursts) if bursts else 0,
+            "jitter_ms": self.jitter * 1000,
+        }
+
+
+class ThroughputSampler:
+    """
+    Counts the bytes received in fixed time intervals (from the first byte), so besides the average speed a transfer can
+    report its time to first byte, how long the TCP slow-start ramp took and the steady-state speed
+    """
+    def __init__(self, interval=0.1):
+        """
+        Parameters:
+            interval: the length of each sample in seconds
+        """
+        self.interval = interval
+        self.samples = []  # bytes received in each interval
+        self.total_bytes = 0
+        self.request_time = None
+        self.first_byte_time = None
+        self.last_byte_time = None
+        self.warmup = 0
+        self.warmup_end = 0.0
+        self.warmup_bytes = 0  # received before warmup_end, not a part of a duration-based test's rate
+
+    def start(self, now, warmup=0):
+        """
+        Mark the time the request was sent. The bytes received in the 'warmup' seconds after the first byte are counted
+        apart, the server may start sending late (ex the session waited for a slot)
+        """
+        self.request_time = now
+        self.warmup = warmup
+        self.warmup_end = now + warmup  # until the first byte arrives
+
+    def add(self, num_bytes, now):
+        """Record 'num_bytes' that were received at 'now' (seconds, same clock as start())"""
+        if self.first_byte_time is None:
+            self.first_byte_time = now
+            self.warmup_end = now + self.warmup
+        if now < self.warmup_end:
+            self.warmup_bytes += num_bytes
+        index = int((now - self.first_byte_time) / self.interval)
+        while len(self.samples) <= index:
+            self.samples.append(0)
+        self.samples[index] += num_bytes
+        self.total_bytes += num_bytes
+        self.last_byte_time = now
+
+    def get_interval_speeds(self):
+        """The speed of each full interval in bits/second (the last interval is partial and left out)"""
+        return [num_bytes * 8 / self.interval for num_bytes in self.samples[:-1]]
+
+    def get_report(self):
+        """A summary of the transfer, returns None if no data was received"""
+        if self.first_byte_time is None:
+            return None
+        speeds = self.get_interval_speeds()
+        if len(speeds) == 0:  # the whole transfer took less than one interval
+            transfer_time = self.last_byte_time - self.first_byte_time
+            if transfer_time <= 0:  # all the data arrived in a single read
+                transfer_time = self.last_byte_time - self.request_time
+            steady_state_speed = self.total_bytes * 8 / transfer_time if transfer_time > 0 else 0
+            ramp_time = 0
+        else:
+            # the steady state is the median speed of the second half of the transfer, the ramp ends once 90% of it is reached
+            second_half = sorted(speeds[len(speeds) // 2:])
+            steady_state_speed = second_half[len(second_half) // 2]
+            ramp_intervals = next((i for i, speed in enumerate(speeds) if speed >= 0.9 * steady_state_speed), 0)
+            ramp_time = ramp_intervals * self.interval
+        return {
+            "time_to_first_byte": self.first_byte_time - self.request_time,
+            "ramp_time": ramp_time,
+            "steady_state_speed": steady_state_speed,
+            "interval_speeds": speeds,
+        }
+
+
+class LatencyHistogram:
+    """
+    Round-trip times in log-spaced buckets, each bucket 'precision' wider than the previous one. The memory is fixed
+    however many values are added (ex probes during a long transfer), and the percentiles are within 'precision' of
+    the exact ones.
+    """
+    def __init__(self, min_value=1e-6, max_value=100, precision=0.02):
+        """
+        Parameters:
+            min_value: the upper bound of the first bucket in seconds, smaller values are counted in it
+            max_value: larger values (in seconds) are counted in the last bucket
+            precision: the relative width of a bucket
+        """
+        self.min_value = min_value
+        self.log_growth = math.log(1 + precision)
+        self.counts = [0] * (int(math.log(max_value / min_value) / self.log_growth) + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """Record a value in seconds"""
+        if value <= self.min_value:
+            index = 0
+        else:
+            index = min(int(math.log(value / self.min_value) / self.log_growth) + 1, len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def get_percentile(self, percentile):
+        """The value under which 'percentile' percent of the values fall, in seconds (the geometric middle of its bucket)"""
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                value = self.min_value * math.exp((index - 0.5) * self.log_growth) if index != 0 else self.min_value
+                return min(max(value, self.min), self.max)  # the exact min/max are known, don't report past them
+        return self.max
+
+    def get_report(self):
+        """A summary in milliseconds, returns None if no value was added"""
+        if self.count == 0:
+            return None
+        return {
+            "rtt_count": self.count,
+            "rtt_min_ms": self.min * 1000,
+            "rtt_mean_ms": self.total / self.count * 1000,
+            "rtt_p50_ms": self.get_percentile(50) * 1000,
+            "rtt_p90_ms": self.get_percentile(90) * 1000,
+            "rtt_p99_ms": self.get_percentile(99) * 1000,
+            "rtt_p99_9_ms": self.get_percentile(99.9) * 1000,
+            "rtt_max_ms": self.max * 1000,
+        }
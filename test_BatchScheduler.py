@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from BatchScheduler import BatchScheduler
+from CustomExceptions import InvalidTestPlan
+
+
+class LoadPlanTest(unittest.TestCase):
+    def load(self, *lines):
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as plan_file:
+            plan_file.write("\n".join(lines) + "\n")
+        self.addCleanup(os.remove, plan_file.name)
+        return BatchScheduler.load_plan(plan_file.name)
+
+    def test_valid_plan(self):
+        plan = self.load('{"name": "small", "size": "5 MB", "tcp": 2, "udp": 1, "repetitions": 3, "server": "10.0.0.5:41234:41235"}',
+                         '',
+                         '# a comment line',
+                         '{"size": 1000, "server": {"ip": "10.0.0.6", "tcp_port": 1, "udp_port": "2"}, "direction": "upload"}',
+                         '{"duration": 5, "warmup": 0.5, "udp": 1}')
+        self.assertEqual(len(plan), 3)
+        self.assertEqual(plan[0], {"name": "small", "file_size": 5 * 1048576, "num_of_tcp_conn": 2, "num_of_udp_conn": 1,
+                                   "repetitions": 3, "server": ("10.0.0.5", 41234, 41235), "direction": None,
+                                   "duration": None, "warmup": None})
+        self.assertEqual(plan[1]["name"], "test-4")  # named by its line
+        self.assertEqual(plan[1]["file_size"], 1000)
+        self.assertEqual(plan[1]["server"], ("10.0.0.6", 1, 2))
+        self.assertEqual(plan[1]["direction"], "upload")
+        self.assertEqual((plan[2]["duration"], plan[2]["warmup"], plan[2]["file_size"], plan[2]["server"]), (5.0, 0.5, 0, None))
+
+    def test_invalid_tests_report_their_line(self):
+        invalid_tests = ['{"tcp": 1}',  # no size
+                         '{"size": "5 TB"}',
+                         '{"size": 10, "direction": "sideways"}',
+                         '{"duration": 5, "direction": "upload"}',
+                         '{"size": 10, "server": "10.0.0.5:41234"}',
+                         '{"size": 10',
+                         '{"size": 10, "tcp": "many"}']
+        for test in invalid_tests:
+            with self.subTest(test=test):
+                with self.assertRaisesRegex(InvalidTestPlan, "line 2 "):
+                    self.load('{"size": 10}', test)
+
+    def test_parse_server(self):
+        self.assertIsNone(BatchScheduler.parse_server(None))
+        self.assertIsNone(BatchScheduler.parse_server("discover"))
+        self.assertEqual(BatchScheduler.parse_server("::1:10:20"), ("::1", 10, 20))
+
+    def test_aggregate_test(self):
+        test = {"name": "t", "file_size": 10, "num_of_tcp_conn": 1, "num_of_udp_conn": 1}
+        runs = [{"throughput": 100, "transfers_failed": 0, "udp_loss_percent": 1.0},
+                {"throughput": 300, "transfers_failed": 1, "udp_loss_percent": None}]
+        aggregate = BatchScheduler.aggregate_test(test, runs)
+        self.assertEqual(aggregate["throughput"]["mean"], 200)
+        self.assertEqual((aggregate["throughput"]["min"], aggregate["throughput"]["max"]), (100, 300))
+        self.assertEqual(aggregate["transfers_failed"], 1)
+        self.assertEqual(aggregate["udp_loss_percent"], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
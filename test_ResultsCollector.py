@@ -0,0 +1,42 @@
+import unittest
+from ResultsCollector import ResultsCollector
+
+
+def transfer(protocol, start_time, end_time, **fields):
+    return {"protocol": protocol, "start_time": start_time, "end_time": end_time, **fields}
+
+
+class ResultsCollectorTest(unittest.TestCase):
+    def test_union_time(self):
+        results = [transfer("tcp", 0, 2), transfer("tcp", 1, 3), transfer("tcp", 5, 6), transfer("tcp", 5.5, 5.8)]
+        self.assertEqual(ResultsCollector.get_union_time(results), 4)  # [0, 3] and [5, 6], the gap isn't counted
+        self.assertEqual(ResultsCollector.get_union_time(list(reversed(results))), 4)
+        self.assertEqual(ResultsCollector.get_union_time([]), 0)
+
+    def test_bytes_delivered(self):
+        tcp = transfer("tcp", 0, 1, bytes_received=1000)
+        udp = transfer("udp", 0, 1, file_size=1000, unique_segments=9, total_segments=10)
+        bidirectional = transfer("tcp", 0, 1, bytes_received=1000, upload=transfer("tcp", 0, 1, bytes_received=500))
+        self.assertEqual(ResultsCollector.get_bytes_delivered(tcp), 1000)
+        self.assertEqual(ResultsCollector.get_bytes_delivered(udp), 900)
+        self.assertEqual(ResultsCollector.get_bytes_delivered(bidirectional), 1500)
+
+    def test_aggregate(self):
+        results = [transfer("tcp", 0, 1, bytes_received=1000), transfer("tcp", 0.5, 2, bytes_received=1000),
+                   transfer("udp", 3, 4, file_size=1000, unique_segments=5, total_segments=10)]
+        aggregate = ResultsCollector.aggregate(results)
+        self.assertEqual(aggregate["transfers_completed"], 3)
+        self.assertEqual(aggregate["bytes_delivered"], 2500)
+        self.assertEqual(aggregate["wall_time"], 3)
+        self.assertAlmostEqual(aggregate["throughput"], 2500 * 8 / 3)
+        self.assertAlmostEqual(aggregate["tcp_throughput"], 2000 * 8 / 2)
+        self.assertAlmostEqual(aggregate["udp_throughput"], 500 * 8)
+
+    def test_aggregate_without_results(self):
+        aggregate = ResultsCollector.aggregate([])
+        self.assertEqual(aggregate["throughput"], 0)
+        self.assertEqual(aggregate["bytes_delivered"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import threading
+import unittest
+from SessionScheduler import SessionScheduler
+from ServerMetrics import MetricsRegistry
+
+
+class SessionSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.rejected = []
+
+    def submit(self, scheduler, client_ip, name, queue_timeout=None):
+        return scheduler.submit(client_ip, "tcp", lambda: self.started.append(name), lambda: self.rejected.append(name), queue_timeout)
+
+    def test_starts_right_away_without_limits(self):
+        scheduler = SessionScheduler()
+        for i in range(5):
+            self.assertTrue(self.submit(scheduler, "10.0.0.1", i))
+        self.assertEqual(self.started, [0, 1, 2, 3, 4])
+        self.assertEqual(scheduler.active_sessions, 5)
+
+    def test_per_client_limit_queues_in_order(self):
+        scheduler = SessionScheduler(max_sessions_per_client=1)
+        for name in ("a1", "a2", "a3"):
+            self.submit(scheduler, "10.0.0.1", name)
+        self.submit(scheduler, "10.0.0.2", "b1")  # another client isn't held back by the first one's limit
+        self.assertEqual(self.started, ["a1", "b1"])
+        scheduler.release("10.0.0.1")
+        scheduler.release("10.0.0.1")
+        self.assertEqual(self.started, ["a1", "b1", "a2", "a3"])
+        self.assertEqual(scheduler.queued_sessions, 0)
+
+    def test_freed_slots_go_round_robin_between_clients(self):
+        scheduler = SessionScheduler(max_sessions=1)
+        self.submit(scheduler, "10.0.0.1", "a1")
+        for name in ("a2", "a3", "a4"):  # the greedy client asks for more sessions first
+            self.submit(scheduler, "10.0.0.1", name)
+        for name in ("b1", "b2"):
+            self.submit(scheduler, "10.0.0.2", name)
+        for client_ip in ("10.0.0.1", "10.0.0.1", "10.0.0.2", "10.0.0.1", "10.0.0.2"):
+            scheduler.release(client_ip)
+        self.assertEqual(self.started, ["a1", "a2", "b1", "a3", "b2", "a4"])
+
+    def test_a_client_doesnt_overtake_its_queued_sessions(self):
+        scheduler = SessionScheduler(max_sessions=2)
+        self.submit(scheduler, "10.0.0.1", "a1")
+        self.submit(scheduler, "10.0.0.2", "b1")
+        self.submit(scheduler, "10.0.0.1", "a2")
+        scheduler.release("10.0.0.2")
+        self.assertEqual(self.started, ["a1", "b1", "a2"])
+
+    def test_full_queue_rejects(self):
+        metrics = MetricsRegistry()
+        scheduler = SessionScheduler(max_sessions=1, max_queued_sessions=1, metrics=metrics)
+        self.assertTrue(self.submit(scheduler, "10.0.0.1", "a1"))
+        self.assertTrue(self.submit(scheduler, "10.0.0.1", "a2"))
+        self.assertFalse(self.submit(scheduler, "10.0.0.1", "a3"))
+        self.assertEqual(self.rejected, ["a3"])
+        self.assertEqual(MetricsRegistry.get_total(metrics.snapshot(), "speedtest_sessions_rejected_total", reason="queue_full"), 1)
+
+    def test_waiting_sessions_expire_without_a_release(self):
+        scheduler = SessionScheduler(max_sessions=1)
+        expired = threading.Event()
+        self.submit(scheduler, "10.0.0.1", "a1")
+        scheduler.submit("10.0.0.2", "udp", lambda: self.started.append("b1"), expired.set, queue_timeout=0.05)
+        self.submit(scheduler, "10.0.0.3", "c1", queue_timeout=10)
+        self.assertTrue(expired.wait(2))  # rejected by the expiry timer, nothing was submitted or released since
+        self.assertEqual(scheduler.queued_sessions, 1)
+        scheduler.release("10.0.0.1")
+        self.assertEqual(self.started, ["a1", "c1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
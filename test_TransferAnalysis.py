@@ -0,0 +1,137 @@
+import unittest
+from TransferAnalysis import UdpLossAnalyzer, ThroughputSampler, LatencyHistogram
+
+
+class UdpLossAnalyzerTest(unittest.TestCase):
+    def test_loss_duplicates_and_reordering(self):
+        analyzer = UdpLossAnalyzer()
+        for time, segment in enumerate([0, 1, 3, 2, 2, 6, 7, 9]):
+            analyzer.add_segment(segment, 10, time * 0.001, 100)
+        report = analyzer.get_report()
+        self.assertEqual(report["total_segments"], 10)
+        self.assertEqual(report["segments_received"], 8)
+        self.assertEqual(report["unique_segments"], 7)
+        self.assertEqual(report["lost_segments"], 3)  # 4, 5 and 8
+        self.assertEqual(report["duplicates"], 1)
+        self.assertEqual(report["reordered"], 2)  # 2 arrived after 3, twice
+        self.assertEqual(report["max_reorder_depth"], 1)
+        self.assertEqual(analyzer.unique_bytes, 700)
+
+    def test_loss_bursts(self):
+        analyzer = UdpLossAnalyzer()
+        # a burst inside a byte, one across a byte boundary and one at the end, the padding bits aren't lost segments
+        for segment in [0, 3, 4, 5, 6, 10, 11, 12, 13, 14, 15, 16]:
+            analyzer.add_segment(segment, 20, 0.0)
+        self.assertEqual(analyzer.get_loss_bursts(), [2, 3, 3])
+        report = analyzer.get_report()
+        self.assertEqual(report["loss_bursts"], 3)
+        self.assertEqual(report["max_loss_burst"], 3)
+
+    def test_segments_past_the_total_are_ignored(self):
+        analyzer = UdpLossAnalyzer()
+        analyzer.add_segment(0, 2, 0.0)
+        analyzer.add_segment(5, 2, 0.0)
+        self.assertEqual(analyzer.segments_received, 1)
+
+    def test_open_ended_stream_grows_and_ends_with_the_marker(self):
+        analyzer = UdpLossAnalyzer()
+        for segment in [0, 1, 2, 30, 1000]:
+            analyzer.add_segment(segment, 0, 0.0)
+        self.assertTrue(analyzer.open_ended)
+        self.assertGreaterEqual(len(analyzer.bitmap) * 8, 1001)
+        analyzer.end_stream(1005)
+        report = analyzer.get_report()
+        self.assertEqual(report["total_segments"], 1005)
+        self.assertEqual(report["unique_segments"], 5)
+        self.assertEqual(report["lost_segments"], 1000)
+
+    def test_open_ended_stream_without_a_marker_ends_with_its_last_segment(self):
+        analyzer = UdpLossAnalyzer()
+        for segment in [0, 1, 3]:
+            analyzer.add_segment(segment, 0, 0.0)
+        report = analyzer.get_report()
+        self.assertEqual(report["total_segments"], 4)
+        self.assertEqual(report["lost_segments"], 1)
+
+    def test_warmup_starts_with_the_first_segment(self):
+        analyzer = UdpLossAnalyzer(warmup=1.0)
+        for segment, arrival_time in enumerate([100.0, 100.5, 101.0, 101.5]):
+            analyzer.add_segment(segment, 4, arrival_time, 10)
+        self.assertEqual(analyzer.warmup_end, 101.0)
+        self.assertEqual(analyzer.warmup_bytes, 20)
+        self.assertEqual(analyzer.unique_bytes, 40)
+
+    def test_no_segments(self):
+        self.assertIsNone(UdpLossAnalyzer().get_report())
+
+
+class ThroughputSamplerTest(unittest.TestCase):
+    def test_intervals_and_time_to_first_byte(self):
+        sampler = ThroughputSampler(interval=0.25)
+        sampler.start(10.0)
+        for i in range(10):
+            sampler.add(1000, 10.5 + i * 0.125)
+        self.assertEqual(sampler.total_bytes, 10000)
+        self.assertEqual(sampler.samples, [2000] * 5)
+        report = sampler.get_report()
+        self.assertEqual(report["time_to_first_byte"], 0.5)
+        self.assertEqual(report["interval_speeds"], [64000.0] * 4)
+
+    def test_warmup_starts_with_the_first_byte(self):
+        sampler = ThroughputSampler()
+        sampler.start(10.0, warmup=1.0)
+        sampler.add(100, 15.0)  # the request waited 5 seconds in the server's queue
+        sampler.add(100, 15.5)
+        sampler.add(100, 16.5)
+        self.assertEqual(sampler.warmup_end, 16.0)
+        self.assertEqual(sampler.warmup_bytes, 200)
+
+    def test_no_data(self):
+        sampler = ThroughputSampler()
+        sampler.start(0.0)
+        self.assertIsNone(sampler.get_report())
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_percentiles_within_precision(self):
+        histogram = LatencyHistogram(precision=0.02)
+        values = [(i + 1) / 10000 for i in range(1000)]  # 0.1 ms to 100 ms
+        for value in values:
+            histogram.add(value)
+        for percentile in (50, 90, 99, 99.9):
+            exact = values[int(percentile / 100 * len(values)) - 1]
+            self.assertAlmostEqual(histogram.get_percentile(percentile), exact, delta=exact * 0.02)
+        self.assertEqual(histogram.get_percentile(100), values[-1])
+
+    def test_percentiles_stay_within_min_and_max(self):
+        histogram = LatencyHistogram()
+        for _ in range(10):
+            histogram.add(0.001)
+        self.assertEqual(histogram.get_percentile(0), 0.001)
+        self.assertEqual(histogram.get_percentile(99.9), 0.001)
+
+    def test_out_of_range_values(self):
+        histogram = LatencyHistogram(min_value=1e-3, max_value=1)
+        histogram.add(1e-5)
+        histogram.add(50)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        # the values are reported as their bucket's, the first and the last buckets are bounded by min_value and max_value
+        self.assertEqual(histogram.get_percentile(50), 1e-3)
+        self.assertAlmostEqual(histogram.get_percentile(100), 1, delta=0.02)
+        self.assertEqual(histogram.max, 50)
+
+    def test_report(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.get_report())
+        histogram.add(0.002)
+        histogram.add(0.004)
+        report = histogram.get_report()
+        self.assertEqual(report["rtt_count"], 2)
+        self.assertAlmostEqual(report["rtt_mean_ms"], 3)
+        self.assertAlmostEqual(report["rtt_min_ms"], 2)
+        self.assertAlmostEqual(report["rtt_max_ms"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import threading
+import unittest
+from ClientMethods import ClientMethods
+from ServerMethods import ServerMethods
+
+
+class UdpTransfersTest(unittest.TestCase):
+    """Upload and bidirectional UDP transfers against a local server, over the loopback interface"""
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ServerMethods(broadcast_port=0, udp_target_rate=200e6)
+        threading.Thread(target=cls.server.listen_for_UDP_requests, daemon=True).start()
+
+    def create_client(self, direction):
+        client = ClientMethods(broadcast_port=0, file_size=500_000, num_of_tcp_conn=0, num_of_udp_conn=1, print_results=False,
+                               direction=direction, udp_upload_rate=200e6)
+        client.server_ip, client.tcp_request_port, client.udp_request_port = "127.0.0.1", self.server.tcp_main_port, self.server.udp_main_port
+        return client
+
+    def test_upload(self):
+        client = self.create_client("upload")
+        for transfer_id in range(1, 4):
+            result = client.run_udp_upload_test(transfer_id)
+            self.assertIsNotNone(result)
+            self.assertEqual(result["direction"], "upload")
+
+    def test_bidirectional(self):
+        # the marker's late copies reach the server's closed socket, the ICMP error mustn't fail the transfer
+        client = self.create_client("bidirectional")
+        for transfer_id in range(1, 7):
+            result = client.run_udp_upload_test(transfer_id)
+            self.assertIsNotNone(result)
+            self.assertEqual(result["direction"], "bidirectional")
+            self.assertIsNotNone(result["upload"])
+
+
+if __name__ == "__main__":
+    unittest.main()